@@ -0,0 +1,195 @@
+"""
+Load test of a server with many concurrent bot clients using aiosnek.
+Each bot registers, then sets a random direction and asks for the updated state at the given rates,
+over a persistent connection (or a new connection for each command with --one-shot).
+It reports latency percentiles, throughput and errors of each command and, when the server is started by the load test
+itself (i.e. without --host), the lateness of the server's ticks.
+Run from the root of the repository with: python -m benchmarks.load (see --help for the options)
+Note that thousands of clients may need a higher limit of open files (e.g. ulimit -n).
+"""
+import argparse
+import asyncio
+import multiprocessing
+import random
+import socket
+import time
+from collections import Counter, defaultdict, deque
+
+from server import PacManSnekEngine
+from sneklib import aiosnek, servers
+from sneklib.acceptors import AcceptorsServer
+
+DIRECTIONS = (b'\x01', b'\x02', b'\x03', b'\x04')
+
+
+class QuietServer(servers.AsyncTCPServer):
+    """AsyncTCPServer without the printing user interface"""
+
+    async def user_interface_loop(self):
+        pass
+
+
+class QuietAcceptorsServer(AcceptorsServer):
+    """AcceptorsServer without the printing user interface"""
+
+    async def user_interface_loop(self):
+        pass
+
+
+def serve(address, width, height, players, game_tick, acceptors, stop, results):
+    """
+    runs a server (an AcceptorsServer with that many acceptors if acceptors isn't 0) until stop is set,
+    then puts the lateness, move and fan-out times of its ticks in results
+    """
+    asyncio.run(_serve(address, width, height, players, game_tick, acceptors, stop, results))
+
+
+async def _serve(address, width, height, players, game_tick, acceptors, stop, results):
+    engine = PacManSnekEngine(width=width, height=height, max_food=players, game_tick=game_tick)
+    engine.stats = deque()
+    if acceptors:
+        server = QuietAcceptorsServer(address, engine, max_connections=players)
+        server.ACCEPTORS = acceptors
+    else:
+        server = QuietServer(address, engine, max_connections=players)
+    task = asyncio.ensure_future(server.loop())
+
+    await asyncio.get_running_loop().run_in_executor(None, stop.wait)
+    task.cancel()
+    results.put(([(stats.lateness, stats.move, stats.fan_out) for stats in engine.stats], engine.overruns))
+
+
+class Bot:
+    """a client registering a snek and playing randomly until deadline, recording the latency of each command"""
+
+    def __init__(self, host, port, one_shot, dir_rate, poll_rate, latencies, errors):
+        self.commands = aiosnek._OneShot(host, port) if one_shot else aiosnek.Connection(host, port)
+        self.one_shot = one_shot
+        self.dir_rate = dir_rate
+        self.poll_rate = poll_rate
+        self.latencies = latencies
+        self.errors = errors
+
+    async def timed(self, name, command, *args):
+        """sends a command, recording its latency or the error it raised"""
+        start = time.perf_counter()
+        try:
+            res = await command(*args)
+        except Exception as e:
+            self.errors[name, type(e).__name__] += 1
+            raise
+        self.latencies[name].append(time.perf_counter() - start)
+        return res
+
+    async def play(self, deadline):
+        """plays until deadline, setting a direction every 1 / dir_rate seconds and polling every 1 / poll_rate"""
+        commands = self.commands
+        if not self.one_shot:
+            await self.timed('connect', commands.open)
+        try:
+            hash_id = await self.timed('register', commands.register, 'bot')
+            next_dir = next_poll = time.monotonic()
+            while time.monotonic() < deadline:
+                now = time.monotonic()
+                if now >= next_dir:
+                    await self.timed('set_dir', commands.set_dir, hash_id, random.choice(DIRECTIONS))
+                    next_dir += 1 / self.dir_rate
+                if now >= next_poll:
+                    player, _, _ = await self.timed('get_updated_state', commands.get_updated_state, hash_id)
+                    if not player[0]:  # dead, play again with a new snek
+                        hash_id = await self.timed('register', commands.register, 'bot')
+                    next_poll += 1 / self.poll_rate
+                await asyncio.sleep(max(min(next_dir, next_poll) - time.monotonic(), 0))
+        except Exception:
+            pass  # already counted in self.errors
+        finally:
+            if not self.one_shot and commands.writer is not None:
+                commands.writer.close()
+
+
+async def load(args, latencies, errors):
+    """starts args.clients bots over args.ramp seconds and waits for them to play for args.seconds"""
+    deadline = time.monotonic() + args.ramp + args.seconds
+    bots = []
+    for i in range(args.clients):
+        bot = Bot(args.host or 'localhost', args.port, args.one_shot, args.dir_rate, args.poll_rate, latencies, errors)
+        bots.append(asyncio.ensure_future(bot.play(deadline)))
+        await asyncio.sleep(args.ramp / args.clients)
+    await asyncio.gather(*bots)
+
+
+def wait_listening(host, port, timeout=30):
+    """waits until a server accepts connections on (host, port), for at most timeout seconds"""
+    deadline = time.monotonic() + timeout
+    while 1:
+        try:
+            socket.create_connection((host, port)).close()
+            return
+        except ConnectionError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def percentiles(values, ps=(50, 90, 99)):
+    """the given percentiles of values, followed by their maximum"""
+    values = sorted(values)
+    return [values[min(len(values) * p // 100, len(values) - 1)] for p in ps] + [values[-1]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', help='host of a running server; if not given, a server is started locally')
+    parser.add_argument('--port', type=int, default=12346)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--seconds', type=float, default=10, help='duration of the test after all clients started')
+    parser.add_argument('--ramp', type=float, default=5, help='seconds over which clients are started')
+    parser.add_argument('--dir-rate', type=float, default=2, help='directions set per second by each client')
+    parser.add_argument('--poll-rate', type=float, default=10, help='updated states asked per second by each client')
+    parser.add_argument('--one-shot', action='store_true', help='send each command over a new connection')
+    parser.add_argument('--size', default='400x400', help='board size of the local server as WIDTHxHEIGHT')
+    parser.add_argument('--game-tick', type=float, default=0.1, help='seconds per tick of the local server')
+    parser.add_argument('--acceptors', type=int, default=0,
+                        help='run the local server as an AcceptorsServer with that many acceptor processes')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    process = None
+    if args.host is None:
+        width, height = map(int, args.size.split('x'))
+        stop = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=serve, args=(('localhost', args.port), width, height, args.clients,
+                                                              args.game_tick, args.acceptors, stop, results))
+        process.start()
+        wait_listening('localhost', args.port)
+
+    latencies = defaultdict(list)
+    errors = Counter()
+    start = time.perf_counter()
+    asyncio.run(load(args, latencies, errors))
+    elapsed = time.perf_counter() - start
+
+    print(f'{args.clients} clients, {elapsed:.1f} seconds')
+    print(f"{'command':>18} {'requests':>9} {'req/s':>9} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, values in latencies.items():
+        line = ' '.join(f'{value * 1e3:>9.2f}' for value in percentiles(values))
+        print(f'{name:>18} {len(values):>9} {len(values) / elapsed:>9.0f} {line}')
+    for (name, error), count in errors.items():
+        print(f'{count} errors in {name}: {error}')
+
+    if process is not None:
+        stop.set()
+        ticks, overruns = results.get()
+        process.join()
+        if ticks:
+            print(f'{len(ticks)} ticks, {overruns} overruns')
+            print(f"{'tick':>18} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+            for name, values in zip(('lateness', 'move', 'fan-out'), zip(*ticks)):
+                line = ' '.join(f'{value * 1e3:>9.2f}' for value in percentiles(values))
+                print(f'{name:>18} {line}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""
+Benchmark for the cost of spawning food and sneks in the example snek engine.
+Run from the root of the repository with: python -m benchmarks.spawn
+"""
+import random
+import time
+
+from server import SnekEngine, Wall
+
+SIZES = ((100, 100), (1000, 1000))
+SPAWNS = 1000
+
+
+def spawn_food(engine):
+    """spawns a food and indexes it like engine.tick() would"""
+    food = engine.create_food()
+    engine.occupancy.add(food, food.whole)
+
+
+def measure(function, *args, repeat=SPAWNS):
+    """average time in microseconds of a call to function"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(*args)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    random.seed(0)
+    print(f"{'board':>12} {'setup (ms)':>12} {'food (us)':>12} {'snek (us)':>12}")
+    for width, height in SIZES:
+        walls = [Wall(pos=(x, height // 2)) for x in range(width)]
+
+        start = time.perf_counter()
+        engine = SnekEngine(width=width, height=height, max_food=SPAWNS, game_tick=0, walls=walls)
+        setup = (time.perf_counter() - start) * 1e3
+
+        food = measure(spawn_food, engine)
+        snek = measure(engine.create_snek)
+        print(f"{f'{width}x{height}':>12} {setup:>12.1f} {food:>12.2f} {snek:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""
+Benchmark for the cost of running the example snek engines and of serving their state to players, without sockets.
+Synthetic bots register, turn and request the state of the game through Server.deal_with_request for a number of ticks,
+and the time spent in each phase of a tick and in answering each state command is reported, together with memory.
+Run from the root of the repository with: python -m benchmarks.ticks (see --help for the options)
+"""
+import argparse
+import random
+import time
+import tracemalloc
+from collections import defaultdict
+from itertools import product
+
+from server import ArrayPacManSnekEngine, ArraySnekEngine, PacManSnekEngine, SnekEngine, Wall, numpy
+from sneklib.basetypes import Server
+
+ENGINES = {'snek': SnekEngine, 'pacman': PacManSnekEngine}
+if numpy is not None:
+    ENGINES.update({'array': ArraySnekEngine, 'array-pacman': ArrayPacManSnekEngine})
+PHASES = ('kill_sneks', 'eat_food', 'move_sneks', 'spawn_food')
+COMMANDS = (3, 4, 254, 255)
+DIRECTIONS = {'u': b'\x01', 'l': b'\x02', 'd': b'\x03', 'r': b'\x04'}
+
+
+def timed(engine_class, times):
+    """subclass of engine_class adding the time spent in each phase of move() to times"""
+    def wrap(name):
+        method = getattr(engine_class, name)
+
+        def wrapper(self, *args):
+            start = time.perf_counter()
+            res = method(self, *args)
+            times[name] += time.perf_counter() - start
+            return res
+        return wrapper
+
+    return type(f'Timed{engine_class.__name__}', (engine_class,), {name: wrap(name) for name in PHASES})
+
+
+def next_block(engine, snek, direction):
+    """the block the head of snek would move to with direction, or None if it is outside of the board"""
+    (x, y), (dx, dy) = snek.head[0], snek.MOVEMENT[direction]
+    x, y = x + dx, y + dy
+    if isinstance(engine, PacManSnekEngine):
+        return x % engine.width, y % engine.height
+    if 0 <= x < engine.width and 0 <= y < engine.height:
+        return x, y
+    return None
+
+
+def occupied(engine, block):
+    """whether something is on block, looked up in the index of the board kept by engine"""
+    if engine.indexed:
+        return block in engine.occupancy
+    cell = block[1] * engine.width + block[0]
+    return bool(engine.solid_board[cell] or engine.food_board[cell])
+
+
+def choose_direction(engine, snek):
+    """keeps going straight if the next block is free, otherwise turns randomly towards a free block"""
+    directions = [direction for direction in DIRECTIONS if direction != snek.OPPOSITE[snek.dir]]
+    free = []
+    for direction in directions:
+        block = next_block(engine, snek, direction)
+        if block is not None and not occupied(engine, block):
+            free.append(direction)
+    if snek.dir in free and random.random() > 0.1:
+        return snek.dir
+    return random.choice(free or directions)
+
+
+def run(engine_name, width, height, players, length, walls, ticks):
+    """runs a game, returning the number of seconds spent in each phase and command, and the number of requests"""
+    times = defaultdict(float)
+    requests = defaultdict(int)
+
+    cells = random.sample(range(width * height), int(width * height * walls))
+    wall_list = [Wall(pos=(cell % width, cell // width)) for cell in cells]
+    engine = timed(ENGINES[engine_name], times)(width=width, height=height, max_food=players, game_tick=0,
+                                                walls=wall_list)
+    server = Server(None, engine, max_connections=players)
+    bots = [b''] * players
+
+    for _ in range(ticks):
+        for i, hash_id in enumerate(bots):
+            player = server.players.get(hash_id)
+            if player is None or not player.snek.alive:
+                bots[i] = hash_id = server.deal_with_request(0, b'bot')
+                player = server.players.get(hash_id)
+            if player is None:  # no room left on the board
+                continue
+            snek = player.snek
+            if len(snek.whole) < length:
+                snek.will_grow = True
+            server.deal_with_request(1, hash_id + DIRECTIONS[choose_direction(engine, snek)])
+
+        start = time.perf_counter()
+        tick = engine.tick()
+        moved = time.perf_counter()
+        server.update(*tick)
+        times['tick'] += moved - start
+        times['fan_out'] += time.perf_counter() - moved
+
+        for i, hash_id in enumerate(bots):
+            if hash_id not in server.players:
+                continue
+            c = COMMANDS[i % len(COMMANDS)]
+            start = time.perf_counter()
+            server.deal_with_request(c, hash_id)
+            times[c] += time.perf_counter() - start
+            requests[c] += 1
+
+    return times, requests
+
+
+def measure_memory(*args):
+    """peak memory in megabytes allocated while running a game"""
+    tracemalloc.start()
+    try:
+        run(*args)
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--engine', choices=ENGINES, default='pacman')
+    parser.add_argument('--sizes', nargs='+', default=['50x50', '200x200'], help='board sizes as WIDTHxHEIGHT')
+    parser.add_argument('--players', nargs='+', type=int, default=[10, 100])
+    parser.add_argument('--lengths', nargs='+', type=int, default=[10], help='lengths the sneks grow to')
+    parser.add_argument('--walls', nargs='+', type=float, default=[0.0, 0.1], help='fractions of cells with walls')
+    parser.add_argument('--ticks', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help="don't run each game again to measure memory")
+    args = parser.parse_args()
+
+    columns = ('board', 'players', 'length', 'walls', 'ticks/s', 'kill', 'eat', 'move', 'spawn', 'fan-out',
+               *(f'cmd {c}' for c in COMMANDS), 'MB')
+    print('times in microseconds per tick (phases) and per request (commands)')
+    print(' '.join(f'{column:>9}' for column in columns))
+    for size, players, length, walls in product(args.sizes, args.players, args.lengths, args.walls):
+        width, height = map(int, size.split('x'))
+        config = (args.engine, width, height, players, length, walls, args.ticks)
+
+        random.seed(args.seed)
+        times, requests = run(*config)
+        memory = float('nan')
+        if not args.no_memory:
+            random.seed(args.seed)
+            memory = measure_memory(*config)
+
+        per_tick = [times[phase] / args.ticks * 1e6 for phase in PHASES + ('fan_out',)]
+        per_request = [times[c] / requests[c] * 1e6 if requests[c] else float('nan') for c in COMMANDS]
+        ticks_per_second = args.ticks / (times['tick'] + times['fan_out'])
+        values = (size, players, length, walls, f'{ticks_per_second:.0f}',
+                  *(f'{value:.1f}' for value in per_tick + per_request), f'{memory:.1f}')
+        print(' '.join(f'{value:>9}' for value in values))
+
+
+if __name__ == '__main__':
+    main()
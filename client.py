@@ -13,7 +13,7 @@ width: int = 20
 grid: list
 
 
-async def gather_keyboard(host, port, hash_id):
+async def gather_keyboard(connection, hash_id):
     direction = 'u'
     while True:
         new_direction = 0
@@ -30,7 +30,7 @@ async def gather_keyboard(host, port, hash_id):
 
         if new_direction != 0 and new_direction != direction:
             direction = new_direction
-            await aiosnek.set_dir(host, port, hash_id, DIRECTION[direction])
+            await connection.set_dir(hash_id, DIRECTION[direction])
 
         await asyncio.sleep(0.003)
 
@@ -60,9 +60,9 @@ def draw_screen_partial(news, olds):  # TODO: improve
         print()
 
 
-async def handle_connection(host, port, hash_id):
+async def handle_connection(connection, hash_id):
     while 1:
-        alive, new_blocks, old_blocks = await aiosnek.get_current_blocks(host, port, hash_id)
+        alive, new_blocks, old_blocks = await connection.get_current_blocks(hash_id)
 
         if not alive:
             sys.exit()
@@ -78,18 +78,19 @@ async def main():
 
     host, port = 'localhost', 12345
     print(host, port)
-    hash_id = await aiosnek.register(host, port)
+    async with aiosnek.Connection(host, port) as connection:
+        hash_id = await connection.register()
 
-    infos = await aiosnek.get_infos(host, port)
-    if 'width' in infos:
-        width = infos['width']
-    if 'height' in infos:
-        height = infos['height']
+        infos = await connection.get_infos()
+        if 'width' in infos:
+            width = infos['width']
+        if 'height' in infos:
+            height = infos['height']
 
-    grid = [[' ' for x in range(width)] for y in range(height)]
+        grid = [[' ' for x in range(width)] for y in range(height)]
 
-    print(infos)
-    await asyncio.gather(handle_connection(host, port, hash_id), gather_keyboard(host, port, hash_id))
+        print(infos)
+        await asyncio.gather(handle_connection(connection, hash_id), gather_keyboard(connection, hash_id))
 
 if __name__ == '__main__':
     asyncio.run(main())
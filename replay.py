@@ -0,0 +1,58 @@
+"""
+Replays a game recorded by a server (see Server.RECORDING), printing the board after the given ticks.
+Run with: python replay.py RECORDING [START [STOP]] (see --help for the options)
+"""
+import argparse
+import time
+
+from sneklib.replay import Replay
+
+SYMBOLS = '#@*+%&'  # sneks are drawn with the first symbol, each other kind with the following ones
+
+
+def draw_board(state, width, height):
+    """prints the blocks of every object of state on a width x height board"""
+    grid = [[' ' for x in range(width)] for y in range(height)]
+    sneks, kinds = state
+    for symbol, objs in zip(SYMBOLS, [sneks] + kinds):
+        for data, blocks in objs:
+            for x, y in blocks:
+                if 0 <= x < width and 0 <= y < height:
+                    grid[y][x] = symbol
+    for row in grid:
+        print(' '.join(row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('recording')
+    parser.add_argument('start', type=int, nargs='?', help='first tick to print (the last one if not given)')
+    parser.add_argument('stop', type=int, nargs='?', help='tick to stop before (only START if not given)')
+    parser.add_argument('--time', action='store_true', help='rebuild every tick without printing, and time it')
+    args = parser.parse_args()
+
+    replay = Replay(args.recording)
+    print(f'infos: {replay.infos}, ticks {replay.first} to {replay.last}, {len(replay.keyframes)} keyframes')
+    if replay.first is None:
+        return
+
+    if args.time:
+        start = time.perf_counter()
+        ticks = sum(1 for _ in replay.states(replay.first))
+        elapsed = time.perf_counter() - start
+        print(f'{ticks} ticks rebuilt in {elapsed:.3f} seconds ({ticks / elapsed:.0f} ticks/s)')
+        return
+
+    infos = replay.infos if isinstance(replay.infos, dict) else {}
+    start = replay.last if args.start is None else args.start
+    stop = start + 1 if args.stop is None else args.stop
+    for tick, state in replay.states(start, stop):
+        sneks, kinds = state
+        print(f'tick {tick}: ' + ', '.join(str(data.get('name') if isinstance(data, dict) else data)
+                                           for data, blocks in sneks))
+        if 'width' in infos and 'height' in infos:
+            draw_board(state, infos['width'], infos['height'])
+
+
+if __name__ == '__main__':
+    main()
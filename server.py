@@ -1,8 +1,13 @@
 import random
 from functools import partial
-from itertools import chain
 
 from sneklib import basetypes, servers
+from sneklib.spatial import FreeCells
+
+try:
+    import numpy
+except ImportError:  # numpy is optional, it is only needed for the array engines
+    numpy = None
 
 
 # pacman effect -> snek wraps to the other side when it exits
@@ -10,6 +15,8 @@ from sneklib import basetypes, servers
 
 class Snek(basetypes.Snek):
     MOVEMENT = {'u': (0, -1), 'l': (-1, 0), 'd': (0, 1), 'r': (1, 0), 'lol': (0, -3)}
+    OPPOSITE = {'u': 'd', 'l': 'r', 'd': 'u', 'r': 'l'}
+    _body_type = basetypes.Body
 
     def __init__(self, direction='u', pos=(0, 0), name=''):
         """ snek spawns vertical, facing up, 3 blocks high """
@@ -33,16 +40,37 @@ class Snek(basetypes.Snek):
         else:
             return self.future_head + self.head + self.body
 
+    def covers(self, block):
+        """same as block in self.head + self.body, but in O(1)"""
+        whole = self.whole
+        return whole.count(block) > (len(whole) > 1 and block == whole[-1])
+
+    def will_cover(self, block):
+        """same as block in self.future_whole, but in O(1)"""
+        if block == self.future_head[0]:
+            return True
+        if self.will_grow:
+            return block in self.whole
+        return self.covers(block)
+
     def move(self):
-        res = (self.future_head, []) if self.will_grow else (self.future_head, self.tail)
-        super().move()
+        head = self.future_head
+        self.whole.push(head[0])
+        res = (head, []) if self.will_grow else (head, [self.whole.pop()])
         self.will_grow = False
         return res
 
+    def valid_input(self, previous, direction):
+        """a snek can't turn back on itself"""
+        return direction != previous and self.OPPOSITE.get(direction) != previous
+
     def __rshift__(self, other):
+        head = self.future_head[0]
         if other is self:
-            return self.future_head[0] in (other.head + other.body)
-        return self.future_head[0] in other.future_whole
+            return self.covers(head)
+        if isinstance(other, Snek):
+            return other.will_cover(head)
+        return head in other.future_whole
 
 
 class PacManSnek(Snek):
@@ -71,12 +99,18 @@ class Wall(basetypes.Snek):
 
 class SnekEngine(basetypes.SnekEngine):
     _snek_factory = Snek
+    static_kinds = (Wall,)
     mode = 'Snek'
 
     def __init__(self, width, height, max_food, game_tick, sneks=(), foods=(), walls=()):
         self.width = width
         self.height = height
         self.target_food = max_food
+        # cells where food can spawn, and top cells of the 3 blocks high columns where sneks can spawn
+        self.free_cells = self.spawn_cells = None
+        if self.indexed:  # they are kept up to date through self.occupancy
+            self.free_cells = FreeCells(width * max(height - 3, 0))
+            self.spawn_cells = FreeCells(width * height, 3 * width, (height - 3) * width)
         infos = {'mode': self.mode, 'width': self.width, 'height': self.height}
         super().__init__(sneks, {Food: foods, Wall: walls}, game_tick, infos)
 
@@ -102,24 +136,42 @@ class SnekEngine(basetypes.SnekEngine):
         foods = {}
         new_foods = {}
 
-        # kill sneks
+        future_heads = {snek: snek.future_head[0] for snek in self.sneks}
+
+        self.kill_sneks(sneks, future_heads)
+        self.eat_food(foods, future_heads)
+        self.move_sneks(sneks)
+        self.spawn_food(new_foods)
+
+        return sneks, {}, {Food: foods}, {Food: new_foods}
+
+    def kill_sneks(self, sneks, future_heads):
+        """kills the sneks that would hit something, adding the news and olds of every snek to sneks"""
+        heads = {}
+        for head in future_heads.values():
+            heads[head] = heads.get(head, 0) + 1
+
         keep_sneks = []
         for s1 in self.sneks:
             sneks[s1] = [[], []]
-            if not self.snek_within(s1) or any((s1 >> s2 for s2 in chain(self.sneks, self.walls))) or not s1.alive:
+            if not s1.alive or not self.snek_within(s1) or self.snek_collides(future_heads[s1], heads):
                 s1.kill()
                 sneks[s1][1] += s1.whole
             else:
                 keep_sneks.append(s1)
         self.sneks = keep_sneks
 
-        # eat food
+    def eat_food(self, foods, future_heads):
+        """makes the sneks eat the food under their future heads, adding the news and olds of every food to foods"""
+        eaters = {}
+        for s1 in self.sneks:
+            eaters.setdefault(future_heads[s1], s1)
         keep_foods = []
         for food in self.foods:
             foods[food] = [[], []]
-            for s1 in self.sneks:
-                if s1 >> food:
-                    s1.will_grow = True
+            for block in food.whole:
+                if block in eaters:
+                    eaters[block].will_grow = True
                     food.kill()
                     foods[food][1] += food.whole
                     break
@@ -127,40 +179,67 @@ class SnekEngine(basetypes.SnekEngine):
                 keep_foods.append(food)
         self.foods = keep_foods
 
-        # move sneks
+    def move_sneks(self, sneks):
+        """moves the sneks, adding their news and olds to sneks"""
         for snek in self.sneks:
             news, olds = snek.move()
             sneks[snek][0] += news
             sneks[snek][1] += olds
+            for block in news:  # self.occupancy only gets the news after move(), but food spawns in this same tick
+                self.cell_occupied(block)
 
-        # create food
+    def spawn_food(self, new_foods):
+        """creates a food if there is less than target_food, adding it to new_foods"""
         if len(self.foods) < self.target_food:
             food = self.create_food()
             if food:
                 new_foods[food] = [food.whole, []]
 
-        return sneks, {}, {Food: foods}, {Food: new_foods}
+    def snek_collides(self, head, heads):
+        """
+        tells whether a snek moving its head to head would hit something, using the occupancy index.
+        heads counts how many sneks are moving their head to each block
+        """
+        if heads[head] > 1:
+            return True
+        for owner in self.occupancy.owners(head):
+            if isinstance(owner, Food):
+                continue
+            if isinstance(owner, Snek) and not owner.will_grow and head == owner.tail[0] != owner.head[0]:
+                continue  # the tail is moving away in this same tick
+            return True
+        return False
+
+    def cell_occupied(self, block):
+        x, y = block
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return
+        if y < self.height - 3:
+            self.free_cells.discard(y * self.width + x)
+        for top in range(max(y - 2, 3), min(y + 1, self.height - 3)):
+            self.spawn_cells.discard(top * self.width + x)
+
+    def cell_freed(self, block):
+        x, y = block
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return
+        if y < self.height - 3:
+            self.free_cells.add(y * self.width + x)
+        for top in range(max(y - 2, 3), min(y + 1, self.height - 3)):
+            if all((x, top + b) not in self.occupancy for b in range(3)):
+                self.spawn_cells.add(top * self.width + x)
 
     def create_snek(self, *args, **kwargs):
-        t = []
-        for x in range(self.width):
-            for y in range(3, self.height - 3):
-                if all((x, y + b) not in self.all_blocks for b in range(3)):
-                    t.append((x, y))
-
-        if t:
-            return super().create_snek(pos=random.choice(t), *args, **kwargs)
+        self.index_changed_lists()
+        if self.spawn_cells:
+            y, x = divmod(self.spawn_cells.choice(), self.width)
+            return super().create_snek(pos=(x, y), *args, **kwargs)
         return None  # IDEA: maybe raise instead
 
     def create_food(self):
-        t = []
-        for x in range(self.width):
-            for y in range(self.height - 3):
-                if (x, y) not in self.all_blocks:
-                    t.append((x, y))
-
-        if t:
-            res = Food(pos=random.choice(t))
+        if self.free_cells:
+            y, x = divmod(self.free_cells.choice(), self.width)
+            res = Food(pos=(x, y))
             self.foods.append(res)
             return res
         return None  # IDEA: maybe raise instead
@@ -178,11 +257,177 @@ class PacManSnekEngine(SnekEngine):
         self._snek_factory = partial(self._snek_factory, dimensions=(width, height))
 
 
+class ArraySnekEngine(SnekEngine):
+    """
+    SnekEngine with the same rules, which computes the future heads, the collisions and the food eaten by every snek at
+    once with numpy arrays instead of one snek at a time: the blocks of the board are counted in solid_board (sneks and
+    walls) and food_board (foods), indexed by y * width + x, so each check is a lookup of every head in these arrays.
+    The boards are kept up to date by the engine itself (so sneks and foods should only be added with create_snek and
+    create_food), and are built again whenever the walls change (see static_changed). The cells where sneks and foods
+    spawn are also found in the boards, so occupancy, free_cells and spawn_cells are not kept (see indexed).
+    """
+
+    indexed = False
+    wraps = False  # whether sneks exiting the board come back from the other side
+
+    def __init__(self, width, height, max_food, game_tick, sneks=(), foods=(), walls=()):
+        if numpy is None:
+            raise ImportError(f'{type(self).__name__} needs numpy')
+        super().__init__(width, height, max_food, game_tick, sneks, foods, walls)
+        self.__leaving = numpy.zeros(width * height, numpy.int32)  # tails moving away, only set during kill_sneks
+        self.__build_boards()
+
+    def move(self):
+        if self.static_kind(Wall) is not self.__walls:
+            self.__build_boards()
+        sneks = {}
+        foods = {}
+        new_foods = {}
+
+        rows = [(*snek.whole[0], *snek.MOVEMENT[snek.dir]) for snek in self.sneks]
+        rows = numpy.array(rows, numpy.int64).reshape(-1, 4)
+        future_heads = rows[:, :2] + rows[:, 2:]
+        if self.wraps:
+            future_heads %= (self.width, self.height)
+
+        future_heads = self.kill_sneks(sneks, future_heads)
+        self.eat_food(foods, future_heads)
+        self.move_sneks(sneks, future_heads)
+        self.spawn_food(new_foods)
+
+        return sneks, {}, {Food: foods}, {Food: new_foods}
+
+    def kill_sneks(self, sneks, future_heads):
+        """
+        kills the sneks that would hit something, adding the news and olds of every snek to sneks,
+        and returns the future heads of the sneks left
+        """
+        width, height = self.width, self.height
+        rows = [(*snek.whole[0], *snek.whole[-1], snek.alive, snek.will_grow) for snek in self.sneks]
+        rows = numpy.array(rows, numpy.int64).reshape(-1, 6)
+
+        x, y = future_heads[:, 0], future_heads[:, 1]
+        within = (0 <= x) & (x < width) & (0 <= y) & (y < height)
+        cells = numpy.where(within, y * width + x, -1)
+        _, inverse, counts = numpy.unique(cells, return_inverse=True, return_counts=True)
+
+        # a tail moving away in this same tick doesn't block a head
+        moving = (rows[:, 5] == 0) & (rows[:, 0:2] != rows[:, 2:4]).any(axis=1)
+        tails = rows[moving, 3] * width + rows[moving, 2]
+        numpy.add.at(self.__leaving, tails, 1)
+        blocked = numpy.zeros(len(cells), bool)
+        blocked[within] = self.solid_board[cells[within]] > self.__leaving[cells[within]]
+        self.__leaving[tails] = 0
+
+        dead = (rows[:, 4] == 0) | ~within | (counts[inverse.reshape(-1)] > 1) | blocked
+        keep_sneks = []
+        olds = []
+        for snek, snek_dead in zip(self.sneks, dead.tolist()):
+            if snek_dead:
+                snek.kill()
+                sneks[snek] = [[], list(snek.whole)]
+                olds += snek.whole
+            else:
+                sneks[snek] = [[], []]
+                keep_sneks.append(snek)
+        self.sneks = keep_sneks
+        self.__count(self.solid_board, olds, -1)
+        return future_heads[~dead]
+
+    def eat_food(self, foods, future_heads):
+        """makes the sneks eat the food under their future heads, adding the news and olds of every food to foods"""
+        cells = future_heads[:, 1] * self.width + future_heads[:, 0]
+        eaten = set()
+        for i in numpy.flatnonzero(self.food_board[cells]).tolist():
+            self.sneks[i].will_grow = True
+            eaten.add(tuple(future_heads[i].tolist()))
+
+        keep_foods = []
+        olds = []
+        for food in self.foods:
+            foods[food] = [[], []]
+            if eaten and any(block in eaten for block in food.whole):
+                food.kill()
+                foods[food][1] += food.whole
+                olds += food.whole
+            else:
+                keep_foods.append(food)
+        self.foods = keep_foods
+        self.__count(self.food_board, olds, -1)
+
+    def move_sneks(self, sneks, future_heads):
+        """moves the sneks to future_heads, adding their news and olds to sneks"""
+        olds = []
+        for snek, head in zip(self.sneks, map(tuple, future_heads.tolist())):
+            whole = snek.whole
+            whole.push(head)
+            news_olds = sneks[snek]
+            news_olds[0].append(head)
+            if snek.will_grow:
+                snek.will_grow = False
+            else:
+                tail = whole.pop()
+                news_olds[1].append(tail)
+                olds.append(tail)
+        self.__count(self.solid_board, future_heads, 1)
+        self.__count(self.solid_board, olds, -1)
+
+    def create_snek(self, *args, **kwargs):
+        width, height = self.width, self.height
+        free = self.__free_cells().reshape(height, width)
+        # top cells of the 3 blocks high free columns, from the fourth row to the fourth to last
+        tops = numpy.flatnonzero(free[3:height - 3] & free[4:height - 2] & free[5:height - 1]) if height > 6 else []
+        if len(tops):
+            y, x = divmod(int(tops[random.randrange(len(tops))]), width)
+            res = super(SnekEngine, self).create_snek(pos=(x, y + 3), *args, **kwargs)
+            self.__count(self.solid_board, list(res.whole), 1)
+            return res
+        return None
+
+    def create_food(self):
+        cells = numpy.flatnonzero(self.__free_cells()[:self.width * max(self.height - 3, 0)])
+        if len(cells):
+            y, x = divmod(int(cells[random.randrange(len(cells))]), self.width)
+            res = Food(pos=(x, y))
+            self.foods.append(res)
+            self.__count(self.food_board, res.whole, 1)
+            return res
+        return None
+
+    def __free_cells(self):
+        """whether each cell of the board is free, as an array indexed by y * width + x"""
+        return (self.solid_board == 0) & (self.food_board == 0)
+
+    def __build_boards(self):
+        """counts the blocks of every object in solid_board and food_board"""
+        self.__walls = self.static_kind(Wall)
+        self.solid_board = numpy.zeros(self.width * self.height, numpy.int32)
+        self.food_board = numpy.zeros(self.width * self.height, numpy.int32)
+        self.__count(self.solid_board, [block for snek in self.sneks for block in snek.whole], 1)
+        for kind, elements in self.other_sneks.items():
+            board = self.food_board if kind is Food else self.solid_board
+            self.__count(board, [block for element in elements for block in element.whole], 1)
+
+    def __count(self, board, blocks, value):
+        """adds value to the count of each block (inside the board) of blocks, a sequence or (n, 2) array"""
+        blocks = numpy.asarray(blocks, numpy.int64).reshape(-1, 2)
+        x, y = blocks[:, 0], blocks[:, 1]
+        inside = (0 <= x) & (x < self.width) & (0 <= y) & (y < self.height)
+        numpy.add.at(board, y[inside] * self.width + x[inside], value)
+
+
+class ArrayPacManSnekEngine(ArraySnekEngine, PacManSnekEngine):
+    """PacManSnekEngine computing each tick like ArraySnekEngine"""
+
+    wraps = True
+
+
 def main():
     wall_list = [Wall(pos=(10, y)) for y in range(21)] + [Wall(pos=(x, 10)) for x in range(21) if x != 10]
     engine = PacManSnekEngine(width=21, height=21, max_food=2, game_tick=0.1, walls=wall_list)
     server = servers.AsyncTCPServer(address=('', 12345), engine=engine)
     server.DIRECTION = {b'\x01': 'u', b'\x02': 'l', b'\x03': 'd', b'\x04': 'r', b'\x05': 'lol'}
+    server.EVENT_LOOP = 'uvloop'  # if it is installed
     server.run()
 
 
@@ -0,0 +1,124 @@
+import asyncio
+import multiprocessing
+import os
+from functools import partial
+
+from sneklib.basetypes import Server, use_event_loop
+from sneklib.rooms import RelayServer, read_pipe
+
+
+class Acceptor(RelayServer):
+    """
+    Acceptor of an AcceptorsServer, run inside a worker process by serve_acceptor.
+    It accepts connections like AsyncTCPServer on the address of the game, which every acceptor listens on
+    (with SO_REUSEPORT, so that the kernel spreads the new connections across them), and relays each command to the
+    game process through connection, relaying back the answers and the updates pushed to subscribers.
+    It should be subclassed to redefine the constants of TCPConnections (e.g. MAX_OPEN_CONNECTIONS) for the acceptors.
+    Acceptors run on uvloop if it is installed (see EVENT_LOOP).
+    """
+
+    EVENT_LOOP = 'uvloop'
+
+    def __init__(self, address, connection, max_connections=5):
+        super().__init__(address, max_connections)
+        self.pipes.append(connection)
+
+    async def loop(self):
+        """serves the players until cancelled, or until the game process stops"""
+        try:
+            await self.relay_loop()
+        except (EOFError, BrokenPipeError):  # the game process stopped, so its end of the pipe got closed
+            pass
+
+    async def server_loop(self):
+        server = await asyncio.start_server(self.dispatch, self.address[0], self.address[1],
+                                            backlog=self.max_connections, reuse_port=True)
+        async with server:
+            await server.serve_forever()
+
+
+def serve_acceptor(address, connection, acceptor_class, max_connections):
+    """
+    Entry point of an acceptor process: accepts connections on address with an acceptor_class,
+    relaying their commands to the game process through connection, until the game process stops.
+    """
+    use_event_loop(acceptor_class.EVENT_LOOP)
+    asyncio.run(acceptor_class(address, connection, max_connections).loop())
+
+
+class AcceptorsServer(Server):
+    """
+    Server running the game in this process, while ACCEPTORS worker processes (one per core if None) accept the
+    connections of the players, all listening on address with SO_REUSEPORT (so it needs a platform supporting it, like
+    Linux). Accepting connections, reading requests and writing answers and updates is spread across the acceptors,
+    while the ticks, the players and their state stay in this process: each acceptor relays the commands it reads
+    through a pipe, they are answered here with deal_with_request, and the updates of each tick are sent once to each
+    acceptor, which writes them to its own subscribers.
+    address is a tuple with the IP address and the port like for AsyncTCPServer, and acceptor_class the Acceptor
+    subclass of the acceptors, which is sent to the worker processes, so it must be picklable (and, as the workers are
+    spawned, the main module must only start the server under if __name__ == '__main__').
+    Like its acceptors, it runs on uvloop if it is installed (see EVENT_LOOP).
+    It exposes:
+    ACCEPTORS constant,
+    self.acceptor_class attribute.
+    """
+
+    ACCEPTORS = None
+    EVENT_LOOP = 'uvloop'
+
+    def __init__(self, address, engine, max_connections=5, viewport=None, acceptor_class=Acceptor):
+        super().__init__(address, engine, max_connections, viewport)
+        self.acceptor_class = acceptor_class
+        self.__pipes = []
+
+    async def server_loop(self):
+        # spawned rather than forked, so that each acceptor only holds its own end of its pipe and stops with the game
+        context = multiprocessing.get_context('spawn')
+        processes = []
+        for _ in range(self.ACCEPTORS or os.cpu_count() or 1):
+            pipe, acceptor_pipe = context.Pipe()
+            process = context.Process(target=serve_acceptor, daemon=True,
+                                      args=(self.address, acceptor_pipe, self.acceptor_class, self.max_connections))
+            process.start()
+            acceptor_pipe.close()
+            processes.append(process)
+            self.__pipes.append(pipe)
+
+        try:
+            await asyncio.gather(*(self.__serve(index, pipe) for index, pipe in enumerate(self.__pipes)))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join(1)
+
+    def broadcast(self, message, version=1):
+        handles = {}
+        for (index, handle), player in self.subscribers.items():
+            if (player.version if player else 1) == version:
+                handles.setdefault(index, []).append(handle)
+        for index, acceptor_handles in handles.items():
+            self.__pipes[index].send(('broadcast', acceptor_handles, message))
+
+    async def __serve(self, index, pipe):
+        """answers the requests relayed by an acceptor, until it stops"""
+        try:
+            await read_pipe(pipe, partial(self.__answer, index, pipe))
+        except EOFError:  # the acceptor process died
+            pass
+        for subscriber in [subscriber for subscriber in self.subscribers if subscriber[0] == index]:
+            self.unsubscribe(subscriber)
+
+    def __answer(self, index, pipe, request):
+        """answers a request relayed by the acceptor with the given index"""
+        kind, _, *args = request
+        if kind == 'request':
+            request_id, c, _args, handle = args
+            try:
+                answer = self.deal_with_request(c, _args)
+            except LookupError:  # unknown command or unknown player
+                answer = None
+            if c == 5 and answer:
+                self.subscribe((index, handle), _args)
+            pipe.send(('answer', request_id, answer))
+        elif kind == 'unsubscribe':
+            self.unsubscribe((index, args[0]))
@@ -1,4 +1,5 @@
 import asyncio
+from abc import ABC, abstractmethod
 
 from sneklib import snekpi
 
@@ -25,60 +26,344 @@ async def send_command(host, port, c, *args):
         await writer.wait_closed()
 
 
+class _Commands(ABC):
+    """
+    Commands of the snek communication protocol, sent trough self.send_command(c, *args),
+    which the subclasses implement.
+    State messages are decoded with self.version, which is set by self.set_version(hash_id, version).
+    """
+
+    version = 1
+
+    @abstractmethod
+    async def send_command(self, c, *args):
+        """sends command c with arguments args and returns the answer"""
+
+    async def register(self, name=''):
+        """0 -> Registers a snek to the server"""
+        hash_id = await self.send_command(b'\x00', name.encode('utf-8'))
+        if not hash_id:
+            raise ConnectionError('No hash_id received')
+        return hash_id
+
+    async def set_dir(self, hash_id, direction):
+        """1 -> Sets the direction of the snek"""
+        ack = await self.send_command(b'\x01', hash_id, direction)
+        if ack != b'\x00':
+            raise ConnectionError('Error setting direction')
+
+    async def get_infos(self):
+        """2 -> Request game general infos (e.g. game type, size, ...)"""
+        _res = await self.send_command(b'\x02')
+
+        data, _ = snekpi.decode_json(_res)
+
+        return data
+
+    async def get_current_state(self, hash_id=b''):
+        """3 -> Gets current state of the game from the server"""
+        _res = await self.send_command(b'\x03', hash_id)
+
+        return self.decode_message(_res)
+
+    async def get_updated_state(self, hash_id):
+        """4 -> gets updated state of the game since last request"""
+        _res = await self.send_command(b'\x04', hash_id)
+
+        return self.decode_message(_res)
+
+    async def set_version(self, hash_id, version):
+        """
+        6 -> Sets the version of the encoding of the player's state messages.
+        With version 2 the data of an object is None unless it is new or it has changed.
+        """
+        ack = await self.send_command(b'\x06', hash_id, bytes((version,)))
+        if ack != b'\x00':
+            raise ConnectionError('Error setting version')
+        self.version = version
+
+    def decode_message(self, message):
+        """decodes a state message with self.version"""
+        if self.version == 2:
+            return snekpi.decode_message_v2(message)
+        return snekpi.decode_message(message)
+
+    async def get_metrics(self):
+        """7 -> Request the metrics of the server, as text in the Prometheus format"""
+        _res = await self.send_command(b'\x07')
+
+        return _res.decode('ascii')
+
+    async def get_current_blocks(self, hash_id=b''):
+        """254 -> requests current blocks in the game"""
+        _res = await self.send_command(b'\xfe', hash_id)
+
+        alive = bool(_res[0])
+        news, olds, _ = snekpi.decode_blocks(_res[1:])
+
+        return alive, news, olds
+
+    async def get_updated_blocks(self, hash_id):
+        """255 -> requests updated blocks state in the server
+        (new blocks and blocks to be deleted)"""
+        _res = await self.send_command(b'\xff', hash_id)
+
+        alive = bool(_res[0])
+        news, olds, _ = snekpi.decode_blocks(_res[1:])
+
+        return alive, news, olds
+
+
+class _OneShot(_Commands):
+    """Sends each command over a new connection"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    async def send_command(self, c, *args):
+        return await send_command(self.host, self.port, c, *args)
+
+
+class Connection(_Commands):
+    """
+    Persistent connection to the server. Commands are sent as length-prefixed frames over the same TCP connection,
+    saving a handshake and a teardown for each command.
+    It should be used as an asynchronous context manager:
+    async with Connection(host, port) as connection:
+        hash_id = await connection.register()
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+
+    async def open(self):
+        """opens the connection and switches it to framed mode"""
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(snekpi.FRAMED)
+        await self.writer.drain()
+
+    async def close(self):
+        """closes the connection"""
+        self.writer.close()
+        await self.writer.wait_closed()
+
+    async def send_command(self, c, *args):
+        """Sends a generic command and waits for its answer"""
+        async with self.lock:
+            self.writer.write(snekpi.encode_frame(c + b''.join(args)))
+            await self.writer.drain()
+
+            return await self.read_frame()
+
+    async def read_frame(self):
+        """reads a frame sent by the server"""
+        header = await self.reader.readexactly(4)
+        return await self.reader.readexactly(snekpi.decode_frame_header(header))
+
+    async def subscribe(self, hash_id=b''):
+        """
+        5 -> subscribes to the updates pushed by the server after each tick.
+        It returns the current tick and state of the game; updates should then be read with self.updates().
+        After subscribing, no other command can be sent over this connection.
+        """
+        _res = await self.send_command(b'\x05', hash_id)
+        if not _res:
+            raise ConnectionError('Error subscribing')
+
+        if self.version == 2:
+            return snekpi.decode_subscription_v2(_res)
+        return snekpi.decode_subscription(_res)
+
+    async def updates(self):
+        """yields the tick, sneks and other kinds of objects pushed after each tick by the server"""
+        decode_delta = snekpi.decode_delta_v2 if self.version == 2 else snekpi.decode_delta
+        while 1:
+            yield decode_delta(await self.read_frame())
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
+class DatagramConnection(_Commands, asyncio.DatagramProtocol):
+    """
+    Connection to an AsyncUDPServer. Each command is sent as a datagram with a new sequence number,
+    and sent again every TIMEOUT seconds (up to RETRIES times) until its answer arrives.
+    Unlike Connection, commands can still be sent after subscribing, so that inputs don't wait behind lost updates;
+    a lost update is detected from the tick numbers and recovered by subscribing again.
+    It should be used as an asynchronous context manager:
+    async with DatagramConnection(host, port) as connection:
+        hash_id = await connection.register()
+    """
+
+    TIMEOUT = 0.2
+    RETRIES = 10
+    KEEP_ALIVE = 2
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.transport = None
+        self.sequence = 0
+        self.answers = {}
+        self.updates_queue = asyncio.Queue()
+        self.lock = asyncio.Lock()
+        self.keep_alive_task = None
+        self.hash_id = b''
+        self.tick = None
+        self.known = []
+
+    async def open(self):
+        """opens the datagram endpoint and starts keeping the connection alive"""
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: self, remote_addr=(self.host, self.port))
+        self.keep_alive_task = asyncio.create_task(self.keep_alive())
+
+    async def close(self):
+        """closes the datagram endpoint"""
+        self.keep_alive_task.cancel()
+        self.transport.close()
+
+    async def keep_alive(self):
+        """sends an empty message every KEEP_ALIVE seconds, so that the server doesn't forget the connection"""
+        while 1:
+            self.transport.sendto(snekpi.encode_datagram(0, b''))
+            await asyncio.sleep(self.KEEP_ALIVE)
+
+    def datagram_received(self, data, addr):
+        sequence, message = snekpi.decode_datagram(data)
+        if sequence == 0:
+            self.updates_queue.put_nowait(message)
+            return
+        answer = self.answers.get(sequence)
+        if answer is not None and not answer.done():
+            answer.set_result(message)
+
+    async def send_command(self, c, *args):
+        """Sends a generic command and waits for its answer"""
+        async with self.lock:
+            self.sequence += 1
+            sequence = self.sequence
+            answer = self.answers[sequence] = asyncio.get_running_loop().create_future()
+            datagram = snekpi.encode_datagram(sequence, c + b''.join(args))
+            try:
+                for _ in range(self.RETRIES):
+                    self.transport.sendto(datagram)
+                    try:
+                        return await asyncio.wait_for(asyncio.shield(answer), self.TIMEOUT)
+                    except asyncio.TimeoutError:
+                        pass
+                raise ConnectionError('No answer received')
+            finally:
+                del self.answers[sequence]
+
+    async def subscribe(self, hash_id=b''):
+        """
+        5 -> subscribes to the updates pushed by the server after each tick.
+        It returns the current tick and state of the game; updates should then be read with self.updates().
+        """
+        _res = await self.send_command(b'\x05', hash_id)
+        if not _res:
+            raise ConnectionError('Error subscribing')
+
+        if self.version == 2:
+            tick, player, sneks, kinds = snekpi.decode_subscription_v2(_res)
+        else:
+            tick, player, sneks, kinds = snekpi.decode_subscription(_res)
+        self.hash_id = hash_id
+        self.tick = tick
+        self.known = [len(objs) for objs in [sneks] + kinds]
+
+        return tick, player, sneks, kinds
+
+    async def resync(self):
+        """
+        subscribes again after losing an update. The new state is returned like an updated state that had to be resent
+        (see note 7 of the protocol): every object known so far is marked dead, followed by every current object
+        """
+        known = self.known
+        tick, _, sneks, kinds = await self.subscribe(self.hash_id)
+        dead = [[(False, None, [], [])] * count for count in known]
+        return tick, dead[0] + sneks, [deads + objs for deads, objs in zip(dead[1:], kinds)]
+
+    async def updates(self):
+        """
+        yields the tick, sneks and other kinds of objects pushed after each tick by the server;
+        late updates are dropped and lost ones are recovered with self.resync()
+        """
+        decode_delta = snekpi.decode_delta_v2 if self.version == 2 else snekpi.decode_delta
+        while 1:
+            tick, sneks, kinds = decode_delta(await self.updates_queue.get())
+            if tick <= self.tick:
+                continue
+            if tick > self.tick + 1:
+                yield await self.resync()
+                continue
+            self.tick = tick
+            self.known = [sum(1 for obj in objs if obj[0]) for objs in [sneks] + kinds]
+            yield tick, sneks, kinds
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
 async def register(host, port, name=''):
     """0 -> Registers a snek to the server"""
-    hash_id = await send_command(host, port, b'\x00', name.encode('utf-8'))
-    if not hash_id:
-        raise ConnectionError('No hash_id received')
-    return hash_id
+    return await _OneShot(host, port).register(name)
 
 
 async def set_dir(host, port, hash_id, direction):
     """1 -> Sets the direction of the snek"""
-    ack = await send_command(host, port, b'\x01', hash_id, direction)
-    if ack != b'\x00':
-        raise ConnectionError('Error setting direction')
+    return await _OneShot(host, port).set_dir(hash_id, direction)
 
 
 async def get_infos(host, port):
     """2 -> Request game general infos (e.g. game type, size, ...)"""
-    _res = await send_command(host, port, b'\x02')
+    return await _OneShot(host, port).get_infos()
 
-    data, _ = snekpi.decode_json(_res)
 
-    return data
+async def get_current_state(host, port, hash_id=b'', version=1):
+    """3 -> Gets current state of the game from the server (version is the one set with set_version)"""
+    commands = _OneShot(host, port)
+    commands.version = version
+    return await commands.get_current_state(hash_id)
 
 
-async def get_current_state(host, port, hash_id=b''):
-    """3 -> Gets current state of the game from the server"""
-    _res = await send_command(host, port, b'\x03', hash_id)
+async def get_updated_state(host, port, hash_id, version=1):
+    """4 -> gets updated state of the game since last request (version is the one set with set_version)"""
+    commands = _OneShot(host, port)
+    commands.version = version
+    return await commands.get_updated_state(hash_id)
 
-    return snekpi.decode_message(_res)
 
+async def set_version(host, port, hash_id, version):
+    """6 -> Sets the version of the encoding of the player's state messages"""
+    return await _OneShot(host, port).set_version(hash_id, version)
 
-async def get_updated_state(host, port, hash_id):
-    """4 -> gets updated state of the game since last request"""
-    _res = await send_command(host, port, b'\x04', hash_id)
 
-    return snekpi.decode_message(_res)
+async def get_metrics(host, port):
+    """7 -> Request the metrics of the server, as text in the Prometheus format"""
+    return await _OneShot(host, port).get_metrics()
 
 
 async def get_current_blocks(host, port, hash_id=b''):
     """254 -> requests current blocks in the game"""
-    _res = await send_command(host, port, b'\xfe', hash_id)
-
-    alive = bool(_res[0])
-    news, olds, _ = snekpi.decode_blocks(_res[1:])
-
-    return alive, news, olds
+    return await _OneShot(host, port).get_current_blocks(hash_id)
 
 
 async def get_updated_blocks(host, port, hash_id):
     """255 -> requests updated blocks state in the server
     (new blocks and blocks to be deleted)"""
-    _res = await send_command(host, port, b'\xff', hash_id)
-
-    alive = bool(_res[0])
-    news, olds, _ = snekpi.decode_blocks(_res[1:])
-
-    return alive, news, olds
+    return await _OneShot(host, port).get_updated_blocks(hash_id)
@@ -1,36 +1,134 @@
 import asyncio
+import importlib
+import math
 import random
 import time
-from dataclasses import make_dataclass
+from collections import Counter, deque
+from dataclasses import field, make_dataclass
+from itertools import chain
 from typing import Tuple
 
 from sneklib import snekpi
+from sneklib.metrics import Metrics
+from sneklib.replay import Recorder
+from sneklib.spatial import Buckets, Occupancy
+from sneklib.timers import TimerWheel
 
 Block = Tuple[int, int]
 
 
+class Body:
+    """
+    Ordered sequence of blocks, meant to be used as whole of long and moving sneks.
+    Blocks are kept in a deque together with the number of times each block appears,
+    so that pushing a new head, popping the tail and membership tests cost O(1).
+    It exposes:
+    self.push(block), self.pop() and self.count(block) methods,
+    and behaves like a read only list of blocks (len, iteration, indexing, +, ==, in).
+    """
+
+    __slots__ = ('blocks', 'counts')
+
+    def __init__(self, blocks=()):
+        self.blocks = deque(blocks)
+        self.counts = {}
+        for block in self.blocks:
+            self.counts[block] = self.counts.get(block, 0) + 1
+
+    def push(self, block):
+        """adds block as the new head"""
+        self.blocks.appendleft(block)
+        self.counts[block] = self.counts.get(block, 0) + 1
+
+    def pop(self):
+        """removes and returns the tail"""
+        block = self.blocks.pop()
+        count = self.counts[block] - 1
+        if count:
+            self.counts[block] = count
+        else:
+            del self.counts[block]
+        return block
+
+    def count(self, block):
+        """number of times block appears"""
+        return self.counts.get(block, 0)
+
+    def __contains__(self, block):
+        return block in self.counts
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __iter__(self):
+        return iter(self.blocks)
+
+    def __reversed__(self):
+        return reversed(self.blocks)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self.blocks)[index]
+        return self.blocks[index]
+
+    def __add__(self, other):
+        return list(self.blocks) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self.blocks)
+
+    def __eq__(self, other):
+        try:
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self.blocks))
+
+
 class Snek:
     """
     Base snek class that other snek classes should inherit from.
     It represents a generic snek, the objects that interact in a snek game trough a snek engine.
     It exposes:
-    self.alive, self.whole and self.data attributes,
-    self.move() and self.kill() methods,
+    _body_type attribute in the class itself (the type whole gets converted to when it is set),
+    INPUTS constant (the number of inputs that can be buffered),
+    self.alive, self.whole, self.data and self.inputs attributes,
+    self.move(), self.kill(), self.queue_input(direction), self.valid_input(previous, direction)
+    and self.apply_input() methods,
     self.head, self.body, self.tail, self.future_head, self.future_whole properties,
     and a self.__repr__() method.
     """
 
+    _body_type = list
+
+    INPUTS = 3
+
     def __init__(self, whole=None, data=()):
         self.alive = True
         if whole is None:
             whole = []
         self.whole = whole
         self.data = data
+        self.inputs = deque()
+
+    @property
+    def whole(self):
+        """all the blocks of the snek, head first"""
+        return self._whole
+
+    @whole.setter
+    def whole(self, value):
+        if not isinstance(value, self._body_type):
+            value = self._body_type(value)
+        self._whole = value
 
     @property
     def head(self):
         """head of the snek, the first element of whole"""
-        return self.whole[:1]
+        whole = self.whole
+        return [whole[0]] if whole else []
 
     @property
     def body(self):
@@ -40,7 +138,8 @@ class Snek:
     @property
     def tail(self):
         """tail of the snek, the last element of whole"""
-        return self.whole[-1:]
+        whole = self.whole
+        return [whole[-1]] if whole else []
 
     @property
     def future_head(self):
@@ -66,40 +165,97 @@ class Snek:
         """method for killing the snek"""
         self.alive = False
 
+    def queue_input(self, direction):
+        """
+        buffers direction (if valid after the last buffered one, and if less than INPUTS are buffered),
+        to be applied by the engine at the beginning of a following tick
+        """
+        previous = self.inputs[-1] if self.inputs else getattr(self, 'dir', None)
+        if len(self.inputs) < self.INPUTS and self.valid_input(previous, direction):
+            self.inputs.append(direction)
+
+    def valid_input(self, previous, direction):
+        """whether direction can follow previous (that is None if the snek has no direction yet)"""
+        return direction != previous
+
+    def apply_input(self):
+        """sets dir to the first buffered direction, if any; called by the engine once per tick"""
+        if self.inputs:
+            self.dir = self.inputs.popleft()
+
     def __repr__(self):
         return f"$data:{self.data}, whole:{self.whole}$"
 
 
+StaticKind = make_dataclass('StaticKind', [('objects', tuple), ('blocks', list),
+                                           ('encodings', dict, field(default_factory=dict))])
+
+TickStats = make_dataclass('TickStats', [('tick', int), ('lateness', float), ('move', float), ('fan_out', float),
+                                         ('skipped', int)])
+
+
 class SnekEngine:
     """
     Base snek engine class that other snek engine classes should inherit from.
     A snek engine is where the actual game runs and where different sneks interact.
     It exposes:
-    _snek_factory attribute in the class itself (although it can be modified within instances),
-    self.sneks, self.other_sneks and self.game_tick attributes,
-    self.create_snek(*args, **kwargs) and self.move() methods,
+    _snek_factory, static_kinds and indexed attributes in the class itself (although they can be modified within
+    instances),
+    OVERRUN, MAX_CATCH_UP and STATS constants (that can be redefined for each engine instance),
+    self.sneks, self.other_sneks, self.occupancy, self.game_tick, self.stats, self.overruns and self.profiler
+    attributes,
+    self.create_snek(*args, **kwargs), self.move(), self.tick(), self.index(), self.index_changed_lists(),
+    self.static_kind(kind) and self.static_changed(kind) methods,
+    self.cell_occupied(block) and self.cell_freed(block) hooks,
     and self.loop() asynchronous generator.
     """
 
     _snek_factory = Snek
+    static_kinds = ()  # kinds of objects that never move or change, e.g. walls
+    indexed = True  # whether self.occupancy is kept up to date (engines with their own index of the board can opt out)
+
+    OVERRUN = 'catch_up'  # or 'skip'
+    MAX_CATCH_UP = 5
+    STATS = 256
 
     def __init__(self, sneks=(), other_objs=None, game_tick=1, infos=()):
-        self.sneks = sneks
+        self.sneks = list(sneks)
         if other_objs is None:
             other_objs = {}
-        self.other_sneks = other_objs
+        self.other_sneks = {kind: list(elements) for kind, elements in other_objs.items()}
         self.game_tick = game_tick
         self.infos = infos
+        self.stats = deque(maxlen=self.STATS)
+        self.overruns = 0
+        self.profiler = None  # if set, self.move() is called through self.profiler(self.move)
+        self.__static = {}
+        self.__blocks = None  # (key, all_blocks), see self.all_blocks
+        self.__ticks = 0
+
+        self.occupancy = Occupancy(self.cell_occupied, self.cell_freed)
+        self.__indexed = {}  # kind (None for the sneks): (list indexed by self.occupancy, its length)
+        self.index()
 
     @property
     def all_blocks(self):
-        """a list of all of the blocks for each snek object in the engine"""
+        """
+        a list of all of the blocks for each snek object in the engine, shared between the accesses until the objects
+        of the engine change (with each tick, or with the number of objects), so it should not be modified.
+        Use self.occupancy to find whether a block is occupied (and by what) in O(1)
+        """
+        key = self.__ticks, len(self.sneks), tuple(len(elements) for elements in self.other_sneks.values())
+        if self.__blocks is not None and self.__blocks[0] == key:
+            return self.__blocks[1]
         res = []
         for snek in self.sneks:
             res += snek.whole
-        for kind in self.other_sneks.values():
-            for snek_object in kind:
+        for kind, elements in self.other_sneks.items():
+            if kind in self.static_kinds:
+                res += self.static_kind(kind).blocks
+                continue
+            for snek_object in elements:
                 res += snek_object.whole
+        self.__blocks = key, res
         return res
 
     @property
@@ -107,13 +263,60 @@ class SnekEngine:
         """all of the objects in the engine"""
         return self.sneks, self.other_sneks
 
+    def static_kind(self, kind):
+        """
+        the objects of a kind in self.static_kinds as a StaticKind, with their blocks and a cache for their encodings.
+        It is computed again only if the list of the kind gets replaced or changes length,
+        or after static_changed(kind), and then the objects of the kind are indexed again in self.occupancy
+        """
+        elements = self.other_sneks[kind]
+        cached = self.__static.get(kind)
+        if cached is None or cached[0] is not elements or len(cached[1].objects) != len(elements):
+            if self.indexed:
+                self.__index_list(kind, elements)
+            static = StaticKind(tuple(elements), [block for element in elements for block in element.whole])
+            self.__static[kind] = elements, static
+            return static
+        return cached[1]
+
+    def static_changed(self, kind):
+        """
+        should be called after changing the objects of a static kind without replacing or resizing its list,
+        it also indexes all of the objects in self.occupancy again, as the blocks they had are not known anymore
+        """
+        self.__static.pop(kind, None)
+        self.__blocks = None
+        self.index()
+
+    def index(self):
+        """indexes the blocks of all of the objects of the engine in self.occupancy from scratch (if self.indexed)"""
+        if not self.indexed:
+            return
+        self.occupancy.clear()
+        self.__indexed = {}
+        self.__index_list(None, self.sneks)
+        for kind, elements in self.other_sneks.items():
+            self.__index_list(kind, elements)
+
+    def cell_occupied(self, block):
+        """called by self.occupancy when block becomes occupied"""
+        pass
+
+    def cell_freed(self, block):
+        """called by self.occupancy when block becomes free"""
+        pass
+
     def create_snek(self, *args, **kwargs):
         """
         function for creating a new snek and adding it to self.sneks of the engine.
         It passes *args and **kwargs to the snek factory of the engine
         """
+        self.index_changed_lists()
         res = self._snek_factory(*args, **kwargs)
         self.sneks.append(res)
+        if self.indexed:
+            self.occupancy.add(res, res.whole)
+            self.__indexed[None] = self.sneks, len(self.sneks)
         return res
 
     def move(self):
@@ -124,14 +327,102 @@ class SnekEngine:
         new_of_kinds = {kind: {} for kind in self.other_sneks}
         return sneks, new_sneks, kinds, new_of_kinds
 
+    def tick(self):
+        """
+        makes the game advance by one tick, applying one buffered input of each snek first,
+        and keeping self.occupancy in sync with the blocks moved by self.move() (if self.indexed).
+        The lists of objects replaced or resized since the previous tick (e.g. walls set or foods appended from outside
+        of the engine) are indexed again first
+        """
+        for snek in self.sneks:
+            snek.apply_input()
+        self.index_changed_lists()
+        res = self.move() if self.profiler is None else self.profiler(self.move)
+        self.__ticks += 1
+        if self.indexed:
+            self.occupancy.apply(*res)
+            self.__indexed = {kind: (elements, len(elements)) for kind, elements in self.other_sneks.items()}
+            self.__indexed[None] = self.sneks, len(self.sneks)
+        return res
+
+    def index_changed_lists(self):
+        """
+        indexes again in self.occupancy the lists of objects replaced or resized since they were last indexed,
+        should be called before looking up self.occupancy between ticks
+        """
+        if not self.indexed:
+            return
+        self.__index_list(None, self.sneks)
+        for kind, elements in self.other_sneks.items():
+            self.__index_list(kind, elements)
+
+    def __index_list(self, kind, elements):
+        """indexes the objects of elements (the list of kind) in self.occupancy instead of the ones of its old list"""
+        indexed, length = self.__indexed.get(kind, ((), 0))
+        if indexed is elements and length == len(elements):
+            return
+        for element in indexed:
+            self.occupancy.remove(element, element.whole)
+        for element in elements:
+            self.occupancy.add(element, element.whole)
+        self.__indexed[kind] = elements, len(elements)
+
     async def loop(self):
-        """runs the game indefinitely"""
+        """
+        runs the game indefinitely, starting each tick game_tick seconds after the previous one was due
+        (not after the previous one ended), and records the timings of each tick in self.stats.
+        When a tick ends after the next one was due, the late ticks are run right away if OVERRUN is 'catch_up'
+        (unless they are more than MAX_CATCH_UP), otherwise they are skipped to get back on schedule
+        """
+        tick = 0
+        deadline = time.monotonic()
         while 1:
-            yield self.move()
-            await asyncio.sleep(self.game_tick)
+            start = time.monotonic()
+            res = self.tick()
+            moved = time.monotonic()
+            yield res
+            done = time.monotonic()
+
+            lateness = start - deadline
+            deadline += self.game_tick
+            skipped = 0
+            if done > deadline and self.game_tick > 0:
+                self.overruns += 1
+                late_ticks = math.ceil((done - deadline) / self.game_tick)
+                if self.OVERRUN != 'catch_up' or late_ticks > self.MAX_CATCH_UP:
+                    skipped = late_ticks
+                    deadline += skipped * self.game_tick
+            self.stats.append(TickStats(tick, lateness, moved - start, done - moved, skipped))
+            tick += 1
+
+            await asyncio.sleep(max(deadline - time.monotonic(), 0))
+
+
+def use_event_loop(module_name):
+    """
+    makes asyncio use the event loop of module module_name (e.g. 'uvloop'), through its EventLoopPolicy,
+    if it is installed; keeps asyncio's own event loop otherwise (or if module_name is None)
+    """
+    if module_name is None:
+        return
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError:  # the faster event loop is optional
+        return
+    asyncio.set_event_loop_policy(module.EventLoopPolicy())
+
 
+Player = make_dataclass('Player', [('snek', Snek), ('tick', int), ('known', tuple), ('last', float),
+                                   ('version', int, field(default=1)), ('snek_sent', bool, field(default=False)),
+                                   ('resync', bool, field(default=False))],
+                        slots=True)
 
-Player = make_dataclass('Player', [('snek', Snek), ('sneks', dict), ('kinds', dict), ('last', float)])
+TickDelta = make_dataclass('TickDelta', [('tick', int), ('sneks', dict), ('kinds', list), ('objects', tuple),
+                                         ('changed', set), ('messages', dict, field(default_factory=dict)),
+                                         ('blocks', tuple, field(default=None)),
+                                         ('joined', dict, field(default_factory=dict))])
+
+Snapshot = make_dataclass('Snapshot', [('sneks', bytes), ('kinds', bytes), ('offsets', dict)])
 
 
 class Server:
@@ -139,33 +430,87 @@ class Server:
     Base server class. Should be derived only for implementing new communication
     protocols not already implemented in sneklib/servers.
     It exposes:
-    DIRECTION, KILL_TIME, KICK_TIME constants (that can be redefined for each server instance),
-    Player dataclass (with attributes snek, sneks kinds and last attributes)
-    self.address, self.engine, self.max_connections, self.players attributes,
-    self.run() and self.deal_with_request(c, _args) methods,
+    DIRECTION, KILL_TIME, KICK_TIME, EXPIRY_RESOLUTION, HISTORY, VERSIONS, USER_INTERFACE, METRICS_ADDRESS,
+    RECORDING and EVENT_LOOP constants
+    (that can be redefined for each server instance),
+    Player dataclass (with attributes snek, tick, known, last, version, snek_sent and resync attributes)
+    self.address, self.engine, self.max_connections, self.viewport, self.players, self.tick, self.history,
+    self.subscribers, self.connections, self.metrics and self.recorder attributes,
+    self.run(), self.update(sneks, new_sneks, kinds, new_of_kinds), self.deal_with_request(c, _args),
+    self.subscribe(handle, _args), self.unsubscribe(handle), self.player_removed(hash_id), self.broadcast(message)
+    and self.updates_since(tick, version) methods,
     and self.loop(), self.user_interface_loop(), self.game_loop() and self.server_loop() asynchronous methods.
     """
 
     DIRECTION = {b'\x01': 'u', b'\x02': 'l', b'\x03': 'd', b'\x04': 'r'}
     KILL_TIME = 10
     KICK_TIME = KILL_TIME + 10
-
-    def __init__(self, address, engine, max_connections=5):
+    EXPIRY_RESOLUTION = 0.25  # seconds by which killing and kicking inactive players may be late
+    HISTORY = 256
+    VERSIONS = {1, 2}
+    BUCKET = 16
+    USER_INTERFACE = True
+    METRICS_ADDRESS = None  # (host, port) to serve the metrics over HTTP from
+    RECORDING = None  # path of the file to record the game to
+    EVENT_LOOP = None  # module whose EventLoopPolicy run() uses if it is installed, e.g. 'uvloop' (None for asyncio's)
+
+    def __init__(self, address, engine, max_connections=5, viewport=None):
         self.address = address
         self.engine: SnekEngine = engine
         self.max_connections = max_connections
+        self.viewport = viewport
         self.players = {}
+        self.tick = 0
+        self.history = deque(maxlen=self.HISTORY)
+        self.subscribers = {}
+        self.connections = 0  # kept up to date by the server implementations
+        self.metrics = Metrics()
+        self.metrics.gauge('players', lambda: len(self.players))
+        self.metrics.gauge('subscribers', lambda: len(self.subscribers))
+        self.metrics.gauge('connections', lambda: self.connections)
+        self.metrics.gauge('tick', lambda: self.tick)
+        self.metrics.gauge('tick_overruns', lambda: self.engine.overruns)
+        self.engine.profiler = self.metrics.profiled
+        self.recorder = None
+        self.__joined = set()
+        self.__expiries = TimerWheel(self.EXPIRY_RESOLUTION)
+        self.__metadata = {}
+        self.__data_since = None  # tick after which self.history tracks the data changes, once version 2 is used
+        self.__buckets = None
+        self.__positions = {}
+        if viewport is not None:
+            self.__buckets = Buckets(self.BUCKET)
+            sneks, kinds = self.engine.all_objects
+            for obj in chain(sneks, *kinds.values()):
+                self.__buckets.add(obj, obj.whole)
+        self.__objects = self.__published_objects()
+        self.__snapshots = {}
+        self.__snapshot_blocks = None
         self.__cases = {0: self.__register, 1: self.__set_dir, 2: self.__engine_info,
-                        3: self.__get_state_current, 4: self.__get_state_updated,
+                        3: self.__get_state_current, 4: self.__get_state_updated, 5: self.__subscribe,
+                        6: self.__set_version, 7: self.__get_metrics,
                         254: self.__get_state_current_old, 255: self.__get_state_updated_old}
 
     def run(self):
-        """function called to start the server"""
+        """function called to start the server (on the event loop of EVENT_LOOP if it is installed)"""
+        use_event_loop(self.EVENT_LOOP)
         asyncio.run(self.loop())
 
     async def loop(self):
         """runs the server indefinitely"""
-        await asyncio.gather(self.server_loop(), self.game_loop(), self.user_interface_loop())
+        loops = [self.server_loop(), self.game_loop()]
+        if self.USER_INTERFACE:
+            loops.append(self.user_interface_loop())
+        if self.METRICS_ADDRESS is not None:
+            loops.append(self.metrics.serve_http(*self.METRICS_ADDRESS))
+        if self.RECORDING is None:
+            await asyncio.gather(*loops)
+            return
+        self.recorder = Recorder(self.RECORDING, self.engine.infos)
+        try:
+            await asyncio.gather(*loops)
+        finally:
+            self.recorder.close()
 
     # TODO improve UI
     async def user_interface_loop(self):
@@ -179,32 +524,360 @@ class Server:
             await asyncio.sleep(2)
 
     async def game_loop(self):
-        """loop for gathering data from the game engine"""
+        """loop for gathering data from the game engine, recording the timings of each tick in self.metrics"""
+        stats = self.engine.stats
+        last = None
         async for sneks, new_sneks, kinds, new_of_kinds in self.engine.loop():
-            keep_players = {}
-            for hash_id, player in self.players.items():
-                for snek, (news, olds) in sneks.items():
-                    player.sneks[snek][0] += news
-                    player.sneks[snek][1] += olds
-                player.sneks.update(new_sneks)
-                for kind, elements in kinds.items():
-                    for element, (news, olds) in elements.items():
-                        player.kinds[kind][element][0] += news
-                        player.kinds[kind][element][1] += olds
-                for kind, new_elements in new_of_kinds.items():
-                    player.kinds[kind].update(new_elements)
-
-                if time.time() - player.last > self.KILL_TIME:
-                    player.snek.kill()
-
-                if time.time() - player.last < self.KICK_TIME:
-                    keep_players[hash_id] = player
-            self.players = keep_players
+            if stats and stats[-1] is not last:  # the timings of the previous tick
+                last = stats[-1]
+                self.metrics.observe('tick_move_seconds', last.move)
+                self.metrics.observe('tick_fan_out_seconds', last.fan_out)
+                self.metrics.observe('tick_lateness_seconds', max(last.lateness, 0))
+                self.metrics.count('ticks_skipped_total', last.skipped)
+            self.update(sneks, new_sneks, kinds, new_of_kinds)
+
+    def update(self, sneks, new_sneks, kinds, new_of_kinds):
+        """
+        records the changes of a tick yielded by the engine in self.history,
+        pushes them to the subscribers and kills or kicks inactive players
+        """
+        self.tick += 1
+
+        snek_news_olds = {}
+        joined = {}  # the actual moves of the sneks that joined, for players who already got them whole
+        for snek, (news, olds) in chain(sneks.items(), new_sneks.items()):
+            if snek in self.__joined:  # players haven't seen this snek yet
+                joined[snek] = news, olds
+                news, olds = (list(snek.whole) if snek.alive else []), []
+            snek_news_olds[snek] = (news, olds)
+        kind_news_olds = []
+        for kind in self.engine.other_sneks:
+            if kind in kinds:
+                kind_news_olds.append(dict(chain(kinds[kind].items(), new_of_kinds.get(kind, {}).items())))
+            else:
+                kind_news_olds.append(None)  # nothing changed
+
+        if self.__buckets is not None:
+            for obj, (news, olds) in chain(snek_news_olds.items(), *(e.items() for e in kind_news_olds if e)):
+                if obj.alive:
+                    self.__buckets.add(obj, news)
+                    self.__buckets.remove(obj, olds)
+                else:
+                    self.__buckets.discard(obj)
+
+        if self.__data_since is None and self.recorder is not None:
+            self.__data_since = self.tick - 1
+        changed = set()  # objects whose data has to be sent with version 2
+        if self.__data_since is not None:
+            for obj in chain(snek_news_olds, *filter(None, kind_news_olds)):
+                if not obj.alive:
+                    self.__metadata.pop(obj, None)
+                    continue
+                metadata = snekpi.encode_json(obj.data)
+                if self.__metadata.get(obj) != metadata:
+                    self.__metadata[obj] = metadata
+                    changed.add(obj)
+
+        self.__joined.clear()
+        self.__objects = self.__published_objects()
+        self.__snapshots.clear()
+        self.__snapshot_blocks = None
+        delta = TickDelta(self.tick, snek_news_olds, kind_news_olds, self.__objects, changed, joined=joined)
+        self.history.append(delta)
+        if self.recorder is not None:
+            self.recorder.record(self.tick, self.__delta_message(delta, 2), self.__keyframe)
+
+        now = time.time()
+        if self.subscribers:
+            versions = {player.version if player else 1 for player in self.subscribers.values()}
+            for version in versions:
+                message = self.__encode_tick(version) + self.__delta_message(delta, version)
+                self.broadcast(message, version)
+                receivers = sum(1 for player in self.subscribers.values()
+                                if (player.version if player else 1) == version)
+                self.metrics.count('bytes_out_total', len(message) * receivers)
+            for player in self.subscribers.values():
+                if player is not None:
+                    player.last = now
+            if any(not snek.alive for snek in snek_news_olds):
+                self.__remove_dead_subscribers()
+
+        self.__expire_players(now)
+
+    def __remove_dead_subscribers(self):
+        """removes the subscribed players whose snek died, as they got the tick where it died pushed already"""
+        dead = [player.snek for player in self.subscribers.values() if player is not None and not player.snek.alive]
+        for hash_id, player in list(self.players.items()):
+            if player.snek in dead:
+                del self.players[hash_id]
+                self.player_removed(hash_id)
+
+    def __expire_players(self, now):
+        """kills the sneks of the players inactive for KILL_TIME and kicks the ones inactive for KICK_TIME"""
+        for hash_id, player in self.__expiries.pop_due(now):
+            if self.players.get(hash_id) is not player:
+                continue
+            if now - player.last >= self.KICK_TIME:
+                del self.players[hash_id]
+                self.player_removed(hash_id)
+                continue
+            if now - player.last > self.KILL_TIME:
+                player.snek.kill()
+                self.__expiries.schedule((hash_id, player), player.last + self.KICK_TIME)
+            else:  # active since it was scheduled
+                self.__expiries.schedule((hash_id, player), player.last + self.KILL_TIME)
 
     async def server_loop(self):
         """server loop to communicate with players"""
         pass
 
+    def subscribe(self, handle, _args):
+        """
+        Method that should be called after answering a subscription command (5) with a non-empty answer.
+        handle is whatever the server implementation needs to push messages to the player (e.g. a stream),
+        _args are the bytes of the subscription command.
+        """
+        self.subscribers[handle] = self.players.get(_args[:8])
+
+    def unsubscribe(self, handle):
+        """stops pushing updates to handle"""
+        self.subscribers.pop(handle, None)
+
+    def player_removed(self, hash_id):
+        """called when the player hash_id is removed from self.players (kicked, or after its snek died)"""
+        pass
+
+    def broadcast(self, message, version=1):
+        """
+        sends message as is to every handle in self.subscribers whose player uses version (spectators use 1);
+        must be implemented in the subclasses
+        """
+        pass
+
+    def updates_since(self, tick, version=1):
+        """
+        the message pushed to subscribers with the changes of every tick after tick merged together (e.g. for a
+        subscriber that couldn't keep up), or None if those ticks are not in self.history anymore
+        """
+        deltas = self.__deltas_since(tick, version)
+        if deltas is None:
+            return None
+        if not deltas:
+            return b''
+        if len(deltas) == 1:
+            return self.__encode_tick(version) + self.__delta_message(deltas[0], version)
+        sneks, kinds, changed = self.__merge(deltas)
+        return self.__encode_tick(version) + self.__encode_lists(sneks, kinds, self.__objects, version, changed)
+
+    def __published_objects(self):
+        """
+        the objects players know about after the last tick, as a tuple of sneks and a tuple of each kind
+        (in viewport mode, the position of each object is also stored in self.__positions)
+        """
+        sneks, kinds = self.engine.all_objects
+        static_kinds = self.engine.static_kinds
+        res = (tuple(snek for snek in sneks if snek not in self.__joined),
+               tuple(self.engine.static_kind(kind).objects if kind in static_kinds else tuple(elements)
+                     for kind, elements in kinds.items()))
+        if self.__buckets is not None:
+            self.__positions = {obj: (i, j) for i, objs in enumerate((res[0],) + res[1]) for j, obj in enumerate(objs)}
+        return res
+
+    def __visible(self, player):
+        """
+        the published objects inside the viewport around the head of the player's snek, formatted like self.__objects
+        (players without a head, e.g. spectators, see every object)
+        """
+        head = player.snek.head
+        if not head:
+            return self.__objects
+        (x, y), (width, height) = head[0], self.viewport
+        positions = self.__positions
+        objs = [obj for obj in self.__buckets.query(x - width, y - height, x + width, y + height) if obj in positions]
+        res = [[] for _ in range(len(self.__objects[1]) + 1)]
+        for obj in sorted(objs, key=positions.__getitem__):
+            res[positions[obj][0]].append(obj)
+        return tuple(res[0]), tuple(map(tuple, res[1:]))
+
+    def __encode_tick(self, version):
+        """encodes the current tick"""
+        if version == 2:
+            return snekpi.encode_varint(self.tick)
+        return snekpi.encode_tick(self.tick)
+
+    @staticmethod
+    def __encode_snek(snek, news, olds, version, with_data=True, alive=None):
+        """encodes a snek with the given version (data is always sent with version 1)"""
+        if version == 2:
+            return snekpi.encode_partial_snek_v2(snek, news, olds, with_data, alive)
+        return snekpi.encode_partial_snek(snek, news, olds, alive)
+
+    @staticmethod
+    def __encode_list(obj_news_olds, version, changed=None):
+        """encodes a list of (snek, news, olds) with the given version (data is always sent with version 1)"""
+        if version == 2:
+            return snekpi.encode_partial_list_v2(obj_news_olds, changed)
+        return snekpi.encode_partial_list(obj_news_olds)
+
+    def __encode_whole_lists(self, kinds, version):
+        """encodes each list of objects of kinds whole, reusing the encodings of static kinds"""
+        res = []
+        static_kinds = self.engine.static_kinds
+        for kind, objs in zip(self.engine.other_sneks, kinds):
+            static = self.engine.static_kind(kind) if kind in static_kinds else None
+            if static is None or static.objects is not objs:
+                res.append(self.__encode_list(((obj, obj.whole, []) for obj in objs), version))
+                continue
+            encoded = static.encodings.get(version)
+            if encoded is None:
+                encoded = self.__encode_list(((obj, obj.whole, []) for obj in objs), version)
+                static.encodings[version] = encoded
+            res.append(encoded)
+        return b''.join(res)
+
+    def __snapshot(self, version):
+        """
+        the whole encodings of the sneks and of the other kinds of the current tick (each list with its length),
+        and the start and end of each snek inside them, computed at most once per tick for each version
+        """
+        snapshot = self.__snapshots.get(version)
+        if snapshot is None:
+            sneks, kinds = self.__objects
+            res = [self.__encode_count(len(sneks), version)]
+            offsets = {}
+            start = len(res[0])
+            for snek in sneks:
+                encoded = self.__encode_snek(snek, snek.whole, [], version)
+                res.append(encoded)
+                offsets[snek] = start, start + len(encoded)
+                start += len(encoded)
+            snapshot = Snapshot(b''.join(res), self.__encode_whole_lists(kinds, version), offsets)
+            self.__snapshots[version] = snapshot
+        return snapshot
+
+    def __keyframe(self):
+        """the whole state of the current tick, as recorded in a keyframe"""
+        snapshot = self.__snapshot(2)
+        return snapshot.sneks + snapshot.kinds
+
+    def __snapshot_player(self, snapshot, player_snek, version):
+        """the encoding of the player's snek, taken from the snapshot if it is there"""
+        offsets = snapshot.offsets.get(player_snek)
+        if offsets is None:
+            return self.__encode_snek(player_snek, player_snek.whole, [], version)
+        return snapshot.sneks[offsets[0]:offsets[1]]
+
+    @staticmethod
+    def __encode_count(count, version):
+        """encodes the number of objects of a list"""
+        if version == 2:
+            return snekpi.encode_varint(count)
+        return count.to_bytes(4, 'big')
+
+    def __encode_lists(self, sneks, kinds, objects, version, changed):
+        """encodes the sneks and the other kinds of objects of an updated state, given the news and olds of each"""
+        encode_list = self.__encode_list
+        res = [encode_list(((snek, news, olds) for snek, (news, olds) in sneks.items()), version, changed)]
+        for kind, elements, objs in zip(self.engine.other_sneks, kinds, objects[1]):
+            if elements is None and version == 2:
+                res.append(snekpi.encode_unchanged_list_v2(len(objs)))
+            elif elements is None:
+                res.append(self.__encode_unchanged_list(kind, objs, version))
+            else:
+                obj_news_olds = ((obj, news, olds) for obj, (news, olds) in elements.items())
+                res.append(encode_list(obj_news_olds, version, changed))
+        return b''.join(res)
+
+    def __encode_unchanged_list(self, kind, objs, version):
+        """encodes the objects of kind without changes, reusing the encoding of static kinds"""
+        static = self.engine.static_kind(kind) if kind in self.engine.static_kinds else None
+        if static is None or static.objects is not objs:
+            return self.__encode_list(((obj, [], []) for obj in objs), version)
+        key = 'unchanged', version
+        encoded = static.encodings.get(key)
+        if encoded is None:
+            encoded = self.__encode_list(((obj, [], []) for obj in objs), version)
+            static.encodings[key] = encoded
+        return encoded
+
+    def __delta_message(self, delta, version):
+        """the changes of a tick as encoded in an updated state, computed once for every player"""
+        message = delta.messages.get(version)
+        if message is None:
+            message = self.__encode_lists(delta.sneks, delta.kinds, delta.objects, version, delta.changed)
+            delta.messages[version] = message
+        return message
+
+    @staticmethod
+    def __delta_blocks(delta):
+        """all the new and old blocks of a tick"""
+        if delta.blocks is None:
+            news = []
+            olds = []
+            for news_, olds_ in delta.sneks.values():
+                news += news_
+                olds += olds_
+            for elements in delta.kinds:
+                if elements is not None:
+                    for news_, olds_ in elements.values():
+                        news += news_
+                        olds += olds_
+            delta.blocks = news, olds
+        return delta.blocks
+
+    def __deltas_since(self, tick, version=1):
+        """
+        the deltas of the ticks after tick, or None if they are not in self.history anymore
+        (or if they don't track the data changes needed by version 2)
+        """
+        missing = self.tick - tick
+        if missing > len(self.history):
+            return None
+        if version == 2 and (self.__data_since is None or tick < self.__data_since):
+            return None
+        return [self.history[i] for i in range(len(self.history) - missing, len(self.history))]
+
+    @staticmethod
+    def __merge(deltas):
+        """merges the news and olds (and the changed objects) of many deltas, keeping the objects in order"""
+        sneks = {}
+        kinds = [None] * len(deltas[-1].kinds)
+        changed = set()
+        for delta in deltas:
+            changed |= delta.changed
+            for snek, (news, olds) in delta.sneks.items():
+                merged = sneks.setdefault(snek, ([], []))
+                merged[0].extend(news)
+                merged[1].extend(olds)
+            for i, elements in enumerate(delta.kinds):
+                if elements is None:
+                    continue
+                if kinds[i] is None:
+                    kinds[i] = {}
+                for obj, (news, olds) in elements.items():
+                    merged = kinds[i].setdefault(obj, ([], []))
+                    merged[0].extend(news)
+                    merged[1].extend(olds)
+
+        sneks = {snek: Server.__net(news, olds) for snek, (news, olds) in sneks.items()}
+        kinds = [elements and {obj: Server.__net(news, olds) for obj, (news, olds) in elements.items()}
+                 for elements in kinds]
+        return sneks, kinds, changed
+
+    @staticmethod
+    def __net(news, olds):
+        """drops the blocks that have been both added and removed from news and olds"""
+        if not news or not olds:
+            return news, olds
+        counts = Counter(olds)
+        net_news = []
+        for block in news:
+            if counts[block]:
+                counts[block] -= 1
+            else:
+                net_news.append(block)
+        return net_news, list(counts.elements())
+
     # TODO: add exception handling
 
     def deal_with_request(self, c, _args):
@@ -213,19 +886,34 @@ class Server:
         Parameter c is the command from the player as an int;
         _args is the rest of the bytes read from the player.
         It returns the answer message as bytes that should be relayed as is to the player.
+        The latency, bytes and errors of each command are recorded in self.metrics.
         """
+        start = time.perf_counter()
+        self.metrics.count('bytes_in_total', 1 + len(_args))
+        try:
+            answer = self.metrics.profiled(self.__deal_with_request, c, _args)
+        except LookupError:
+            self.metrics.count('request_errors_total', command=c)
+            raise
+        self.metrics.observe('request_seconds', time.perf_counter() - start, command=c)
+        self.metrics.count('bytes_out_total', len(answer))
+        return answer
+
+    def __deal_with_request(self, c, _args):
+        """decodes and answers a request from the player"""
         args = self.__decode(c, _args)
         answer = self.__cases[c](*args)
 
         # cleanup for the player (e.g. last, ...)
         if c in {3, 4, 254, 255}:
-            self.__set_player(args[0])
+            self.__set_player(args[0], c)
 
-        if c in {1, 3, 4, 254, 255}:
+        if c in {1, 3, 4, 5, 6, 254, 255}:
             args[0].last = time.time()
 
-        if len(args) > 0 and isinstance(args[0], Snek) and not args[0].alive:
-            del self.players[_args[:8]]
+        if c in {1, 3, 4, 5, 6, 254, 255} and not args[0].snek.alive and self.players.get(_args[:8]) is args[0]:
+            del self.players[_args[:8]]  # the player got the answer where its snek is dead
+            self.player_removed(_args[:8])
 
         return answer
 
@@ -240,31 +928,36 @@ class Server:
         elif c == 3:
             if args:
                 return self.players[args[:8]],
-            return Player(Snek(), {}, {}, 0),
+            return Player(Snek(), 0, ((), ()), 0),
         elif c == 4:
             return self.players[args[:8]],
+        elif c == 5:
+            if args:
+                return self.players[args[:8]],
+            return Player(Snek(), 0, ((), ()), 0),
+        elif c == 6:
+            return self.players[args[:8]], args[8]
+        elif c == 7:
+            return ()
         elif c == 254:
             if args:
                 return self.players[args[:8]],
-            return Player(Snek(), {}, {}, 0),
+            return Player(Snek(), 0, ((), ()), 0),
         elif c == 255:
             return self.players[args[:8]],
         raise LookupError(f'invalid command: {c}')
 
-    def __set_player(self, player):
-        """resets player.sneks and player.kinds attributes"""
-        sneks_, kinds_ = self.engine.all_objects
-        sneks = {}
-        kinds = {}
-        for snek in sneks_:
-            sneks[snek] = [[], []]
-        for kind, elements in kinds_.items():
-            kinds[kind] = {}
-            for element in elements:
-                kinds[kind][element] = [[], []]
-
-        player.sneks = sneks
-        player.kinds = kinds
+    def __set_player(self, player, c):
+        """
+        marks player as up to date with the current tick
+        (in viewport mode, the objects known by the player are only set by the answers to commands 3 and 4,
+        so commands 254 and 255, which don't send them, make the next command 4 resend every object)
+        """
+        player.tick = self.tick
+        if self.viewport is None:
+            player.known = self.__objects
+        elif c in {254, 255}:
+            player.resync = True
 
     def __register(self, name):
         """registers player to the server"""
@@ -277,18 +970,18 @@ class Server:
         snek = self.engine.create_snek(name=name)
         if not snek:
             return b''
+        self.__joined.add(snek)
 
-        for player in self.players.values():
-            player.sneks[snek] = [[], []]
-        player = Player(snek, {}, {}, time.time())
-        self.__set_player(player)
+        known = self.__objects if self.viewport is None else ((), ((),) * len(self.__objects[1]))
+        player = Player(snek, self.tick, known, time.time())
         self.players[hash_id] = player
+        self.__expiries.schedule((hash_id, player), player.last + self.KILL_TIME)
         return hash_id
 
     @staticmethod
     def __set_dir(player, direction):  # add exception handling
-        """sets player's snek direction"""
-        player.snek.dir = direction
+        """buffers player's snek direction, which gets applied by the engine at the beginning of a tick"""
+        player.snek.queue_input(direction)
         return b'\x00'
 
     def __engine_info(self):
@@ -296,62 +989,182 @@ class Server:
         encoded_data = snekpi.encode_json(self.engine.infos)
         return encoded_data
 
+    def __set_version(self, player, version):
+        """sets the version of the encoding used for the player's state messages"""
+        if version not in self.VERSIONS:
+            return b''
+        player.version = version
+        if version == 2 and self.__data_since is None:
+            self.__data_since = self.tick  # the data changes are only tracked from now on
+        return b'\x00'
+
+    def __get_metrics(self):
+        """sends the metrics of the server in the Prometheus text format"""
+        return self.metrics.render().encode('ascii')
+
     def __get_state_current(self, player):
         """sends current state of the game"""
         player_snek = player.snek
-        sneks, kinds = self.engine.all_objects
-        res = b''
-
-        res += snekpi.encode_whole_snek(player_snek)
-
-        res += snekpi.encode_whole_list((snek for snek in sneks if snek is not player_snek))
-
-        for elements in kinds.values():
-            res += snekpi.encode_whole_list(elements)
-
-        return res
-
-    @staticmethod
-    def __get_state_updated(player):
+        version = player.version
+        if player_snek in self.__joined:  # the player gets its snek whole before the others do
+            player.snek_sent = True
+        if self.viewport is not None:
+            sneks, kinds = player.known = self.__visible(player)
+            player.resync = False
+            res = self.__encode_snek(player_snek, player_snek.whole, [], version)
+            res += self.__encode_list(((snek, snek.whole, []) for snek in sneks if snek is not player_snek), version)
+            return res + self.__encode_whole_lists(kinds, version)
+
+        # the player's snek is moved from the list of sneks to the front
+        snapshot = self.__snapshot(version)
+        offsets = snapshot.offsets.get(player_snek)
+        if offsets is None:
+            return self.__encode_snek(player_snek, player_snek.whole, [], version) + snapshot.sneks + snapshot.kinds
+        sneks_len = len(self.__objects[0])
+        start = len(self.__encode_count(sneks_len, version))
+        return (snapshot.sneks[offsets[0]:offsets[1]] + self.__encode_count(sneks_len - 1, version) +
+                snapshot.sneks[start:offsets[0]] + snapshot.sneks[offsets[1]:] + snapshot.kinds)
+
+    def __get_state_updated(self, player):
         """sends updated state of the game since last time that self.set_player was called on the player"""
-        player_snek = player
-        sneks = player
-        kinds = player
-        res = b''
-
-        res += snekpi.encode_partial_snek(player_snek, sneks[player_snek][0], sneks[player_snek][1])
+        if self.viewport is not None:
+            return self.__get_state_visible(player)
+        player_snek = player.snek
+        version = player.version
+        deltas = self.__deltas_since(player.tick, player.version)
+        if deltas is None:
+            return self.__get_state_resync(player, self.__objects)
+        if not deltas:
+            sneks = {snek: ((), ()) for snek in player.known[0]}
+            kinds = [None] * len(player.known[1])
+            return (self.__encode_snek(player_snek, [], [], version, False) +
+                    self.__encode_lists(sneks, kinds, player.known, version, set()))
+        if len(deltas) == 1:
+            delta = deltas[0]
+            news, olds = self.__player_changes(player, delta.sneks, deltas)
+            return (self.__encode_snek(player_snek, news, olds, version, player_snek in delta.changed) +
+                    self.__delta_message(delta, version))
+
+        sneks, kinds, changed = self.__merge(deltas)
+        news, olds = self.__player_changes(player, sneks, deltas)
+        return (self.__encode_snek(player_snek, news, olds, version, player_snek in changed) +
+                self.__encode_lists(sneks, kinds, self.__objects, version, changed))
 
-        res += snekpi.encode_partial_list(((snek, news, olds) for snek, (news, olds) in sneks.items()))
+    @staticmethod
+    def __player_changes(player, sneks, deltas):
+        """
+        the news and olds of the player's snek in sneks (the changes of deltas); if the player already got its snek
+        whole in the tick it joined (see player.snek_sent), its actual moves of that tick are used instead of all of
+        its blocks, which the other players get
+        """
+        player_snek = player.snek
+        if not player.snek_sent or not any(player_snek in delta.joined for delta in deltas):
+            return sneks.get(player_snek, ((), ()))
+        news = []
+        olds = []
+        for delta in deltas:
+            news_, olds_ = delta.joined.get(player_snek) or delta.sneks.get(player_snek, ((), ()))
+            news += news_
+            olds += olds_
+        return Server.__net(news, olds)
 
-        for elements in kinds.values():
-            res += snekpi.encode_partial_list((element, news, olds) for element, (news, olds) in elements.items())
+    def __get_state_visible(self, player):
+        """
+        sends updated state of the game in viewport mode: the objects known by the player are sent in order with their
+        changes while still inside the viewport, or marked dead once out of it; objects that entered it are sent whole
+        """
+        player_snek = player.snek
+        version = player.version
+        deltas = self.__deltas_since(player.tick, player.version)
+        visible = self.__visible(player)
+        if deltas is None or player.resync:
+            res = self.__get_state_resync(player, visible)
+            player.known = visible
+            player.resync = False
+            return res
+        if deltas:
+            sneks, kinds, changed = self.__merge(deltas)
+        else:
+            sneks, kinds, changed = {}, [None] * len(visible[1]), set()
+
+        news, olds = self.__player_changes(player, sneks, deltas)
+        res = self.__encode_snek(player_snek, news, olds, version, player_snek in changed)
+        known = []
+        for knowns, currents, elements in zip((player.known[0],) + player.known[1], (visible[0],) + visible[1],
+                                              [sneks] + kinds):
+            elements = elements or {}
+            currents_set = set(currents)
+            knowns_set = set(knowns)
+            entered = [obj for obj in currents if obj not in knowns_set]
+            res += self.__encode_count(len(knowns) + len(entered), version)
+            for obj in knowns:
+                if obj in currents_set:
+                    news, olds = elements.get(obj, ((), ()))
+                    res += self.__encode_snek(obj, news, olds, version, obj in changed)
+                else:
+                    res += self.__encode_snek(obj, [], [], version, False, alive=False)
+            res += b''.join(self.__encode_snek(obj, obj.whole, [], version) for obj in entered)
+            known.append(tuple(obj for obj in knowns if obj in currents_set) + tuple(entered))
+        player.known = known[0], tuple(known[1:])
+        return res
 
+    def __get_state_resync(self, player, objects):
+        """
+        sends updated state of the game to a player too far behind for self.history:
+        every object known by the player is marked dead, and every current object is sent as new
+        """
+        player_snek = player.snek
+        version = player.version
+        res = self.__encode_snek(player_snek, player_snek.whole, [], version)
+        for knowns, currents in zip((player.known[0],) + player.known[1], (objects[0],) + objects[1]):
+            res += self.__encode_count(len(knowns) + len(currents), version)
+            res += b''.join(self.__encode_snek(obj, [], [], version, False, alive=False) for obj in knowns)
+            res += b''.join(self.__encode_snek(obj, obj.whole, [], version) for obj in currents)
         return res
 
+    def __subscribe(self, player):
+        """
+        sends current state of the game, including the player's snek in the list of sneks, and the current tick.
+        Sneks that joined during this tick are left out, as they are sent whole with the next tick
+        """
+        version = player.version
+        snapshot = self.__snapshot(version)
+        return (self.__encode_tick(version) + self.__snapshot_player(snapshot, player.snek, version) +
+                snapshot.sneks + snapshot.kinds)
+
     def __get_state_current_old(self, player):
-        """sends current blocks in the game"""
+        """sends current blocks in the game (encoded at most once per tick)"""
         alive = player.snek.alive
-        blocks = self.engine.all_blocks
+        if self.__snapshot_blocks is None:
+            blocks = self.engine.all_blocks
+            if self.__joined:  # sneks that joined during this tick are sent with the next one
+                joined = {block for snek in self.__joined for block in snek.whole}
+                blocks = [block for block in blocks if block not in joined]
+            self.__snapshot_blocks = snekpi.encode_blocks(blocks, [])
         res = b''
 
         res += alive.to_bytes(1, 'big')
-        res += snekpi.encode_blocks(blocks, [])
+        res += self.__snapshot_blocks
 
         return res
 
-    @staticmethod
-    def __get_state_updated_old(player):  # news and olds might contain repeated elements, is that a problem?
+    def __get_state_updated_old(self, player):
         """sends new and old blocks since last time that self.set_player was called on the player"""
         alive = player.snek.alive
-        news = []
-        olds = []
-        for news_, olds_ in player.sneks.values():
-            news += news_
-            olds += olds_
-        for elements in player.kinds.values():
-            for news_, olds_ in elements.values():
+        deltas = self.__deltas_since(player.tick)
+        if deltas is None:  # too far behind, send everything
+            news = [block for obj in chain(self.__objects[0], *self.__objects[1]) for block in obj.whole]
+            olds = []
+        elif len(deltas) == 1:
+            news, olds = self.__delta_blocks(deltas[0])
+        else:
+            news = []
+            olds = []
+            for delta in deltas:
+                news_, olds_ = self.__delta_blocks(delta)
                 news += news_
                 olds += olds_
+            news, olds = self.__net(news, olds)
         res = b''
 
         res += alive.to_bytes(1, 'big')
@@ -0,0 +1,175 @@
+import asyncio
+import cProfile
+import io
+import pstats
+import random
+from bisect import bisect_left
+
+
+class Histogram:
+    """
+    Histogram of observed values, counted in buckets by their upper bound (like Prometheus histograms).
+    It exposes:
+    BUCKETS constant (the default upper bounds, in seconds),
+    self.buckets, self.counts, self.count and self.sum attributes,
+    and self.observe(value) method.
+    """
+
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=None):
+        self.buckets = self.BUCKETS if buckets is None else tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is for the values above every bucket
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        """counts value in the first bucket whose upper bound is not lower than value"""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms about a server, rendered in the Prometheus text format by self.render().
+    Metrics are identified by a name and optional labels (e.g. the command of a request).
+    Calls made through self.profiled(function, *args) are profiled with cProfile, with probability profile_rate.
+    HTTP clients taking more than READ_TIMEOUT seconds to send their request, or sending a request line and headers
+    longer than MAX_HEAD bytes, are disconnected without an answer.
+    It exposes:
+    READ_TIMEOUT, WRITE_TIMEOUT and MAX_HEAD constants,
+    self.prefix, self.counters, self.gauges, self.histograms, self.profile_rate and self.profile attributes,
+    self.count(name, value, **labels), self.observe(name, value, **labels), self.gauge(name, function),
+    self.profiled(function, *args), self.profile_stats(sort, limit) and self.render() methods,
+    and self.serve_http(host, port) asynchronous method.
+    """
+
+    READ_TIMEOUT = 10
+    WRITE_TIMEOUT = 10
+    MAX_HEAD = 8192
+
+    def __init__(self, prefix='snek', profile_rate=0):
+        self.prefix = prefix
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.profile_rate = profile_rate
+        self.profile = None
+
+    def count(self, name, value=1, **labels):
+        """adds value to a counter"""
+        key = name, tuple(labels.items())
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """adds value to a histogram"""
+        key = name, tuple(labels.items())
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name, function):
+        """registers a gauge, whose value is returned by function whenever the metrics are rendered"""
+        self.gauges[name] = function
+
+    def profiled(self, function, *args):
+        """calls function with args, profiling the call with probability self.profile_rate"""
+        if self.profile_rate and random.random() < self.profile_rate:
+            if self.profile is None:
+                self.profile = cProfile.Profile()
+            return self.profile.runcall(function, *args)
+        return function(*args)
+
+    def profile_stats(self, sort='cumulative', limit=30):
+        """the statistics of the profiled calls so far, as text"""
+        if self.profile is None:
+            return 'no calls profiled (see profile_rate)\n'
+        res = io.StringIO()
+        pstats.Stats(self.profile, stream=res).sort_stats(sort).print_stats(limit)
+        return res.getvalue()
+
+    def render(self):
+        """the metrics in the Prometheus text format"""
+        prefix = self.prefix
+        lines = []
+        for name, function in self.gauges.items():
+            lines.append(f'# TYPE {prefix}_{name} gauge')
+            lines.append(f'{prefix}_{name} {function()}')
+
+        for name, metrics in self.__by_name(self.counters).items():
+            lines.append(f'# TYPE {prefix}_{name} counter')
+            for labels, value in metrics:
+                lines.append(f'{prefix}_{name}{self.__labels(labels)} {value}')
+
+        for name, metrics in self.__by_name(self.histograms).items():
+            lines.append(f'# TYPE {prefix}_{name} histogram')
+            for labels, histogram in metrics:
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{prefix}_{name}_bucket{self.__labels(labels + (("le", bound),))} {cumulative}')
+                lines.append(f'{prefix}_{name}_sum{self.__labels(labels)} {histogram.sum}')
+                lines.append(f'{prefix}_{name}_count{self.__labels(labels)} {histogram.count}')
+
+        return '\n'.join(lines) + '\n'
+
+    async def serve_http(self, host, port):
+        """serves the metrics over HTTP at /metrics (and the profile statistics at /profile)"""
+        server = await asyncio.start_server(self.__answer_http, host, port, limit=self.MAX_HEAD)
+        async with server:
+            await server.serve_forever()
+
+    async def __answer_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """answers a single HTTP request"""
+        try:
+            request = await asyncio.wait_for(self.__read_head(reader), self.READ_TIMEOUT)
+            path = request.split()[1] if len(request.split()) > 1 else b'/'
+            if path == b'/metrics':
+                status, body = '200 OK', self.render()
+            elif path == b'/profile':
+                status, body = '200 OK', self.profile_stats()
+            else:
+                status, body = '404 Not Found', 'not found\n'
+
+            body = body.encode('utf-8')
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('ascii') + body)
+            await asyncio.wait_for(writer.drain(), self.WRITE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+            writer.transport.abort()  # slow, oversized or broken: drop whatever is still buffered
+        finally:
+            writer.close()
+
+    async def __read_head(self, reader):
+        """
+        reads the request line and the headers (which are ignored), returning the request line;
+        raises LimitOverrunError if they are longer than MAX_HEAD bytes (ValueError for a single line, by the reader)
+        """
+        request = await reader.readline()
+        size = len(request)
+        while 1:
+            line = await reader.readline()
+            size += len(line)
+            if size > self.MAX_HEAD:
+                raise asyncio.LimitOverrunError(f'request head too long: more than {self.MAX_HEAD} bytes', size)
+            if not line.strip():
+                return request
+
+    @staticmethod
+    def __by_name(metrics):
+        """groups metrics by name, as (labels, metric) lists"""
+        res = {}
+        for (name, labels), metric in metrics.items():
+            res.setdefault(name, []).append((labels, metric))
+        return res
+
+    @staticmethod
+    def __labels(labels):
+        """formats the labels of a metric"""
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
@@ -0,0 +1,175 @@
+import json
+import queue
+import threading
+from collections import Counter
+
+from sneklib import snekpi
+
+# A recording is a sequence of records, each one made of:
+# | kind (1 byte) | tick (4 bytes) | length of payload (4 bytes) | payload |
+# where kind is INFOS (payload: infos of the engine as json), KEYFRAME (payload: the whole state after the tick,
+# as the lists of sneks and of the other kinds in an answer to command 5) or DELTA (payload: the changes of the tick,
+# as the lists of sneks and of the other kinds in an updated state), everything encoded with version 2.
+INFOS = b'I'
+KEYFRAME = b'K'
+DELTA = b'D'
+
+
+def encode_record(kind, tick, payload):
+    """encodes a record of a recording"""
+    return kind + tick.to_bytes(4, 'big') + len(payload).to_bytes(4, 'big') + payload
+
+
+class Recorder:
+    """
+    Records the ticks of a game to a file, starting with the infos of the engine, given to a Server as its recorder.
+    Records are handed to a thread which writes them in batches, so that recording doesn't block the ticks.
+    A keyframe with the whole state of the game is recorded every KEYFRAME_EVERY ticks (and with the first tick).
+    It should be closed once the game is over (or used as a context manager) to write the last records.
+    It exposes:
+    KEYFRAME_EVERY constant,
+    self.path attribute,
+    self.record(tick, delta, keyframe) and self.close() methods.
+    """
+
+    KEYFRAME_EVERY = 100
+
+    def __init__(self, path, infos=None):
+        self.path = path
+        self.__file = open(path, 'wb')
+        self.__queue = queue.SimpleQueue()
+        self.__queue.put(encode_record(INFOS, 0, json.dumps(infos).encode('ascii')))
+        self.__last_keyframe = None
+        self.__thread = threading.Thread(target=self.__write, daemon=True)
+        self.__thread.start()
+
+    def record(self, tick, delta, keyframe):
+        """records the changes of a tick, and the whole state after it (returned by keyframe()) when it is due"""
+        self.__queue.put(encode_record(DELTA, tick, delta))
+        if self.__last_keyframe is None or tick - self.__last_keyframe >= self.KEYFRAME_EVERY:
+            self.__last_keyframe = tick
+            self.__queue.put(encode_record(KEYFRAME, tick, keyframe()))
+
+    def close(self):
+        """writes the records left and closes the file"""
+        self.__queue.put(None)
+        self.__thread.join()
+        self.__file.close()
+
+    def __write(self):
+        """writes the records as they come, in batches"""
+        while 1:
+            batch = [self.__queue.get()]
+            while not self.__queue.empty():
+                batch.append(self.__queue.get())
+            closed = batch[-1] is None
+            self.__file.write(b''.join(batch[:-1] if closed else batch))
+            self.__file.flush()
+            if closed:
+                return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class Replay:
+    """
+    Reads a recording made by a Recorder. The position of each keyframe is found when the replay is opened,
+    so that the state of any tick is rebuilt from the last keyframe before it, applying only the deltas in between.
+    The state is given as a tuple of the list of sneks and the list of the lists of each other kind,
+    each object being a tuple of its data and of the list of its blocks.
+    It exposes:
+    self.path, self.infos, self.keyframes, self.first and self.last attributes,
+    self.state(tick) and self.states(start, stop) methods.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.infos = None
+        self.keyframes = {}  # tick: position of the keyframe
+        self.first = None
+        self.last = None
+        with open(path, 'rb') as file:
+            position = 0
+            while header := file.read(9):
+                kind, tick, length = header[:1], int.from_bytes(header[1:5], 'big'), int.from_bytes(header[5:], 'big')
+                if kind == INFOS:
+                    self.infos = json.loads(file.read(length))
+                else:
+                    if kind == KEYFRAME:
+                        self.keyframes[tick] = position
+                    elif self.first is None:
+                        self.first = tick
+                    self.last = tick
+                    file.seek(length, 1)
+                position += 9 + length
+
+    def state(self, tick):
+        """the state of the game after tick"""
+        state = None
+        for state in self.states(tick, tick + 1):
+            pass
+        if state is None:
+            raise LookupError(f'tick {tick} is not in the recording')
+        return state[1]
+
+    def states(self, start, stop=None):
+        """yields the tick and the state of the game after each tick in range(start, stop)"""
+        keyframes = [tick for tick in self.keyframes if tick <= start]
+        if not keyframes:
+            return
+        keyframe = max(keyframes)
+        with open(self.path, 'rb') as file:
+            file.seek(self.keyframes[keyframe])
+            state = None
+            while header := file.read(9):
+                kind, tick, length = header[:1], int.from_bytes(header[1:5], 'big'), int.from_bytes(header[5:], 'big')
+                if stop is not None and tick >= stop:
+                    return
+                if kind == KEYFRAME and state is None:
+                    state = self.__decode_keyframe(file.read(length))
+                elif kind == DELTA and state is not None and tick > keyframe:
+                    state = self.__apply(state, file.read(length))
+                else:
+                    file.seek(length, 1)
+                    continue
+                if tick >= start:
+                    yield tick, state
+
+    @staticmethod
+    def __decode_keyframe(payload):
+        """decodes the whole state of a keyframe"""
+        payload = memoryview(payload)
+        sneks, offset = snekpi.read_list_v2(payload)
+        kinds, offset = snekpi.read_lists_v2(payload, offset)
+        return ([(data, news) for alive, data, news, olds in sneks],
+                [[(data, news) for alive, data, news, olds in objs] for objs in kinds])
+
+    @staticmethod
+    def __apply(state, payload):
+        """applies the changes of a tick to state, as a client would, returning the new state"""
+        payload = memoryview(payload)
+        sneks, offset = snekpi.read_list_v2(payload)
+        kinds, offset = snekpi.read_lists_v2(payload, offset)
+        res = []
+        for objs, changes in zip([state[0]] + state[1], [sneks] + kinds):
+            new_objs = []
+            for i, (alive, data, news, olds) in enumerate(changes):
+                old_data, blocks = objs[i] if i < len(objs) else (None, [])
+                if not alive:
+                    continue
+                if olds:
+                    olds = Counter(olds)
+                    kept = []
+                    for block in blocks:
+                        if olds[block]:
+                            olds[block] -= 1
+                        else:
+                            kept.append(block)
+                    blocks = kept
+                new_objs.append((old_data if data is None else data, news + blocks if news else blocks))
+            res.append(new_objs)
+        return res[0], res[1:]
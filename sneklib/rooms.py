@@ -0,0 +1,295 @@
+import asyncio
+import multiprocessing
+import os
+from itertools import count
+
+from sneklib import snekpi
+from sneklib.basetypes import Server, use_event_loop
+from sneklib.servers import TCPConnections
+
+
+class RoomServer(Server):
+    """
+    Server of a single room, run inside a worker process by serve_rooms.
+    Instead of communicating with the players, it serves the requests relayed by a RoomsServer through connection
+    (one end of a multiprocessing.Pipe shared by the rooms of the worker), and sends back answers and broadcasts, and
+    the hash_id of the players it removes.
+    It should be subclassed to redefine the constants of Server (e.g. DIRECTION) for the rooms.
+    """
+
+    def __init__(self, connection, engine, max_connections=5, viewport=None):
+        super().__init__(None, engine, max_connections, viewport)
+        self.connection = connection
+
+    def serve(self, request_id, c, _args, handle):
+        """answers a request relayed by the front server, subscribing handle if it is a successful subscription"""
+        try:
+            answer = self.deal_with_request(c, _args)
+        except LookupError:  # unknown command or unknown player
+            answer = None
+        if c == 5 and answer:
+            self.subscribe(handle, _args)
+        self.connection.send(('answer', request_id, answer))
+
+    def player_removed(self, hash_id):
+        self.connection.send(('removed', hash_id))
+
+    def broadcast(self, message, version=1):
+        handles = [handle for handle, player in self.subscribers.items()
+                   if (player.version if player else 1) == version]
+        self.connection.send(('broadcast', handles, message))
+
+
+def serve_rooms(connection, rooms):
+    """
+    Entry point of a worker process: runs the rooms given as a dictionary of index: (room_class, engine_factory)
+    and serves the requests received from connection until None is received.
+    The worker runs on the EVENT_LOOP of the class of its first room.
+    """
+    use_event_loop(next(iter(rooms.values()))[0].EVENT_LOOP)
+    asyncio.run(_serve_rooms(connection, rooms))
+
+
+async def _serve_rooms(connection, rooms):
+    rooms = {index: room_class(connection, engine_factory()) for index, (room_class, engine_factory) in rooms.items()}
+    game_loops = [asyncio.ensure_future(room.game_loop()) for room in rooms.values()]
+
+    def serve(request):
+        kind, index, *args = request
+        if kind == 'request':
+            rooms[index].serve(*args)
+        elif kind == 'unsubscribe':
+            rooms[index].unsubscribe(*args)
+
+    await read_pipe(connection, serve)
+
+    for game_loop in game_loops:
+        game_loop.cancel()
+
+
+PIPE_BATCH = 16  # messages read_pipe handles each time the pipe is readable, before letting the event loop run
+
+
+async def read_pipe(pipe, handle):
+    """
+    calls handle(message) with each message received from pipe (an end of a multiprocessing.Pipe) until None is
+    received, raising EOFError if the other end gets closed; the messages are read by the event loop as soon as the
+    pipe is readable, instead of waiting for each one of them in another thread
+    """
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+
+    def on_readable():
+        if done.done():
+            return
+        try:
+            for _ in range(PIPE_BATCH):  # the event loop calls on_readable again if more messages are waiting
+                if not pipe.poll():
+                    return
+                message = pipe.recv()
+                if message is None:
+                    done.set_result(None)
+                    return
+                handle(message)
+        except Exception as e:  # EOFError included
+            done.set_exception(e)
+
+    try:
+        loop.add_reader(pipe.fileno(), on_readable)
+    except NotImplementedError:  # event loops without add_reader (e.g. the proactor event loop of Windows)
+        while (message := await loop.run_in_executor(None, pipe.recv)) is not None:
+            handle(message)
+        return
+    try:
+        await done
+    finally:
+        loop.remove_reader(pipe.fileno())
+
+
+class RelayServer(TCPConnections):
+    """
+    Front server accepting connections like AsyncTCPServer (see servers.TCPConnections), which relays the commands of
+    the players to servers running in other processes (e.g. rooms served by serve_rooms) and relays back their answers
+    and the updates they push to subscribers. Each server has an index, and the server with index i is reached through
+    self.pipes[i % len(self.pipes)] (ends of multiprocessing.Pipe, so that a process can host many servers);
+    commands go to the server chosen by self.route(c, _args), which can be overloaded (the first one by default).
+    Subscribers with more than SUBSCRIBER_BUFFER bytes still to be sent are disconnected, as the updates they miss
+    can't be merged without the history of the server that pushed them.
+    Subclasses open self.pipes and then await self.relay_loop() in self.loop().
+    It exposes:
+    KICK_TIME and EVENT_LOOP constants (the ones of Server by default),
+    self.address, self.max_connections and self.pipes attributes,
+    self.run(), self.route(c, _args) and self.player_removed(hash_id) methods, and self.relay_loop() and
+    self.relay_request(index, c, _args, handle) asynchronous methods.
+    """
+
+    KICK_TIME = Server.KICK_TIME
+    EVENT_LOOP = Server.EVENT_LOOP
+
+    def __init__(self, address, max_connections=5):
+        self.address = address
+        self.max_connections = max_connections
+        self.subscribers = {}
+        self.connections = 0
+        self.pipes = []
+        self.__requests = {}
+        self.__request_ids = count()
+        self.__handles = count()
+        self.__writers = {}
+
+    def run(self):
+        """function called to start the server (on the event loop of EVENT_LOOP if it is installed)"""
+        use_event_loop(self.EVENT_LOOP)
+        asyncio.run(self.loop())
+
+    async def relay_loop(self):
+        """serves the players and relays the messages of the servers behind self.pipes until cancelled"""
+        try:
+            await asyncio.gather(self.server_loop(), *(read_pipe(pipe, self.__relay) for pipe in self.pipes))
+        finally:
+            for pipe in self.pipes:
+                pipe.send(None)
+
+    async def dispatch(self, reader, writer):
+        try:
+            await super().dispatch(reader, writer)
+        finally:
+            self.unsubscribe(writer)  # also drops subscriptions made without framed mode
+
+    def route(self, c, _args):
+        """the index of the server command c with arguments _args is sent to"""
+        return 0
+
+    def player_removed(self, hash_id):
+        """called when a server behind self.pipes removes the player hash_id"""
+        pass
+
+    async def answer(self, writer, c, _args):
+        index = self.route(c, _args)
+        handle = None
+        if c == 5:
+            handle = next(self.__handles)
+            self.__writers[handle] = []  # frames pushed before the answer gets written
+            self.subscribers[writer] = (index, handle)
+
+        answer = await self.relay_request(index, c, _args, handle)
+        if c == 5 and not answer:
+            del self.__writers[handle]
+            del self.subscribers[writer]
+        if answer is None:
+            raise LookupError(f'unknown player or command: {c}')
+        return answer
+
+    def subscribe(self, handle, _args):
+        _, server_handle = self.subscribers[handle]
+        for frame in self.__writers[server_handle]:
+            handle.write(frame)
+        self.__writers[server_handle] = handle
+
+    def unsubscribe(self, handle):
+        index, server_handle = self.subscribers.pop(handle, (None, None))
+        if index is not None:
+            del self.__writers[server_handle]
+            self.pipes[index % len(self.pipes)].send(('unsubscribe', index, server_handle))
+
+    async def relay_request(self, index, c, _args, handle=None):
+        """sends a command to a server and waits for its answer (None if the server raised LookupError)"""
+        request_id = next(self.__request_ids)
+        answer = self.__requests[request_id] = asyncio.get_running_loop().create_future()
+        self.pipes[index % len(self.pipes)].send(('request', index, request_id, c, _args, handle))
+        return await answer
+
+    def __relay(self, message):
+        """deals with an answer or a broadcast received from a server"""
+        kind, *message = message
+        if kind == 'answer':
+            request_id, answer = message
+            self.__requests.pop(request_id).set_result(answer)
+        elif kind == 'broadcast':
+            handles, message = message
+            frame = snekpi.encode_frame(message)
+            for handle in handles:
+                writer = self.__writers.get(handle)
+                if isinstance(writer, list):
+                    writer.append(frame)
+                elif writer is None:
+                    continue
+                elif writer.transport.get_write_buffer_size() <= self.SUBSCRIBER_BUFFER:
+                    writer.write(frame)
+                else:  # the ticks it misses can't be merged here, so a lagging subscriber is dropped right away
+                    writer.transport.abort()
+                    self.unsubscribe(writer)
+        elif kind == 'removed':
+            self.player_removed(*message)
+
+
+class RoomsServer(RelayServer):
+    """
+    Front server hosting many rooms, each one with its own snek engine, distributed across worker processes.
+    It accepts connections like AsyncTCPServer and relays each command to the room of the player (found by hash_id),
+    relaying back the answer and the updates pushed to subscribers. Registrations are sent to the rooms in turn
+    (skipping the rooms that refuse them), while commands without hash_id (e.g. infos and spectators) go to the first
+    room. The rooms report the players they remove (see Server.player_removed), which self.player_rooms then forgets.
+    engine_factories is a list with a callable for each room that creates its engine inside the worker,
+    and room_class the RoomServer subclass of the rooms; both are sent to the worker processes, so they must be
+    picklable.
+    It exposes:
+    self.address, self.max_connections, self.rooms, self.workers and self.player_rooms attributes,
+    and self.route(c, _args) method, which can be overloaded to route commands to the rooms differently.
+    """
+
+    def __init__(self, address, engine_factories, room_class=RoomServer, workers=None, max_connections=5):
+        super().__init__(address, max_connections)
+        self.rooms = [(room_class, engine_factory) for engine_factory in engine_factories]
+        self.workers = min(workers or os.cpu_count() or 1, len(self.rooms))
+        self.player_rooms = {}
+        self.__next_room = 0
+
+    async def loop(self):
+        """starts the worker processes and serves the players until cancelled"""
+        processes = []
+        for worker in range(self.workers):
+            connection, worker_connection = multiprocessing.Pipe()
+            rooms = {index: room for index, room in enumerate(self.rooms) if index % self.workers == worker}
+            process = multiprocessing.Process(target=serve_rooms, args=(worker_connection, rooms), daemon=True)
+            process.start()
+            worker_connection.close()
+            processes.append(process)
+            self.pipes.append(connection)
+
+        try:
+            await self.relay_loop()
+        finally:
+            for process in processes:
+                process.join(1)
+                if process.is_alive():
+                    process.terminate()
+
+    def route(self, c, _args):
+        """the index of the room command c with arguments _args is sent to"""
+        if c in {1, 4, 6, 255} or (c in {3, 5, 254} and _args):
+            return self.player_rooms[_args[:8]]
+        return 0
+
+    def player_removed(self, hash_id):
+        self.player_rooms.pop(hash_id, None)
+
+    async def answer(self, writer, c, _args):
+        if c == 0:
+            return await self.__register(_args)
+        try:
+            return await super().answer(writer, c, _args)
+        except LookupError:  # the room doesn't know the player (anymore)
+            self.player_rooms.pop(_args[:8], None)
+            raise
+
+    async def __register(self, _args):
+        """sends a registration to the rooms in turn, until one of them accepts it"""
+        for _ in range(len(self.rooms)):
+            room = self.__next_room
+            self.__next_room = (room + 1) % len(self.rooms)
+            hash_id = await self.relay_request(room, 0, _args)
+            if hash_id:
+                self.player_rooms[hash_id] = room
+                return hash_id
+        return b''
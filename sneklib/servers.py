@@ -1,16 +1,39 @@
 import asyncio
+import time
+from dataclasses import make_dataclass
 
+from sneklib import snekpi
 from sneklib.basetypes import Server
+from sneklib.timers import TimerWheel
 
 
-class AsyncTCPServer(Server):
+class TCPConnections:
     """
-    Server implementation using TCP and asyncio.
-    If using this implementation address should be a tuple containing:
+    Connection handling of AsyncTCPServer, which doesn't need a snek engine, so that it is shared with the servers
+    relaying the commands to other processes (see rooms.RelayServer).
+    address should be a tuple containing:
     a string with the IP address of the server as first element;
     a integer with the IP address if the server as second element.
+    Clients can either send one command per connection,
+    or send snekpi.FRAMED first and then any number of length-prefixed commands over the same connection.
+    A framed connection that subscribes (command 5) only receives the updates pushed after each tick from then on.
+    Connections beyond MAX_OPEN_CONNECTIONS are closed right away, and so are connections sending a request longer than
+    MAX_REQUEST bytes, taking more than READ_TIMEOUT seconds to send a request (or staying idle for KICK_TIME seconds
+    between framed requests), or more than WRITE_TIMEOUT seconds to receive an answer.
+    Classes using it have self.address, self.max_connections and self.connections attributes and a KICK_TIME constant,
+    and define self.answer(writer, c, _args) (asynchronous), self.subscribe(handle, _args) and self.unsubscribe(handle).
+    It exposes:
+    MAX_OPEN_CONNECTIONS, MAX_REQUEST, READ_TIMEOUT, WRITE_TIMEOUT and SUBSCRIBER_BUFFER constants,
+    self.dispatch(reader, writer), self.dispatch_frames(reader, writer) and self.serve_subscriber(reader, writer, _args)
+    asynchronous methods.
     """
 
+    MAX_OPEN_CONNECTIONS = 4096
+    MAX_REQUEST = 4096
+    READ_TIMEOUT = 10
+    WRITE_TIMEOUT = 10
+    SUBSCRIBER_BUFFER = 256 * 1024
+
     async def server_loop(self):
         server = await asyncio.start_server(self.dispatch, self.address[0], self.address[1],
                                             backlog=self.max_connections)
@@ -18,13 +41,209 @@ class AsyncTCPServer(Server):
             await server.serve_forever()
 
     async def dispatch(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-        c = (await reader.readexactly(1))[0]
-        _args = await reader.read()  # is it safe to read any amount of bytes?
+        if self.connections >= self.MAX_OPEN_CONNECTIONS:
+            writer.transport.abort()
+            return
+        self.connections += 1
+        try:
+            c = (await asyncio.wait_for(reader.readexactly(1), self.READ_TIMEOUT))[0]
+            if c == snekpi.FRAMED[0]:
+                await self.dispatch_frames(reader, writer)
+            else:
+                _args = await asyncio.wait_for(self.__read_until_eof(reader), self.READ_TIMEOUT)
+
+                answer = await self.answer(writer, c, _args)
+
+                writer.write(answer)
+                await asyncio.wait_for(writer.drain(), self.WRITE_TIMEOUT)
+
+            writer.close()
+            await asyncio.wait_for(writer.wait_closed(), self.WRITE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.transport.abort()  # slow, oversized or broken: drop whatever is still buffered
+        finally:
+            self.connections -= 1
+
+    async def dispatch_frames(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """serves length-prefixed commands over the same connection until the client closes it"""
+        while 1:
+            try:
+                header = await asyncio.wait_for(reader.readexactly(4), self.KICK_TIME)
+                length = snekpi.decode_frame_header(header)
+                if length > self.MAX_REQUEST:
+                    raise asyncio.LimitOverrunError(f'request too long: {length} bytes', 0)
+                request = await asyncio.wait_for(reader.readexactly(length), self.READ_TIMEOUT)
+            except asyncio.IncompleteReadError:
+                return
+
+            answer = b''
+            if request:  # an empty request gets an empty answer
+                try:
+                    answer = await self.answer(writer, request[0], request[1:])
+                except LookupError:  # unknown command or unknown player
+                    pass
+
+            writer.write(snekpi.encode_frame(answer))
+            await asyncio.wait_for(writer.drain(), self.WRITE_TIMEOUT)
+
+            if request[:1] == b'\x05' and answer:
+                await self.serve_subscriber(reader, writer, request[1:])
+                return
+
+    async def serve_subscriber(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, _args):
+        """keeps writer subscribed until the client closes the connection"""
+        self.subscribe(writer, _args)
+        try:
+            while await reader.read(4096):
+                pass  # nothing is expected from subscribers
+        except ConnectionError:
+            pass
+        finally:
+            self.unsubscribe(writer)
+
+    async def __read_until_eof(self, reader):
+        """reads a request until the end of the stream, raising LimitOverrunError if it is longer than MAX_REQUEST"""
+        res = await reader.read(self.MAX_REQUEST + 1)
+        while res and len(res) <= self.MAX_REQUEST:
+            chunk = await reader.read(self.MAX_REQUEST + 1 - len(res))
+            if not chunk:
+                break
+            res += chunk
+        if len(res) > self.MAX_REQUEST:
+            raise asyncio.LimitOverrunError(f'request too long: more than {self.MAX_REQUEST} bytes', len(res))
+        return res
+
+
+class AsyncTCPServer(TCPConnections, Server):
+    """
+    Server implementation using TCP and asyncio, accepting connections as described in TCPConnections.
+    If using this implementation address should be a tuple containing:
+    a string with the IP address of the server as first element;
+    a integer with the IP address if the server as second element.
+    The updates of a subscriber with more than SUBSCRIBER_BUFFER bytes still to be sent are held back, and sent merged
+    into a single update once it has received half of them (see Server.updates_since); a subscriber that doesn't get
+    there within WRITE_TIMEOUT seconds (or before the ticks it missed leave the history) is disconnected.
+    """
+
+    def __init__(self, address, engine, max_connections=5, viewport=None):
+        super().__init__(address, engine, max_connections, viewport)
+        self.__lagging = {}  # writer: (last tick sent, time the updates started being held back)
+
+    async def answer(self, writer: asyncio.StreamWriter, c, _args):
+        """answers command c with arguments _args received from writer"""
+        return self.deal_with_request(c, _args)
+
+    def unsubscribe(self, handle):
+        super().unsubscribe(handle)
+        self.__lagging.pop(handle, None)
+
+    def broadcast(self, message, version=1):
+        frame = snekpi.encode_frame(message)
+        now = time.time()
+        for writer, player in list(self.subscribers.items()):
+            if (player.version if player else 1) != version:
+                continue
+            buffered = writer.transport.get_write_buffer_size()
+            lagging = self.__lagging.get(writer)
+            if lagging is None:
+                if buffered <= self.SUBSCRIBER_BUFFER:
+                    writer.write(frame)
+                    continue
+                lagging = self.__lagging[writer] = self.tick - 1, now  # this tick is the first one held back
+            tick, since = lagging
+            if buffered <= self.SUBSCRIBER_BUFFER // 2:
+                message = self.updates_since(tick, version)
+                if message is not None:
+                    writer.write(snekpi.encode_frame(message))
+                    del self.__lagging[writer]
+                    continue
+            elif now - since <= self.WRITE_TIMEOUT and self.tick - tick < self.HISTORY:
+                continue
+            writer.transport.abort()  # the subscriber gets unsubscribed by serve_subscriber
+            self.unsubscribe(writer)
+
+
+Peer = make_dataclass('Peer', [('sequence', int), ('answer', bytes), ('last', float)], slots=True)
+
+
+class AsyncUDPServer(Server, asyncio.DatagramProtocol):
+    """
+    Server implementation using UDP and asyncio.
+    If using this implementation address should be a tuple like the one of AsyncTCPServer.
+    Each datagram sent by a client carries a sequence number followed by a command (see snekpi.encode_datagram),
+    and is answered with a datagram carrying the same sequence number; a request that is sent again with the same
+    sequence number gets the same answer, and requests older than the last one are dropped.
+    A client that subscribes (command 5) can keep sending commands, and receives the updates pushed after each tick
+    with sequence number 0; clients report a lost update by subscribing again, which answers with a full state.
+    Clients that don't send anything (an empty message keeps them alive) for KICK_TIME seconds are forgotten.
+    Answers that don't fit in a datagram of MAX_DATAGRAM bytes are refused (answered with an empty answer), and updates
+    that don't fit are not pushed (so subscribers find out they missed them); both are counted in self.metrics as
+    oversized_datagrams_total.
+    """
+
+    MAX_DATAGRAM = 65507  # the largest payload of a UDP datagram over IPv4
+
+    def __init__(self, address, engine, max_connections=5, viewport=None):
+        super().__init__(address, engine, max_connections, viewport)
+        self.transport = None
+        self.peers = {}
+        self.__expiries = TimerWheel(self.EXPIRY_RESOLUTION)
+
+    async def server_loop(self):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=self.address)
+        try:
+            await loop.create_future()  # serve forever
+        finally:
+            self.transport.close()
+
+    def datagram_received(self, data, addr):
+        if len(data) < 4:
+            return
+        sequence, request = snekpi.decode_datagram(data)
+
+        peer = self.peers.get(addr)
+        if peer is None:
+            peer = self.peers[addr] = Peer(0, b'', 0)
+            self.connections = len(self.peers)
+            self.__expiries.schedule((addr, peer), time.time() + self.KICK_TIME)
+        peer.last = time.time()
+
+        if not request or sequence < peer.sequence:  # keep alive or old request
+            return
+        if sequence > peer.sequence:
+            try:
+                answer = self.deal_with_request(request[0], request[1:])
+            except LookupError:  # unknown command or unknown player
+                answer = b''
+            if len(answer) + 4 > self.MAX_DATAGRAM:  # it would be lost on the way, so the client is told instead
+                self.metrics.count('oversized_datagrams_total', command=request[0])
+                answer = b''
+            peer.sequence, peer.answer = sequence, answer
+
+            if request[0] == 5 and answer:
+                self.subscribe(addr, request[1:])
 
-        answer = self.deal_with_request(c, _args)
+        self.transport.sendto(snekpi.encode_datagram(sequence, peer.answer), addr)
 
-        writer.write(answer)
-        await writer.drain()
+    def update(self, sneks, new_sneks, kinds, new_of_kinds):
+        now = time.time()
+        for addr, peer in self.__expiries.pop_due(now):
+            if self.peers.get(addr) is not peer:
+                continue
+            if now - peer.last > self.KICK_TIME:
+                del self.peers[addr]
+                self.unsubscribe(addr)
+            else:
+                self.__expiries.schedule((addr, peer), peer.last + self.KICK_TIME)
+        self.connections = len(self.peers)
+        super().update(sneks, new_sneks, kinds, new_of_kinds)
 
-        writer.close()
-        await writer.wait_closed()
+    def broadcast(self, message, version=1):
+        datagram = snekpi.encode_datagram(0, message)
+        if len(datagram) > self.MAX_DATAGRAM:
+            self.metrics.count('oversized_datagrams_total', command=5)
+            return
+        for addr, player in self.subscribers.items():
+            if (player.version if player else 1) == version:
+                self.transport.sendto(datagram, addr)
@@ -1,4 +1,34 @@
 import json
+import sys
+from array import array
+from itertools import chain
+
+try:
+    import numpy
+except ImportError:  # numpy is optional, it is only needed for the *_array functions
+    numpy = None
+
+FRAMED = b'\xfd'  # first byte sent by a client to switch its connection to framed mode
+
+
+def encode_frame(message):
+    """prefixes message with its length, so that many messages can be sent over the same connection"""
+    return len(message).to_bytes(4, 'big') + message
+
+
+def decode_frame_header(header):
+    """decodes the length of the message following a frame header"""
+    return int.from_bytes(header, 'big')
+
+
+def encode_datagram(sequence, message):
+    """prefixes message with a sequence number, so that answers sent over datagrams can be matched to their requests"""
+    return sequence.to_bytes(4, 'big') + message
+
+
+def decode_datagram(datagram):
+    """decodes the sequence number and the message of a datagram"""
+    return int.from_bytes(datagram[:4], 'big'), datagram[4:]
 
 
 def encode_json(serializable):
@@ -8,35 +38,42 @@ def encode_json(serializable):
     return data_len + data
 
 
-def encode_snek_metadata(snek):
-    """encodes alive and data attributes of a snek"""
-    alive = int(snek.alive).to_bytes(1, 'big')
+def encode_tick(tick):
+    """encodes the number of a tick"""
+    return tick.to_bytes(4, 'big')
+
+
+def encode_snek_metadata(snek, alive=None):
+    """encodes alive and data attributes of a snek (alive can be overridden)"""
+    alive = int(snek.alive if alive is None else alive).to_bytes(1, 'big')
     data = encode_json(snek.data)
     return alive + data
 
 
+def pack_blocks(blocks):
+    """encodes the coordinates of blocks (a sequence of blocks or a (n, 2) numpy array) in one pass"""
+    if numpy is not None and isinstance(blocks, numpy.ndarray):
+        return blocks.astype('>u2', copy=False).tobytes()
+    coordinates = array('H', chain.from_iterable(blocks))
+    if sys.byteorder == 'little':
+        coordinates.byteswap()
+    return coordinates.tobytes()
+
+
 def encode_blocks(new_blocks, old_blocks):
     """encodes new_blocks and old_blocks"""
-    res = b''
-
     new_blocks_len = len(new_blocks).to_bytes(4, 'big')
     old_blocks_len = len(old_blocks).to_bytes(4, 'big')
-    res += new_blocks_len + old_blocks_len
 
-    for x, y in new_blocks:
-        res += x.to_bytes(2, 'big') + y.to_bytes(2, 'big')
-    for x, y in old_blocks:
-        res += x.to_bytes(2, 'big') + y.to_bytes(2, 'big')
-
-    return res
+    return new_blocks_len + old_blocks_len + pack_blocks(new_blocks) + pack_blocks(old_blocks)
 
 
-def encode_partial_snek(snek, new_blocks, old_blocks):
+def encode_partial_snek(snek, new_blocks, old_blocks, alive=None):
     """
-    encodes a snek, using data and alive from the snek itself,
+    encodes a snek, using data and alive from the snek itself (unless alive is given),
     but using new_blocks and old blocks from the arguments passed to the function
     """
-    res = encode_snek_metadata(snek)
+    res = encode_snek_metadata(snek, alive)
     res += encode_blocks(new_blocks, old_blocks)
     return res
 
@@ -52,12 +89,8 @@ def encode_partial_list(obj_news_olds):
     Parameter is a sequence, each element of which is a tuple containing
     1. snek, 2. new_blocks, 3. old_blocks.
     """
-    res = b''
-    obj_len = 0
-    for snek_like_object, news, olds in obj_news_olds:
-        res += encode_partial_snek(snek_like_object, news, olds)
-        obj_len += 1
-    return obj_len.to_bytes(4, 'big') + res
+    res = [encode_partial_snek(snek_like_object, news, olds) for snek_like_object, news, olds in obj_news_olds]
+    return len(res).to_bytes(4, 'big') + b''.join(res)
 
 
 def encode_whole_list(objs):
@@ -65,71 +98,432 @@ def encode_whole_list(objs):
     return encode_partial_list(((obj, obj.whole, []) for obj in objs))
 
 
+def decode_tick(message):
+    """decodes the number of a tick"""
+    tick, offset = read_tick(message)
+    return tick, message[offset:]
+
+
 def decode_json(message):
     """decodes a json message"""
-    data_len = int.from_bytes(message[:2], 'big')
-    data = json.loads(message[2:data_len + 2].decode('ascii'))
-    return data, message[data_len + 2:]
+    data, offset = read_json(message)
+    return data, message[offset:]
+
+
+def unpack_blocks(message, blocks_len):
+    """decodes blocks_len blocks from the start of message in one pass"""
+    coordinates = array('H')
+    coordinates.frombytes(message[:4 * blocks_len])
+    if sys.byteorder == 'little':
+        coordinates.byteswap()
+    it = iter(coordinates)
+    return list(zip(it, it))
 
 
 def decode_blocks(message):
     """decodes old and new blocks"""
-    new_blocks_len = int.from_bytes(message[:4], 'big')
-    old_blocks_len = int.from_bytes(message[4:8], 'big')
-    message = message[8:]
+    new_blocks, old_blocks, offset = read_blocks(message)
+    return new_blocks, old_blocks, message[offset:]
 
-    new_blocks = []
-    old_blocks = []
 
-    for i in range(new_blocks_len):
-        x = int.from_bytes(message[:2], 'big')
-        y = int.from_bytes(message[2:4], 'big')
-        message = message[4:]
-        new_blocks.append((x, y))
+def decode_blocks_array(message):
+    """decodes old and new blocks as two (n, 2) numpy arrays of uint16, without building a tuple per block"""
+    new_blocks_len = int.from_bytes(message[:4], 'big')
+    old_blocks_len = int.from_bytes(message[4:8], 'big')
+    end = 8 + 4 * (new_blocks_len + old_blocks_len)
 
-    for i in range(old_blocks_len):
-        x = int.from_bytes(message[:2], 'big')
-        y = int.from_bytes(message[2:4], 'big')
-        message = message[4:]
-        old_blocks.append((x, y))
+    blocks = numpy.frombuffer(message, '>u2', 2 * (new_blocks_len + old_blocks_len), 8).astype(numpy.uint16)
+    blocks = blocks.reshape(-1, 2)
 
-    return new_blocks, old_blocks, message
+    return blocks[:new_blocks_len], blocks[new_blocks_len:], message[end:]
 
 
 def decode_snek(message):
     """decodes a snek"""
-    alive = bool(message[0])
-    message = message[1:]
+    snek, offset = read_snek(message)
+    return snek, message[offset:]
+
 
-    data, message = decode_json(message)
+def decode_list(message):
+    """decodes a list of sneks"""
+    snek_like_objects, offset = read_list(message)
+    return snek_like_objects, message[offset:]
 
-    new_blocks, old_blocks, message = decode_blocks(message)
 
-    return (alive, data, new_blocks, old_blocks), message
+def decode_message(message):
+    """decodes a message"""
+    message = memoryview(message)
 
+    player, offset = read_snek(message)
 
-def decode_list(message):
-    """decodes a list of sneks"""
-    snek_like_object_len = int.from_bytes(message[:4], 'big')
-    message = message[4:]
+    sneks, offset = read_list(message, offset)
+
+    kinds, offset = read_lists(message, offset)
+
+    return player, sneks, kinds
+
+
+def decode_lists(message):
+    """decodes lists of sneks until the end of the message"""
+    kinds, _ = read_lists(memoryview(message))
+    return kinds
+
+
+def decode_subscription(message):
+    """decodes the answer to a subscription"""
+    message = memoryview(message)
+
+    tick, offset = read_tick(message)
+
+    player, offset = read_snek(message, offset)
+
+    sneks, offset = read_list(message, offset)
+
+    kinds, offset = read_lists(message, offset)
+
+    return tick, player, sneks, kinds
+
+
+def decode_delta(message):
+    """decodes a message pushed to subscribers"""
+    message = memoryview(message)
+
+    tick, offset = read_tick(message)
+
+    sneks, offset = read_list(message, offset)
+
+    kinds, offset = read_lists(message, offset)
+
+    return tick, sneks, kinds
+
+
+# The read_* functions decode starting from offset and return the offset of what follows,
+# so that a message (better if wrapped in a memoryview) can be decoded without copying what is left of it.
+
+def read_tick(message, offset=0):
+    """reads the number of a tick"""
+    return int.from_bytes(message[offset:offset + 4], 'big'), offset + 4
+
+
+def read_json(message, offset=0):
+    """reads a json message"""
+    start = offset + 2
+    end = start + int.from_bytes(message[offset:start], 'big')
+    data = json.loads(str(message[start:end], 'ascii'))
+    return data, end
+
+
+def read_blocks(message, offset=0):
+    """reads old and new blocks"""
+    new_blocks_len = int.from_bytes(message[offset:offset + 4], 'big')
+    old_blocks_len = int.from_bytes(message[offset + 4:offset + 8], 'big')
+    start = offset + 8
+    end = start + 4 * (new_blocks_len + old_blocks_len)
+
+    blocks = unpack_blocks(message[start:end], new_blocks_len + old_blocks_len)
+
+    return blocks[:new_blocks_len], blocks[new_blocks_len:], end
+
+
+def read_snek(message, offset=0):
+    """reads a snek"""
+    alive = bool(message[offset])
+
+    data, offset = read_json(message, offset + 1)
+
+    new_blocks, old_blocks, offset = read_blocks(message, offset)
+
+    return (alive, data, new_blocks, old_blocks), offset
+
+
+def read_list(message, offset=0):
+    """reads a list of sneks"""
+    snek_like_object_len = int.from_bytes(message[offset:offset + 4], 'big')
+    offset += 4
 
     snek_like_objects = []
     for i in range(snek_like_object_len):
-        snek_like_object, message = decode_snek(message)
+        snek_like_object, offset = read_snek(message, offset)
         snek_like_objects.append(snek_like_object)
 
-    return snek_like_objects, message
+    return snek_like_objects, offset
 
 
-def decode_message(message):
-    """decodes a message"""
-    player, message = decode_snek(message)
+def read_lists(message, offset=0):
+    """reads lists of sneks until the end of the message"""
+    kinds = []
+    while offset < len(message):
+        sneks_like_objects, offset = read_list(message, offset)
+        kinds.append(sneks_like_objects)
+
+    return kinds, offset
+
+
+def snek_end(message, offset=0):
+    """offset at which the snek starting at offset ends, or None if message is too short to tell"""
+    blocks = offset + 3
+    if len(message) < blocks:
+        return None
+    blocks += int.from_bytes(message[offset + 1:blocks], 'big')
+    if len(message) < blocks + 8:
+        return None
+    new_blocks_len = int.from_bytes(message[blocks:blocks + 4], 'big')
+    old_blocks_len = int.from_bytes(message[blocks + 4:blocks + 8], 'big')
+    return blocks + 8 + 4 * (new_blocks_len + old_blocks_len)
+
+
+class StreamDecoder:
+    """
+    Decodes a message (formatted as the answers to commands 3 and 4) while its chunks arrive, e.g. from a socket.
+    Chunks are appended to a bytearray with self.feed(chunk), which decodes every complete object and drops its bytes;
+    once the whole message has been fed, self.result() returns the same as decode_message.
+    With tick=True it decodes messages starting with a tick instead (answers to command 5 and pushed messages),
+    and with player=False messages without the player (pushed messages).
+    """
+
+    def __init__(self, tick=False, player=True):
+        self.buffer = bytearray()
+        self.tick = None if tick else False
+        self.player = None if player else False
+        self.lists = []
+        self.left = 0  # objects left in the last list
+
+    def feed(self, chunk):
+        """appends chunk to the message and decodes what can be decoded"""
+        self.buffer += chunk
+        with memoryview(self.buffer) as message:
+            offset = self.__decode(message)
+        del self.buffer[:offset]
+
+    def __decode(self, message):
+        """decodes as many objects as possible from message, returns the offset of what is left"""
+        offset = 0
+        if self.tick is None:
+            if len(message) < 4:
+                return offset
+            self.tick, offset = read_tick(message)
+        if self.player is None:
+            end = snek_end(message, offset)
+            if end is None or len(message) < end:
+                return offset
+            self.player, offset = read_snek(message, offset)
+        while 1:
+            if not self.left:
+                if len(message) < offset + 4:
+                    return offset
+                self.left = int.from_bytes(message[offset:offset + 4], 'big')
+                self.lists.append([])
+                offset += 4
+                continue
+            end = snek_end(message, offset)
+            if end is None or len(message) < end:
+                return offset
+            snek_like_object, offset = read_snek(message, offset)
+            self.lists[-1].append(snek_like_object)
+            self.left -= 1
+
+    def result(self):
+        """the decoded message; raises ValueError if the message fed so far is incomplete"""
+        if self.buffer or self.left or self.tick is None or self.player is None or not self.lists:
+            raise ValueError('incomplete message')
+        res = (self.lists[0], self.lists[1:])
+        if self.player is not False:
+            res = (self.player,) + res
+        if self.tick is not False:
+            res = (self.tick,) + res
+        return res
+
+
+# Version 2 of the encoding, negotiated by each player with command 6.
+# Numbers are varints, blocks lists that are paths are encoded as first block plus a 2-bit step for each other block,
+# and the data of an object is only sent when flagged, e.g. when the object is new or its data has changed.
+
+STEPS = ((0, -1), (-1, 0), (0, 1), (1, 0))
+STEP_CODES = {step: code for code, step in enumerate(STEPS)}
+
+
+def encode_varint(number):
+    """encodes an unsigned integer 7 bits per byte, least significant first"""
+    res = bytearray()
+    while number > 0x7f:
+        res.append(number & 0x7f | 0x80)
+        number >>= 7
+    res.append(number)
+    return bytes(res)
+
+
+def encode_block_list_v2(blocks):
+    """encodes a list of blocks, as a path of steps if each block is next to the previous one"""
+    blocks = list(blocks)
+    codes = []
+    for (x0, y0), (x1, y1) in zip(blocks, blocks[1:]):
+        code = STEP_CODES.get((x1 - x0, y1 - y0))
+        if code is None:
+            break
+        codes.append(code)
+    else:
+        if len(blocks) > 2:
+            res = bytearray(encode_varint(len(blocks) << 1 | 1))
+            res += encode_varint(blocks[0][0]) + encode_varint(blocks[0][1])
+            for i in range(0, len(codes), 4):
+                byte = 0
+                for j, code in enumerate(codes[i:i + 4]):
+                    byte |= code << 2 * j
+                res.append(byte)
+            return bytes(res)
+
+    res = [encode_varint(len(blocks) << 1)]
+    for x, y in blocks:
+        res.append(encode_varint(x))
+        res.append(encode_varint(y))
+    return b''.join(res)
+
+
+def encode_partial_snek_v2(snek, new_blocks, old_blocks, with_data=True, alive=None):
+    """encodes a snek like encode_partial_snek, but only encodes its data if with_data is true"""
+    alive = snek.alive if alive is None else alive
+    res = bytes((int(bool(alive)) | int(with_data) << 1,))
+    if with_data:
+        data = json.dumps(snek.data).encode('ascii')
+        res += encode_varint(len(data)) + data
+    return res + encode_block_list_v2(new_blocks) + encode_block_list_v2(old_blocks)
+
+
+def encode_whole_snek_v2(snek):
+    """encodes a snek with its data"""
+    return encode_partial_snek_v2(snek, snek.whole, [])
+
+
+def encode_partial_list_v2(obj_news_olds, changed=None):
+    """
+    Encodes a sequence of (snek, new_blocks, old_blocks) tuples.
+    The data of each snek is only encoded if the snek is in changed (or if changed is None).
+    """
+    res = [encode_partial_snek_v2(obj, news, olds, changed is None or obj in changed)
+           for obj, news, olds in obj_news_olds]
+    return encode_varint(len(res)) + b''.join(res)
+
+
+def encode_unchanged_list_v2(count):
+    """encodes a list of count objects alive and without changes (neither blocks nor data), as encode_partial_list_v2"""
+    return encode_varint(count) + b'\x01\x00\x00' * count
+
+
+def encode_whole_list_v2(objs):
+    """encodes a list of sneks with their data"""
+    return encode_partial_list_v2((obj, obj.whole, []) for obj in objs)
+
+
+def read_varint(message, offset=0):
+    """reads an unsigned integer encoded with encode_varint"""
+    number = 0
+    shift = 0
+    while 1:
+        byte = message[offset]
+        offset += 1
+        number |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return number, offset
+        shift += 7
+
+
+def read_block_list_v2(message, offset=0):
+    """reads a list of blocks encoded with encode_block_list_v2"""
+    header, offset = read_varint(message, offset)
+    blocks_len = header >> 1
+    blocks = []
+    if header & 1:
+        x, offset = read_varint(message, offset)
+        y, offset = read_varint(message, offset)
+        blocks.append((x, y))
+        for i in range(blocks_len - 1):
+            dx, dy = STEPS[message[offset + i // 4] >> 2 * (i % 4) & 3]
+            x += dx
+            y += dy
+            blocks.append((x, y))
+        offset += (blocks_len + 2) // 4
+    else:
+        for i in range(blocks_len):
+            x, offset = read_varint(message, offset)
+            y, offset = read_varint(message, offset)
+            blocks.append((x, y))
+    return blocks, offset
+
+
+def read_snek_v2(message, offset=0):
+    """reads a snek encoded with encode_partial_snek_v2; data is None if it wasn't sent"""
+    flags = message[offset]
+    offset += 1
+    data = None
+    if flags & 2:
+        data_len, offset = read_varint(message, offset)
+        data = json.loads(str(message[offset:offset + data_len], 'ascii'))
+        offset += data_len
+
+    new_blocks, offset = read_block_list_v2(message, offset)
+    old_blocks, offset = read_block_list_v2(message, offset)
+
+    return (bool(flags & 1), data, new_blocks, old_blocks), offset
+
+
+def read_list_v2(message, offset=0):
+    """reads a list of sneks encoded with encode_partial_list_v2"""
+    snek_like_object_len, offset = read_varint(message, offset)
+
+    snek_like_objects = []
+    for i in range(snek_like_object_len):
+        snek_like_object, offset = read_snek_v2(message, offset)
+        snek_like_objects.append(snek_like_object)
+
+    return snek_like_objects, offset
 
-    sneks, message = decode_list(message)
 
+def read_lists_v2(message, offset=0):
+    """reads lists of sneks until the end of the message"""
     kinds = []
-    while message:
-        sneks_like_objects, message = decode_list(message)
+    while offset < len(message):
+        sneks_like_objects, offset = read_list_v2(message, offset)
         kinds.append(sneks_like_objects)
 
+    return kinds, offset
+
+
+def decode_message_v2(message):
+    """decodes a message encoded with version 2"""
+    message = memoryview(message)
+
+    player, offset = read_snek_v2(message)
+
+    sneks, offset = read_list_v2(message, offset)
+
+    kinds, offset = read_lists_v2(message, offset)
+
     return player, sneks, kinds
+
+
+def decode_subscription_v2(message):
+    """decodes the answer to a subscription encoded with version 2"""
+    message = memoryview(message)
+
+    tick, offset = read_varint(message)
+
+    player, offset = read_snek_v2(message, offset)
+
+    sneks, offset = read_list_v2(message, offset)
+
+    kinds, offset = read_lists_v2(message, offset)
+
+    return tick, player, sneks, kinds
+
+
+def decode_delta_v2(message):
+    """decodes a message pushed to subscribers encoded with version 2"""
+    message = memoryview(message)
+
+    tick, offset = read_varint(message)
+
+    sneks, offset = read_list_v2(message, offset)
+
+    kinds, offset = read_lists_v2(message, offset)
+
+    return tick, sneks, kinds
@@ -0,0 +1,192 @@
+import random
+from array import array
+
+
+class Occupancy:
+    """
+    Index of the blocks occupied by the objects of a snek engine.
+    It maps each occupied block to the list of objects whose whole contains that block,
+    so that checking what is on a block costs O(1) instead of scanning every object.
+    on_occupied(block) and on_freed(block) are called whenever a block becomes occupied or free,
+    and self.changes counts the calls to add and remove,
+    so that views built from the blocks can tell when they are stale.
+    It exposes:
+    self.cells and self.changes attributes,
+    self.add(obj, blocks), self.remove(obj, blocks), self.clear(), self.owners(block) and self.apply(...) methods.
+    """
+
+    def __init__(self, on_occupied=None, on_freed=None):
+        self.cells = {}
+        self.changes = 0
+        self.on_occupied = on_occupied
+        self.on_freed = on_freed
+
+    def add(self, obj, blocks):
+        """marks blocks as occupied by obj"""
+        self.changes += 1
+        cells = self.cells
+        for block in blocks:
+            owners = cells.get(block)
+            if owners is None:
+                cells[block] = [obj]
+                if self.on_occupied is not None:
+                    self.on_occupied(block)
+            else:
+                owners.append(obj)
+
+    def remove(self, obj, blocks):
+        """marks blocks as no longer occupied by obj"""
+        self.changes += 1
+        cells = self.cells
+        for block in blocks:
+            owners = cells.get(block)
+            if owners is None or obj not in owners:
+                continue
+            owners.remove(obj)
+            if not owners:
+                del cells[block]
+                if self.on_freed is not None:
+                    self.on_freed(block)
+
+    def clear(self):
+        """removes every object, calling on_freed for each block"""
+        self.changes += 1
+        cells, self.cells = self.cells, {}
+        if self.on_freed is not None:
+            for block in cells:
+                self.on_freed(block)
+
+    def owners(self, block):
+        """objects occupying block"""
+        return self.cells.get(block, ())
+
+    def apply(self, sneks, new_sneks, kinds, new_of_kinds):
+        """updates the index with the news and olds yielded by a snek engine for one tick"""
+        for obj, (news, olds) in sneks.items():
+            self.add(obj, news)
+            self.remove(obj, olds)
+        for obj, (news, olds) in new_sneks.items():
+            self.add(obj, news)
+            self.remove(obj, olds)
+        for elements in kinds.values():
+            for obj, (news, olds) in elements.items():
+                self.add(obj, news)
+                self.remove(obj, olds)
+        for elements in new_of_kinds.values():
+            for obj, (news, olds) in elements.items():
+                self.add(obj, news)
+                self.remove(obj, olds)
+
+    def __contains__(self, block):
+        return block in self.cells
+
+    def __len__(self):
+        return len(self.cells)
+
+
+class Buckets:
+    """
+    Index of objects by the square buckets of size x size blocks that their blocks fall into,
+    so that finding the objects inside a window of the board only looks at the buckets the window overlaps,
+    instead of scanning every object or every block of the window.
+    It exposes:
+    self.size, self.buckets and self.objects attributes,
+    self.add(obj, blocks), self.remove(obj, blocks), self.discard(obj) and self.query(x0, y0, x1, y1) methods.
+    """
+
+    def __init__(self, size=16):
+        self.size = size
+        self.buckets = {}  # bucket: objects with blocks inside it
+        self.objects = {}  # object: number of its blocks inside each bucket
+
+    def add(self, obj, blocks):
+        """adds blocks to the blocks of obj"""
+        size = self.size
+        counts = self.objects.setdefault(obj, {})
+        for x, y in blocks:
+            bucket = (x // size, y // size)
+            count = counts.get(bucket, 0)
+            if not count:
+                self.buckets.setdefault(bucket, set()).add(obj)
+            counts[bucket] = count + 1
+
+    def remove(self, obj, blocks):
+        """removes blocks from the blocks of obj"""
+        size = self.size
+        counts = self.objects.get(obj)
+        if counts is None:
+            return
+        for x, y in blocks:
+            bucket = (x // size, y // size)
+            count = counts.get(bucket, 0) - 1
+            if count > 0:
+                counts[bucket] = count
+            elif count == 0:
+                del counts[bucket]
+                self.__leave(obj, bucket)
+
+    def discard(self, obj):
+        """removes obj with all of its blocks"""
+        for bucket in self.objects.pop(obj, ()):
+            self.__leave(obj, bucket)
+
+    def query(self, x0, y0, x1, y1):
+        """the objects with blocks in the buckets overlapping the window from (x0, y0) to (x1, y1) (included)"""
+        size = self.size
+        res = set()
+        for bucket_x in range(x0 // size, x1 // size + 1):
+            for bucket_y in range(y0 // size, y1 // size + 1):
+                res.update(self.buckets.get((bucket_x, bucket_y), ()))
+        return res
+
+    def __leave(self, obj, bucket):
+        objs = self.buckets[bucket]
+        objs.discard(obj)
+        if not objs:
+            del self.buckets[bucket]
+
+
+class FreeCells:
+    """
+    Set of integers in range(size) with O(1) add, discard, membership test and random choice.
+    Elements are kept in an array, together with the position of each element inside of it (-1 if missing),
+    so that discarding an element only swaps it with the last one.
+    It is meant to keep track of the free cells of a board, each cell being numbered as y * width + x.
+    """
+
+    def __init__(self, size, start=0, stop=None):
+        """the set has room for range(size) and starts out containing range(start, stop)"""
+        if stop is None:
+            stop = size
+        stop = max(start, stop)
+        self.cells = array('q', range(start, stop))
+        self.positions = array('q', [-1]) * start + array('q', range(stop - start)) + array('q', [-1]) * (size - stop)
+
+    def add(self, cell):
+        """adds cell to the set"""
+        if self.positions[cell] < 0:
+            self.positions[cell] = len(self.cells)
+            self.cells.append(cell)
+
+    def discard(self, cell):
+        """removes cell from the set if present"""
+        position = self.positions[cell]
+        if position < 0:
+            return
+        last = self.cells.pop()
+        if last != cell:
+            self.cells[position] = last
+            self.positions[last] = position
+        self.positions[cell] = -1
+
+    def choice(self):
+        """a random element of the set, raises IndexError if the set is empty"""
+        if not self.cells:
+            raise IndexError('choice from an empty set')
+        return self.cells[random.randrange(len(self.cells))]
+
+    def __contains__(self, cell):
+        return self.positions[cell] >= 0
+
+    def __len__(self):
+        return len(self.cells)
@@ -0,0 +1,42 @@
+import math
+
+
+class TimerWheel:
+    """
+    Items scheduled at a given time, grouped in slots of resolution seconds,
+    so that finding the items that are due costs O(due items) instead of checking every item.
+    The items of a slot are all returned as soon as the slot starts, so an item may be returned up to resolution seconds
+    early (and should be checked and scheduled again if it isn't actually due); items scheduled at a time whose slot
+    was already returned are returned with the next slot.
+    It exposes:
+    self.resolution and self.slots attributes,
+    self.schedule(item, when) and self.pop_due(now) methods.
+    """
+
+    def __init__(self, resolution=1.0):
+        self.resolution = resolution
+        self.slots = {}  # slot: items scheduled in it
+        self.__next = None  # first slot not returned yet
+
+    def schedule(self, item, when):
+        """schedules item at time when"""
+        slot = math.floor(when / self.resolution)
+        if self.__next is not None and slot < self.__next:
+            slot = self.__next
+        self.slots.setdefault(slot, []).append(item)
+
+    def pop_due(self, now):
+        """removes and returns the items of the slots started by now"""
+        last = math.floor(now / self.resolution)
+        if self.__next is None or last - self.__next > len(self.slots):  # fewer slots than slot numbers to look at
+            due = sorted(slot for slot in self.slots if slot <= last)
+        else:
+            due = [slot for slot in range(self.__next, last + 1) if slot in self.slots]
+        self.__next = last + 1
+        res = []
+        for slot in due:
+            res += self.slots.pop(slot)
+        return res
+
+    def __len__(self):
+        return sum(len(items) for items in self.slots.values())
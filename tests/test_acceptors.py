@@ -0,0 +1,54 @@
+import asyncio
+import multiprocessing
+import unittest
+
+from server import SnekEngine
+from sneklib import aiosnek
+from sneklib.acceptors import AcceptorsServer
+from tests import free_port
+
+
+class TestAcceptorsServer(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        engine = SnekEngine(width=21, height=21, max_food=0, game_tick=0.1)
+        self.server = AcceptorsServer(('127.0.0.1', free_port()), engine)
+        self.server.ACCEPTORS = 1
+        self.task = asyncio.create_task(self.server.server_loop())
+        self.addAsyncCleanup(self.stop)
+
+    async def stop(self):
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+
+    async def connect(self):
+        """a connection to the acceptor, once the spawned process listens"""
+        for _ in range(500):
+            connection = aiosnek.Connection(*self.server.address)
+            try:
+                await connection.open()
+                self.addAsyncCleanup(connection.close)
+                return connection
+            except ConnectionError:
+                await asyncio.sleep(0.02)
+        self.fail('the acceptor never started listening')
+
+    async def test_subscriber_is_removed_when_its_acceptor_stops(self):
+        connection = await self.connect()
+        hash_id = await connection.register('player')
+        self.assertIn(hash_id, self.server.players)
+        await connection.subscribe(hash_id)
+        (index, _), = self.server.subscribers
+        self.assertEqual(index, 0)
+
+        acceptor, = multiprocessing.active_children()
+        acceptor.terminate()
+        for _ in range(100):
+            if not self.server.subscribers:
+                break
+            await asyncio.sleep(0.02)
+        self.assertEqual(self.server.subscribers, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,239 @@
+import random
+import unittest
+from collections import Counter
+from unittest import mock
+
+from server import Snek, SnekEngine, Wall
+from sneklib import snekpi
+from sneklib import basetypes
+from sneklib.basetypes import Body, Server
+
+
+def apply_changes(blocks, news, olds):
+    """applies the news and olds of an object to its blocks, as a client would"""
+    blocks = Counter(blocks)
+    blocks.update(news)
+    blocks.subtract(olds)
+    return +blocks
+
+
+class TestBody(unittest.TestCase):
+
+    def test_behaves_like_a_list(self):
+        blocks = [(0, 0), (0, 1), (0, 2), (0, 1)]
+        body = Body(blocks)
+        self.assertEqual(len(body), 4)
+        self.assertEqual(list(body), blocks)
+        self.assertEqual(list(reversed(body)), blocks[::-1])
+        self.assertEqual((body[0], body[-1], body[1:-1]), (blocks[0], blocks[-1], blocks[1:-1]))
+        self.assertEqual(body + [(9, 9)], blocks + [(9, 9)])
+        self.assertEqual([(9, 9)] + body, [(9, 9)] + blocks)
+        self.assertEqual(body, blocks)
+        self.assertNotEqual(body, blocks[:-1])
+        self.assertEqual(body.count((0, 1)), 2)
+        self.assertNotIn((5, 5), body)
+
+    def test_push_and_pop(self):
+        """the counts follow the blocks that enter at the head and leave at the tail"""
+        random.seed(0)
+        body, blocks = Body([(0, 0)]), [(0, 0)]
+        for _ in range(500):
+            if len(blocks) > 1 and random.random() < 0.5:
+                self.assertEqual(body.pop(), blocks.pop())
+            else:
+                block = (random.randrange(4), random.randrange(4))
+                body.push(block)
+                blocks.insert(0, block)
+            self.assertEqual(body, blocks)
+            self.assertEqual(body.counts, dict(Counter(blocks)))
+
+    def test_snek_moves(self):
+        """a snek keeps its Body in sync with the blocks its moves add and remove, growing when told to"""
+        snek = Snek(direction='r', pos=(5, 5))
+        whole = list(snek.whole)
+        for direction, grow in zip('rrdlllu', [False, True, False, False, True, False, False]):
+            snek.dir, snek.will_grow = direction, grow
+            future_whole = snek.future_whole
+            news, olds = snek.move()
+            self.assertEqual(list(olds), [] if grow else whole[-1:])
+            whole = list(news) + (whole if grow else whole[:-1])
+            self.assertEqual(snek.whole, whole)
+            self.assertEqual(snek.whole, future_whole)
+            self.assertTrue(all(snek.covers(block) for block in whole[:-1]))
+
+
+class TestStateRequests(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        self.engine = SnekEngine(width=21, height=21, max_food=0, game_tick=0.1)
+        self.server = Server(None, self.engine)
+
+    def step(self):
+        self.server.update(*self.engine.tick())
+
+    def test_current_then_updated_state_in_the_joining_tick(self):
+        """the player's snek sent whole by command 3 is only moved by the following command 4"""
+        hash_id = self.server.deal_with_request(0, b'player')
+        snek = self.server.players[hash_id].snek
+        (alive, data, news, olds), _, _ = snekpi.decode_message(self.server.deal_with_request(3, hash_id))
+        board = apply_changes([], news, olds)
+
+        for _ in range(4):
+            self.step()
+            (alive, data, news, olds), _, _ = snekpi.decode_message(self.server.deal_with_request(4, hash_id))
+            board = apply_changes(board, news, olds)
+            self.assertEqual(board, Counter(snek.whole))
+
+    def test_updated_state_after_many_ticks_in_the_joining_tick(self):
+        """same as above, with the ticks merged in a single command 4"""
+        hash_id = self.server.deal_with_request(0, b'player')
+        snek = self.server.players[hash_id].snek
+        (alive, data, news, olds), _, _ = snekpi.decode_message(self.server.deal_with_request(3, hash_id))
+        board = apply_changes([], news, olds)
+
+        for _ in range(4):
+            self.step()
+        (alive, data, news, olds), _, _ = snekpi.decode_message(self.server.deal_with_request(4, hash_id))
+        self.assertEqual(apply_changes(board, news, olds), Counter(snek.whole))
+
+    def test_updated_state_without_current_state(self):
+        """a player that didn't ask for the current state gets its snek whole"""
+        hash_id = self.server.deal_with_request(0, b'player')
+        snek = self.server.players[hash_id].snek
+        self.step()
+        (alive, data, news, olds), _, _ = snekpi.decode_message(self.server.deal_with_request(4, hash_id))
+        self.assertEqual(apply_changes([], news, olds), Counter(snek.whole))
+
+
+class TestViewportStateRequests(TestStateRequests):
+
+    def setUp(self):
+        random.seed(0)
+        self.engine = SnekEngine(width=21, height=21, max_food=0, game_tick=0.1)
+        self.server = Server(None, self.engine, viewport=(5, 5))
+
+    def test_old_state_requests_resync_the_viewport(self):
+        """
+        commands 254 and 255 don't compute the objects the player knows about, so the next command 4 marks dead the
+        ones known since command 3 and sends the visible ones whole
+        """
+        hash_id = self.server.deal_with_request(0, b'player')
+        player = self.server.players[hash_id]
+        for _ in range(20):
+            self.engine.create_snek()
+        self.step()
+        self.server.deal_with_request(3, hash_id)
+        known = player.known
+        self.assertGreater(len(known[0]), 1)
+        self.step()
+        with mock.patch.object(self.server, '_Server__visible') as visible:
+            self.server.deal_with_request(255, hash_id)
+            self.server.deal_with_request(254, hash_id)
+            visible.assert_not_called()
+        self.assertIs(player.known, known)
+        self.step()
+        _, sneks, kinds = snekpi.decode_message(self.server.deal_with_request(4, hash_id))
+        for knowns, resent, visible in zip((known[0],) + known[1], [sneks] + kinds,
+                                           (player.known[0],) + player.known[1]):
+            self.assertEqual([(alive, news, olds) for alive, data, news, olds in resent[:len(knowns)]],
+                             [(False, [], [])] * len(knowns))
+            self.assertEqual(len(resent), len(knowns) + len(visible))
+
+
+class TestStaticKinds(unittest.TestCase):
+
+    def test_unchanged_walls_in_updated_state(self):
+        """walls are sent unchanged, in order, with every version (reusing their encodings)"""
+        random.seed(0)
+        walls = [Wall(pos=(x, 20)) for x in range(21)]  # the bottom row, away from the snek facing up
+        engine = SnekEngine(width=21, height=21, max_food=0, game_tick=0.1, walls=walls)
+        server = Server(None, engine)
+        hash_id = server.deal_with_request(0, b'player')
+        for version, decode in ((1, snekpi.decode_message), (2, snekpi.decode_message_v2)):
+            server.deal_with_request(6, hash_id + bytes((version,)))
+            for _ in range(2):
+                server.update(*engine.tick())
+                _, _, kinds = decode(server.deal_with_request(4, hash_id))
+                self.assertEqual(len(kinds[1]), len(walls))
+                self.assertTrue(all(alive and not news and not olds for alive, data, news, olds in kinds[1]))
+
+
+class FakeClock:
+    """stands for the time and asyncio modules in the snek engine loop: sleeping only moves the clock forward"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.now += seconds
+
+
+class SlowEngine(basetypes.SnekEngine):
+    """engine whose ticks take the given durations on clock"""
+
+    def __init__(self, clock, durations):
+        super().__init__(game_tick=1)
+        self.clock = clock
+        self.durations = list(durations)
+        self.starts = []
+
+    def move(self):
+        self.starts.append(self.clock.now)
+        self.clock.now += self.durations.pop(0) if self.durations else 0.5
+        return super().move()
+
+
+class TestLoop(unittest.IsolatedAsyncioTestCase):
+
+    async def run_loop(self, durations, ticks, overrun='catch_up', max_catch_up=5, fan_out=0):
+        """runs ticks ticks of a SlowEngine, spending fan_out seconds on each tick after it is yielded"""
+        clock = FakeClock()
+        engine = SlowEngine(clock, durations)
+        engine.OVERRUN, engine.MAX_CATCH_UP = overrun, max_catch_up
+        with mock.patch.object(basetypes, 'time', clock), mock.patch.object(basetypes, 'asyncio', clock):
+            loop = engine.loop()
+            for _ in range(ticks):
+                await loop.__anext__()
+                clock.now += fan_out
+            await loop.aclose()
+        return engine
+
+    async def test_deadlines_do_not_drift(self):
+        """each tick starts game_tick seconds after the previous one was due, however long the ticks take"""
+        engine = await self.run_loop([0.25, 0.5, 0.75], 5, fan_out=0.125)
+        self.assertEqual(engine.starts, [0, 1, 2, 3, 4])
+        self.assertEqual(engine.overruns, 0)
+        self.assertEqual([(stats.lateness, stats.move, stats.fan_out, stats.skipped) for stats in engine.stats],
+                         [(0, 0.25, 0.125, 0), (0, 0.5, 0.125, 0), (0, 0.75, 0.125, 0), (0, 0.5, 0.125, 0)])
+
+    async def test_catch_up(self):
+        """the ticks due while a tick ran late are run right away, one after the other"""
+        engine = await self.run_loop([0.5, 2.5], 7)
+        self.assertEqual(engine.starts, [0, 1, 3.5, 4, 4.5, 5, 6])
+        self.assertEqual(engine.overruns, 3)
+        self.assertEqual([stats.lateness for stats in engine.stats], [0, 0, 1.5, 1, 0.5, 0])
+        self.assertEqual([stats.skipped for stats in engine.stats], [0] * 6)
+
+    async def test_skip(self):
+        """the ticks due while a tick ran late are skipped, and the next one starts when it is due"""
+        engine = await self.run_loop([0.5, 2.5], 5, overrun='skip')
+        self.assertEqual(engine.starts, [0, 1, 4, 5, 6])
+        self.assertEqual(engine.overruns, 1)
+        self.assertEqual([stats.skipped for stats in engine.stats], [0, 2, 0, 0])
+        self.assertEqual([stats.lateness for stats in engine.stats], [0] * 4)
+
+    async def test_too_many_ticks_to_catch_up(self):
+        """catching up on more than MAX_CATCH_UP ticks skips them instead"""
+        engine = await self.run_loop([0.5, 2.5], 5, max_catch_up=1)
+        self.assertEqual(engine.starts, [0, 1, 4, 5, 6])
+        self.assertEqual([stats.skipped for stats in engine.stats], [0, 2, 0, 0])
+        engine = await self.run_loop([0.5, 2.5], 5, max_catch_up=2)
+        self.assertEqual(engine.starts, [0, 1, 3.5, 4, 4.5])
+
+
+if __name__ == '__main__':
+    unittest.main()
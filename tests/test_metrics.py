@@ -0,0 +1,69 @@
+import asyncio
+import unittest
+
+from sneklib.metrics import Metrics
+from tests import free_port
+
+
+class QuickMetrics(Metrics):
+    READ_TIMEOUT = 0.1
+    MAX_HEAD = 256
+
+
+class TestMetricsOverHTTP(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.metrics = QuickMetrics()
+        self.metrics.count('requests_total', 3, command=4)
+        self.metrics.gauge('players', lambda: 7)
+        self.address = '127.0.0.1', free_port()
+        task = asyncio.create_task(self.metrics.serve_http(*self.address))
+        self.addAsyncCleanup(self.stop, task)
+
+    @staticmethod
+    async def stop(task):
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    async def connect(self):
+        for _ in range(100):
+            try:
+                reader, writer = await asyncio.open_connection(*self.address)
+                break
+            except ConnectionError:
+                await asyncio.sleep(0.01)
+        self.addCleanup(writer.transport.abort)
+        return reader, writer
+
+    async def read(self, reader):
+        """everything the server sends until it closes the connection (b'' if it drops it)"""
+        try:
+            return await asyncio.wait_for(reader.read(), 1)
+        except ConnectionError:
+            return b''
+
+    async def test_scrape(self):
+        reader, writer = await self.connect()
+        writer.write(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\nAccept: text/plain\r\n\r\n')
+        head, body = (await self.read(reader)).split(b'\r\n\r\n', 1)
+        self.assertTrue(head.startswith(b'HTTP/1.1 200 OK\r\n'))
+        samples = dict(line.rsplit(' ', 1) for line in body.decode('utf-8').splitlines() if not line.startswith('#'))
+        self.assertEqual(float(samples['snek_requests_total{command="4"}']), 3)
+        self.assertEqual(float(samples['snek_players']), 7)
+
+    async def test_slow_request_is_dropped(self):
+        reader, writer = await self.connect()
+        writer.write(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n')  # the headers never end
+        self.assertEqual(await self.read(reader), b'')
+
+    async def test_oversized_head_is_dropped(self):
+        reader, writer = await self.connect()
+        writer.write(b'GET /metrics HTTP/1.1\r\n' + b'X-Padding: padding\r\n' * 20 + b'\r\n')
+        self.assertEqual(await self.read(reader), b'')
+        reader, writer = await self.connect()
+        writer.write(b'GET /' + b'x' * QuickMetrics.MAX_HEAD + b' HTTP/1.1\r\n\r\n')
+        self.assertEqual(await self.read(reader), b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
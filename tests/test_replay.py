@@ -0,0 +1,65 @@
+import json
+import os
+import random
+import tempfile
+import unittest
+
+from server import SnekEngine, Wall
+from sneklib.basetypes import Server
+from sneklib.replay import Recorder, Replay
+
+
+def engine_state(engine):
+    """the state of engine as given by Replay"""
+    def objects(objs):
+        return [(json.loads(json.dumps(obj.data)), list(obj.whole)) for obj in objs if obj.alive]
+    sneks, other_sneks = engine.all_objects
+    return objects(sneks), [objects(objs) for objs in other_sneks.values()]
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'game.rec')
+
+    def record(self, ticks, keyframe_every):
+        """records a seeded game, returning the state of the engine after each tick"""
+        random.seed(0)
+        engine = SnekEngine(width=20, height=20, max_food=30, game_tick=0.1, walls=[Wall(pos=(7, 7))])
+        server = Server(None, engine)
+        states = {}
+        with Recorder(self.path, engine.infos) as recorder:
+            recorder.KEYFRAME_EVERY = keyframe_every
+            server.recorder = recorder
+            for tick in range(ticks):
+                if tick % 5 == 0:  # players join between keyframes too
+                    server.deal_with_request(0, b'player %d' % tick)
+                for snek in engine.sneks:
+                    if random.random() < 0.3:
+                        snek.queue_input(random.choice('uldr'))
+                server.update(*engine.tick())
+                states[server.tick] = engine_state(engine)
+        return engine, states
+
+    def test_every_tick_is_rebuilt(self):
+        engine, states = self.record(60, 25)
+        replay = Replay(self.path)
+        self.assertEqual(replay.infos, engine.infos)
+        self.assertEqual((replay.first, replay.last), (1, 60))
+        self.assertEqual(sorted(replay.keyframes), [1, 26, 51])
+        for tick, state in states.items():
+            self.assertEqual(replay.state(tick), state, f'tick {tick}')
+
+    def test_states(self):
+        _, states = self.record(30, 10)
+        replay = Replay(self.path)
+        self.assertEqual(dict(replay.states(5, 25)), {tick: states[tick] for tick in range(5, 25)})
+        self.assertEqual(dict(replay.states(25)), {tick: states[tick] for tick in range(25, 31)})
+        with self.assertRaises(LookupError):
+            replay.state(31)
+
+
+if __name__ == '__main__':
+    unittest.main()
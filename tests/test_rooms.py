@@ -0,0 +1,147 @@
+import asyncio
+import multiprocessing
+import threading
+import unittest
+from functools import partial
+
+from server import SnekEngine
+from sneklib import aiosnek, snekpi
+from sneklib.rooms import RelayServer, RoomServer, RoomsServer, serve_rooms
+from tests import free_port
+
+
+class Relay(RelayServer):
+    SUBSCRIBER_BUFFER = 1024
+
+    def __init__(self, connection):
+        super().__init__(('127.0.0.1', free_port()))
+        self.pipes.append(connection)
+
+
+class Room(RoomServer):
+    KILL_TIME = 0.1
+    KICK_TIME = 0.2
+    EXPIRY_RESOLUTION = 0.05
+
+
+room_engine = partial(SnekEngine, width=21, height=21, max_food=0, game_tick=0.02)
+
+
+class Rooms(RoomsServer):
+
+    def __init__(self, connection):
+        super().__init__(('127.0.0.1', free_port()), [room_engine], Room)
+        self.pipes.append(connection)
+
+
+def flooding_server(connection, received):
+    """accepts every subscription and pushes updates to the subscribers until one of them gets unsubscribed"""
+    subscribers = []
+    while 1:
+        if subscribers and not connection.poll(0.01):
+            connection.send(('broadcast', subscribers, b'\x00' * 64 * 1024))
+            continue
+        request = connection.recv()
+        received.append(request)
+        kind, index, *args = request
+        if kind == 'request':
+            request_id, c, _args, handle = args
+            connection.send(('answer', request_id, b'\x00'))
+            if c == 5:
+                subscribers.append(handle)
+        elif kind == 'unsubscribe':
+            return
+
+
+class TestRoomServer(unittest.TestCase):
+
+    def setUp(self):
+        self.connection, room_connection = multiprocessing.Pipe()
+        self.engine = room_engine()
+        self.room = Room(room_connection, self.engine)
+        self.room.serve(0, 0, b'player', None)
+        self.hash_id = self.connection.recv()[2]
+
+    def messages(self):
+        """the kinds of the messages sent by the room so far"""
+        res = []
+        while self.connection.poll():
+            message = self.connection.recv()
+            res.append(message if message[0] == 'removed' else message[0])
+        return res
+
+    def test_dead_player_is_removed(self):
+        self.room.players[self.hash_id].snek.kill()
+        self.room.update(*self.engine.tick())
+        self.assertEqual(self.messages(), [])
+        self.room.serve(1, 4, self.hash_id, None)
+        self.assertCountEqual(self.messages(), ['answer', ('removed', self.hash_id)])
+        self.assertNotIn(self.hash_id, self.room.players)
+
+    def test_dead_subscribed_player_is_removed(self):
+        """a subscribed player is removed once the tick where its snek died is pushed, without sending any command"""
+        self.room.serve(1, 5, self.hash_id, 'handle')
+        self.room.update(*self.engine.tick())
+        self.assertEqual(self.messages(), ['answer', 'broadcast'])
+        self.room.players[self.hash_id].snek.kill()
+        self.room.update(*self.engine.tick())
+        self.assertEqual(self.messages(), ['broadcast', ('removed', self.hash_id)])
+        self.assertNotIn(self.hash_id, self.room.players)
+
+
+class TestRelayServer(unittest.IsolatedAsyncioTestCase):
+
+    async def start(self, relay_class, target, *args):
+        """starts a relay_class whose pipe leads to target(connection, *args) running in a thread"""
+        connection, server_connection = multiprocessing.Pipe()
+        thread = threading.Thread(target=target, args=(server_connection, *args), daemon=True)
+        thread.start()
+        relay = relay_class(connection)
+        task = asyncio.create_task(relay.relay_loop())
+        self.addAsyncCleanup(self.stop, task)
+        for _ in range(100):
+            try:
+                reader, writer = await asyncio.open_connection(*relay.address)
+                break
+            except ConnectionError:
+                await asyncio.sleep(0.01)
+        self.addCleanup(writer.transport.abort)
+        return relay, thread, reader, writer
+
+    @staticmethod
+    async def stop(task):
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    async def test_lagging_subscriber_is_dropped(self):
+        """a subscriber that doesn't read its updates gets disconnected instead of buffering them forever"""
+        received = []
+        relay, thread, reader, writer = await self.start(Relay, flooding_server, received)
+        writer.write(snekpi.FRAMED + snekpi.encode_frame(b'\x05'))
+        self.assertEqual(await reader.readexactly(5), snekpi.encode_frame(b'\x00'))
+
+        for _ in range(500):  # the subscriber doesn't read anything else
+            if not thread.is_alive():
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(received[-1][0], 'unsubscribe')
+        self.assertEqual(relay.subscribers, {})
+
+    async def test_kicked_players_leave_player_rooms(self):
+        """the rooms report the players they kick, even if they never send another command"""
+        rooms, thread, reader, writer = await self.start(Rooms, serve_rooms, {0: (Room, room_engine)})
+        connection = aiosnek.Connection(*rooms.address)
+        await connection.open()
+        self.addAsyncCleanup(connection.close)
+        hash_id = await connection.register('player')
+        self.assertEqual(rooms.player_rooms, {hash_id: 0})
+
+        for _ in range(100):
+            if not rooms.player_rooms:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(rooms.player_rooms, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import random
+import unittest
+from itertools import chain
+
+from server import ArrayPacManSnekEngine, ArraySnekEngine, PacManSnekEngine, Snek, SnekEngine, Wall, numpy
+
+
+class TestFoodSpawn(unittest.TestCase):
+
+    def play(self, engine_class, seed, ticks=50):
+        """plays a crowded game, checking after each tick that no food is under a snek"""
+        random.seed(seed)
+        engine = engine_class(width=12, height=12, max_food=30, game_tick=0.1)
+        for _ in range(8):
+            engine.create_snek()
+        for _ in range(ticks):
+            for snek in engine.sneks:
+                snek.queue_input(random.choice('uldr'))
+            engine.tick()
+            snek_blocks = {block for snek in engine.sneks for block in snek.whole}
+            for food in engine.foods:
+                self.assertNotIn(food.whole[0], snek_blocks, f'food under a snek (seed {seed})')
+
+    def test_food_never_spawns_under_a_snek(self):
+        for seed in range(100):
+            self.play(SnekEngine, seed)
+
+    def test_food_never_spawns_under_a_pacman_snek(self):
+        for seed in range(100):
+            self.play(PacManSnekEngine, seed)
+
+    @unittest.skipIf(numpy is None, 'the array engines need numpy')
+    def test_food_never_spawns_under_an_array_snek(self):
+        for seed in range(100):
+            self.play(ArraySnekEngine, seed)
+            self.play(ArrayPacManSnekEngine, seed)
+
+    @unittest.skipIf(numpy is None, 'the array engines need numpy')
+    def test_array_engines_keep_no_occupancy(self):
+        """the array engines find the free cells in their boards, so occupancy stays empty, and all_blocks is current"""
+        random.seed(0)
+        engine = ArraySnekEngine(width=12, height=12, max_food=5, game_tick=0.1, walls=[Wall(pos=(0, 0))])
+        for _ in range(3):
+            engine.create_snek()
+        for _ in range(5):
+            engine.tick()
+            blocks = [block for obj in chain(engine.sneks, engine.foods, engine.walls) for block in obj.whole]
+            self.assertEqual(sorted(engine.all_blocks), sorted(blocks))
+        self.assertEqual((len(engine.occupancy), engine.free_cells, engine.spawn_cells), (0, None, None))
+
+    def test_free_cells_match_occupancy(self):
+        random.seed(0)
+        engine = SnekEngine(width=12, height=12, max_food=30, game_tick=0.1)
+        for _ in range(8):
+            engine.create_snek()
+        for _ in range(50):
+            for snek in engine.sneks:
+                snek.queue_input(random.choice('uldr'))
+            engine.tick()
+            free = {y * 12 + x for x in range(12) for y in range(12 - 3) if (x, y) not in engine.occupancy.cells}
+            self.assertEqual(set(engine.free_cells.cells), free)
+
+
+class TestRuntimeObjects(unittest.TestCase):
+
+    def test_wall_placed_at_runtime(self):
+        snek = Snek(direction='u', pos=(5, 10))
+        engine = SnekEngine(width=20, height=20, max_food=0, game_tick=0.1, sneks=[snek])
+        engine.walls = [Wall(pos=(5, 9))]
+        engine.tick()
+        self.assertFalse(snek.alive)
+
+    def test_food_never_spawns_on_walls_placed_at_runtime(self):
+        for seed in range(20):
+            random.seed(seed)
+            engine = SnekEngine(width=12, height=12, max_food=0, game_tick=0.1)
+            engine.tick()
+            engine.walls = [Wall(pos=(x, y)) for x in range(12) for y in range(12 - 3) if (x + y) % 3]
+            engine.target_food = 30
+            for _ in range(5):
+                engine.tick()
+            wall_blocks = {wall.whole[0] for wall in engine.walls}
+            self.assertTrue(engine.foods)
+            self.assertFalse([food for food in engine.foods if food.whole[0] in wall_blocks], f'seed {seed}')
+
+    def test_foods_appended_at_runtime_are_indexed(self):
+        engine = SnekEngine(width=12, height=12, max_food=0, game_tick=0.1)
+        food = engine.create_food()
+        engine.tick()
+        self.assertEqual(engine.occupancy.owners(food.whole[0]), [food])
+        self.assertNotIn(food.whole[0][1] * 12 + food.whole[0][0], engine.free_cells)
+
+    def changed_wall(self, engine_class):
+        """a snek runs into a wall replaced inside the list of walls, after static_changed"""
+        snek = Snek(direction='u', pos=(5, 10))
+        engine = engine_class(width=20, height=20, max_food=0, game_tick=0.1, sneks=[snek], walls=[Wall(pos=(0, 0))])
+        engine.walls[0] = Wall(pos=(5, 9))
+        engine.static_changed(Wall)
+        self.assertEqual(engine.static_kind(Wall).blocks, [(5, 9)])
+        engine.tick()
+        self.assertFalse(snek.alive)
+        return engine
+
+    def test_static_changed(self):
+        engine = self.changed_wall(SnekEngine)
+        self.assertEqual(engine.occupancy.owners((5, 9)), engine.walls)
+        self.assertNotIn((0, 0), engine.occupancy)
+        self.assertIn(0, engine.free_cells)
+        self.assertNotIn(9 * 20 + 5, engine.free_cells)
+
+    @unittest.skipIf(numpy is None, 'the array engines need numpy')
+    def test_static_changed_in_an_array_engine(self):
+        self.changed_wall(ArraySnekEngine)
+
+
+class TestInputs(unittest.TestCase):
+
+    def test_reversals_are_filtered(self):
+        """each direction is checked against the previous buffered one, or the current one if none is buffered"""
+        snek = Snek(direction='u')
+        for direction in 'duulrd':
+            snek.queue_input(direction)
+        self.assertEqual(list(snek.inputs), ['l', 'd'])
+
+    def test_buffer_is_bounded(self):
+        snek = Snek(direction='u')
+        for direction in 'lururu':
+            snek.queue_input(direction)
+        self.assertEqual(list(snek.inputs), ['l', 'u', 'r'][:Snek.INPUTS])
+
+    def test_one_input_per_tick(self):
+        """a quick turn around (left then down) takes two ticks, so the snek doesn't run into itself"""
+        snek = Snek(pos=(10, 10))
+        engine = SnekEngine(width=20, height=20, max_food=0, game_tick=0.1, sneks=[snek])
+        snek.queue_input('l')
+        snek.queue_input('d')
+        engine.tick()
+        self.assertEqual((snek.dir, list(snek.inputs)), ('l', ['d']))
+        engine.tick()
+        self.assertEqual((snek.dir, list(snek.inputs)), ('d', []))
+        self.assertEqual(list(snek.whole), [(9, 11), (9, 10), (10, 10)])
+        self.assertTrue(snek.alive)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+import asyncio
+import random
+import unittest
+from unittest import mock
+
+from server import SnekEngine, Wall
+from sneklib import aiosnek, snekpi
+from sneklib.servers import AsyncTCPServer, AsyncUDPServer
+from tests import free_port
+
+
+class LimitedTCPServer(AsyncTCPServer):
+    MAX_OPEN_CONNECTIONS = 1
+    MAX_REQUEST = 16
+    READ_TIMEOUT = 0.1
+    SUBSCRIBER_BUFFER = 1024
+
+
+class TestAsyncUDPServer(unittest.IsolatedAsyncioTestCase):
+
+    async def start(self, walls=()):
+        random.seed(0)
+        engine = SnekEngine(width=200, height=200, max_food=0, game_tick=0.1, walls=list(walls))
+        server = AsyncUDPServer(('127.0.0.1', 0), engine)
+        task = asyncio.create_task(server.server_loop())
+        self.addAsyncCleanup(self.stop, task)
+        while server.transport is None:
+            await asyncio.sleep(0)
+        connection = aiosnek.DatagramConnection(*server.transport.get_extra_info('sockname'))
+        connection.RETRIES = 2
+        await connection.open()
+        self.addAsyncCleanup(connection.close)
+        return server, connection
+
+    @staticmethod
+    async def stop(task):
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    def oversized(self, server, command):
+        return server.metrics.counters.get(('oversized_datagrams_total', (('command', command),)), 0)
+
+    async def test_subscription(self):
+        server, connection = await self.start()
+        tick, player, sneks, kinds = await connection.subscribe()
+        self.assertEqual(len(server.subscribers), 1)
+        self.assertEqual(self.oversized(server, 5), 0)
+
+    async def test_oversized_subscription_is_refused(self):
+        """the whole state of a board with 6000 walls doesn't fit in a datagram"""
+        server, connection = await self.start(Wall(pos=(i % 200, i // 200 * 2)) for i in range(6000))
+        with self.assertRaisesRegex(ConnectionError, 'Error subscribing'):
+            await connection.subscribe()
+        self.assertEqual(server.subscribers, {})
+        self.assertEqual(self.oversized(server, 5), 1)
+
+    async def test_oversized_update_is_not_pushed(self):
+        server, connection = await self.start()
+        await connection.subscribe()
+        server.broadcast(b'\x00' * server.MAX_DATAGRAM)
+        self.assertEqual(self.oversized(server, 5), 1)
+        server.broadcast(b'\x00' * 4)
+        self.assertEqual(await asyncio.wait_for(connection.updates_queue.get(), 1), b'\x00' * 4)
+
+
+class TestAsyncTCPServer(unittest.IsolatedAsyncioTestCase):
+
+    async def start(self, server_class=AsyncTCPServer):
+        random.seed(0)
+        engine = SnekEngine(width=21, height=21, max_food=0, game_tick=0.1)
+        server = server_class(('127.0.0.1', free_port()), engine)
+        task = asyncio.create_task(server.server_loop())
+        self.addAsyncCleanup(TestAsyncUDPServer.stop, task)
+        return server
+
+    async def connect(self, server, framed=True):
+        for _ in range(100):
+            try:
+                reader, writer = await asyncio.open_connection(*server.address)
+                break
+            except ConnectionError:
+                await asyncio.sleep(0.01)
+        self.addCleanup(writer.transport.abort)
+        if framed:
+            writer.write(snekpi.FRAMED)
+        return reader, writer
+
+    @staticmethod
+    async def request(reader, writer, message):
+        """sends message as a frame and returns the framed answer"""
+        writer.write(snekpi.encode_frame(message))
+        header = await asyncio.wait_for(reader.readexactly(4), 1)
+        return await asyncio.wait_for(reader.readexactly(snekpi.decode_frame_header(header)), 1)
+
+    async def test_empty_frame(self):
+        """an empty frame gets an empty answer, and the connection keeps serving the following frames"""
+        server = await self.start()
+        reader, writer = await self.connect(server)
+        self.assertEqual(await self.request(reader, writer, b''), b'')
+        self.assertEqual(await self.request(reader, writer, b'\x02'), server.deal_with_request(2, b''))
+
+    async def assertClosed(self, reader):
+        """asserts that the server closes the connection of reader within a second, without answering"""
+        try:
+            self.assertEqual(await asyncio.wait_for(reader.read(), 1), b'')
+        except ConnectionError:
+            pass
+
+    async def test_connections_over_the_limit_are_closed(self):
+        server = await self.start(LimitedTCPServer)
+        reader, writer = await self.connect(server)
+        self.assertEqual(await self.request(reader, writer, b'\x02'), server.deal_with_request(2, b''))
+        self.assertEqual(server.connections, 1)
+        await self.assertClosed((await self.connect(server))[0])
+        self.assertEqual(await self.request(reader, writer, b'\x02'), server.deal_with_request(2, b''))
+
+    async def test_oversized_requests_are_refused(self):
+        server = await self.start(LimitedTCPServer)
+        reader, writer = await self.connect(server)
+        writer.write(snekpi.encode_frame(b'\x02' * (server.MAX_REQUEST + 1)))
+        await self.assertClosed(reader)
+        reader, writer = await self.connect(server, framed=False)
+        writer.write(b'\x02' * (server.MAX_REQUEST + 2))
+        writer.write_eof()
+        await self.assertClosed(reader)
+        self.assertEqual(server.connections, 0)
+
+    async def test_idle_readers_time_out(self):
+        server = await self.start(LimitedTCPServer)
+        reader, writer = await self.connect(server, framed=False)  # not even the command
+        await self.assertClosed(reader)
+        reader, writer = await self.connect(server)
+        writer.write(snekpi.encode_frame(b'\x02')[:-1])  # the header, but not the request
+        await self.assertClosed(reader)
+        self.assertEqual(server.connections, 0)
+
+    async def lagging_subscriber(self):
+        """a subscriber whose updates get held back, with a function setting the size of its write buffer"""
+        server = await self.start(LimitedTCPServer)
+        reader, writer = await self.connect(server)
+        await self.request(reader, writer, b'\x05')
+        handle, = server.subscribers
+        buffered = mock.patch.object(handle.transport, 'get_write_buffer_size', return_value=0).start()
+        self.addCleanup(mock.patch.stopall)
+
+        def set_buffered(size):
+            buffered.return_value = size
+        return server, (reader, writer), handle, set_buffered
+
+    async def test_lagging_subscriber_gets_merged_updates(self):
+        server, (reader, writer), handle, set_buffered = await self.lagging_subscriber()
+        server.update(*server.engine.tick())
+        set_buffered(server.SUBSCRIBER_BUFFER + 1)
+        held_from = server.tick
+        for _ in range(3):
+            server.update(*server.engine.tick())
+        set_buffered(server.SUBSCRIBER_BUFFER // 2)
+        server.update(*server.engine.tick())
+        merged = server.updates_since(held_from)
+
+        updates = []
+        for _ in range(2):
+            header = await asyncio.wait_for(reader.readexactly(4), 1)
+            updates.append(await asyncio.wait_for(reader.readexactly(snekpi.decode_frame_header(header)), 1))
+        self.assertEqual(snekpi.decode_delta(updates[0])[0], held_from)
+        self.assertEqual(updates[1], merged)
+        self.assertEqual(snekpi.decode_delta(updates[1])[0], server.tick)
+        self.assertIn(handle, server.subscribers)
+
+    async def test_lagging_subscriber_is_dropped(self):
+        """a subscriber whose write buffer doesn't get down to half of SUBSCRIBER_BUFFER within WRITE_TIMEOUT"""
+        server, connection, handle, set_buffered = await self.lagging_subscriber()
+        set_buffered(server.SUBSCRIBER_BUFFER // 2 + 1)  # enough to keep it lagging, once it is
+        with mock.patch('time.time', return_value=1000):
+            server.update(*server.engine.tick())
+            set_buffered(server.SUBSCRIBER_BUFFER + 1)
+            server.update(*server.engine.tick())
+            set_buffered(server.SUBSCRIBER_BUFFER // 2 + 1)
+        with mock.patch('time.time', return_value=1000 + server.WRITE_TIMEOUT):
+            server.update(*server.engine.tick())
+        self.assertIn(handle, server.subscribers)
+        with mock.patch('time.time', return_value=1000 + server.WRITE_TIMEOUT + 1):
+            server.update(*server.engine.tick())
+        self.assertNotIn(handle, server.subscribers)
+        self.assertTrue(handle.transport.is_closing())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+import json
+import random
+import unittest
+from unittest import mock
+
+from server import Food, Snek, SnekEngine, numpy
+from sneklib import snekpi
+from sneklib.basetypes import Server
+
+
+def state(snek):
+    """what decoding a snek encoded whole gives"""
+    return snek.alive, json.loads(json.dumps(snek.data)), list(snek.whole), []
+
+
+class TestEncoding(unittest.TestCase):
+
+    def setUp(self):
+        self.snek = Snek(direction='r', pos=(300, 60000), name='snek')
+        self.snek.kill()
+        self.foods = [Food(pos=(x, 2 * x)) for x in range(5)]
+
+    def test_snek(self):
+        message = snekpi.encode_partial_snek(self.snek, [(1, 2)], [(3, 4), (5, 6)], alive=True)
+        snek, rest = snekpi.decode_snek(message + b'rest')
+        self.assertEqual(snek, (True, {'name': 'snek'}, [(1, 2)], [(3, 4), (5, 6)]))
+        self.assertEqual(rest, b'rest')
+        self.assertEqual(snekpi.decode_snek(snekpi.encode_whole_snek(self.snek))[0], state(self.snek))
+
+    def test_message(self):
+        message = (snekpi.encode_whole_snek(self.snek) + snekpi.encode_whole_list([self.snek])
+                   + snekpi.encode_whole_list(self.foods) + snekpi.encode_whole_list([]))
+        player, sneks, kinds = snekpi.decode_message(message)
+        self.assertEqual(player, state(self.snek))
+        self.assertEqual(sneks, [state(self.snek)])
+        self.assertEqual(kinds, [[state(food) for food in self.foods], []])
+
+    def test_read_from_offset(self):
+        """the read_* functions decode from an offset, returning where they stopped"""
+        message = memoryview(b'head' + snekpi.encode_tick(70000) + snekpi.encode_whole_list(self.foods))
+        tick, offset = snekpi.read_tick(message, 4)
+        self.assertEqual((tick, offset), (70000, 8))
+        foods, offset = snekpi.read_list(message, offset)
+        self.assertEqual(foods, [state(food) for food in self.foods])
+        self.assertEqual(offset, len(message))
+        self.assertEqual(snekpi.read_lists(message, offset), ([], offset))
+
+    @unittest.skipIf(numpy is None, 'decode_blocks_array needs numpy')
+    def test_blocks_array(self):
+        blocks = numpy.array([(1, 2), (65535, 0), (7, 8)])
+        message = snekpi.encode_blocks(blocks[:1], blocks[1:])
+        new_blocks, old_blocks, rest = snekpi.decode_blocks_array(message + b'rest')
+        self.assertEqual(new_blocks.tolist(), [[1, 2]])
+        self.assertEqual(old_blocks.tolist(), [[65535, 0], [7, 8]])
+        self.assertEqual(snekpi.decode_blocks(message)[:2], ([(1, 2)], [(65535, 0), (7, 8)]))
+        self.assertEqual(rest, b'rest')
+
+
+class TestEncodingV2(unittest.TestCase):
+
+    def test_varint(self):
+        for number in (0, 1, 127, 128, 300, 2 ** 32, 2 ** 70):
+            message = snekpi.encode_varint(number) + b'rest'
+            self.assertEqual(snekpi.read_varint(message), (number, len(message) - 4))
+        self.assertEqual(len(snekpi.encode_varint(127)), 1)
+        self.assertEqual(len(snekpi.encode_varint(128)), 2)
+
+    def test_block_lists(self):
+        """paths and any other list of blocks decode to themselves, paths taking a byte every 4 steps"""
+        random.seed(0)
+        for length in range(12):
+            path = [(500, 500)]
+            for _ in range(length - 1):
+                dx, dy = random.choice(snekpi.STEPS)
+                path.append((path[-1][0] + dx, path[-1][1] + dy))
+            scattered = [(random.randrange(1000), random.randrange(1000)) for _ in range(length)]
+            for blocks in (path, scattered):
+                message = snekpi.encode_block_list_v2(blocks) + b'rest'
+                self.assertEqual(snekpi.read_block_list_v2(message), (blocks, len(message) - 4))
+            if length > 2:
+                self.assertEqual(len(snekpi.encode_block_list_v2(path)), 1 + 2 * 2 + (length + 2) // 4)
+
+    def test_data_only_when_flagged(self):
+        snek = Snek(direction='r', pos=(3, 4), name='snek')
+        food = Food(pos=(1, 1))
+        message = snekpi.encode_partial_list_v2([(snek, [(3, 3)], [(3, 6)]), (food, [], [])], changed={food})
+        sneks, offset = snekpi.read_list_v2(message)
+        self.assertEqual(sneks, [(True, None, [(3, 3)], [(3, 6)]), (True, [], [], [])])
+        self.assertEqual(offset, len(message))
+        self.assertEqual(snekpi.read_list_v2(snekpi.encode_unchanged_list_v2(3))[0], [(True, None, [], [])] * 3)
+
+    def test_server_messages(self):
+        """the answers of a server using version 2 decode to the same state as the ones of version 1"""
+        random.seed(0)
+        engine = SnekEngine(width=30, height=30, max_food=5, game_tick=0.1)
+        server = Server(None, engine)
+        hash_id = server.deal_with_request(0, b'player')
+        hash_id_v2 = server.deal_with_request(0, b'player v2')
+        server.deal_with_request(6, hash_id_v2 + bytes((2,)))
+        for _ in range(3):
+            server.update(*engine.tick())
+        player, sneks, kinds = snekpi.decode_message(server.deal_with_request(3, hash_id))
+        player_v2, sneks_v2, kinds_v2 = snekpi.decode_message_v2(server.deal_with_request(3, hash_id_v2))
+        self.assertEqual(sorted(map(repr, [player] + sneks)), sorted(map(repr, [player_v2] + sneks_v2)))
+        self.assertEqual(kinds, kinds_v2)
+
+    def test_data_changes_tracked_once_version_2_is_used(self):
+        """without version 2 the data isn't encoded every tick, and a player switching to it later gets it anyway"""
+        random.seed(0)
+        engine = SnekEngine(width=30, height=30, max_food=5, game_tick=0.1)
+        server = Server(None, engine)
+        hash_id = server.deal_with_request(0, b'player')
+        other = engine.create_snek(name='other')
+        with mock.patch.object(snekpi, 'encode_json', wraps=snekpi.encode_json) as encode_json:
+            for _ in range(2):  # the sneks spawn 3 rows or more away from the top, facing up
+                server.update(*engine.tick())
+            encode_json.assert_not_called()
+        other.data['name'] = 'renamed'
+        server.deal_with_request(6, hash_id + bytes((2,)))
+        server.update(*engine.tick())
+        _, sneks, _ = snekpi.decode_message_v2(server.deal_with_request(4, hash_id))
+        self.assertIn({'name': 'renamed'}, [data for alive, data, news, olds in sneks])
+
+
+class TestStreamDecoder(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        self.engine = SnekEngine(width=30, height=30, max_food=5, game_tick=0.1)
+        self.server = Server(None, self.engine)
+        self.hash_id = self.server.deal_with_request(0, b'player')
+        for _ in range(3):
+            self.engine.create_snek()
+        for _ in range(3):
+            self.server.update(*self.engine.tick())
+
+    def feed(self, decoder, message, size):
+        for start in range(0, len(message), size):
+            decoder.feed(message[start:start + size])
+        return decoder.result()
+
+    def test_chunks(self):
+        """whatever the chunks the message arrives in, the result is the same as decoding it at once"""
+        current = self.server.deal_with_request(3, self.hash_id)
+        subscription = self.server.deal_with_request(5, self.hash_id)
+        delta = self.server.updates_since(self.server.tick - 2)
+        for size in (1, 2, 3, 7, 64, len(current)):
+            self.assertEqual(self.feed(snekpi.StreamDecoder(), current, size), snekpi.decode_message(current))
+            self.assertEqual(self.feed(snekpi.StreamDecoder(tick=True), subscription, size),
+                             snekpi.decode_subscription(subscription))
+            self.assertEqual(self.feed(snekpi.StreamDecoder(tick=True, player=False), delta, size),
+                             snekpi.decode_delta(delta))
+
+    def test_incomplete_message(self):
+        current = self.server.deal_with_request(3, self.hash_id)
+        decoder = snekpi.StreamDecoder()
+        decoder.feed(current[:-1])
+        with self.assertRaises(ValueError):
+            decoder.result()
+        decoder.feed(current[-1:])
+        self.assertEqual(decoder.result(), snekpi.decode_message(current))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import random
+import unittest
+
+from server import SnekEngine
+from sneklib.spatial import FreeCells, Occupancy
+
+
+class TestOccupancy(unittest.TestCase):
+
+    def setUp(self):
+        self.occupied = []
+        self.freed = []
+        self.occupancy = Occupancy(self.occupied.append, self.freed.append)
+
+    def test_shared_blocks(self):
+        """a block stays occupied until its last owner leaves it"""
+        self.occupancy.add('a', [(0, 0), (0, 1)])
+        self.occupancy.add('b', [(0, 1), (0, 2)])
+        self.assertEqual(self.occupied, [(0, 0), (0, 1), (0, 2)])
+        self.assertEqual(self.occupancy.owners((0, 1)), ['a', 'b'])
+
+        self.occupancy.remove('a', [(0, 0), (0, 1)])
+        self.assertEqual(self.freed, [(0, 0)])
+        self.assertEqual(self.occupancy.owners((0, 1)), ['b'])
+        self.assertNotIn((0, 0), self.occupancy)
+        self.assertEqual(len(self.occupancy), 2)
+        self.assertEqual(self.occupancy.changes, 3)
+
+    def test_removing_blocks_of_another_owner(self):
+        self.occupancy.add('a', [(0, 0)])
+        self.occupancy.remove('b', [(0, 0), (5, 5)])
+        self.assertEqual(self.occupancy.owners((0, 0)), ['a'])
+        self.assertEqual(self.freed, [])
+
+    def test_engine_occupancy_matches_its_objects(self):
+        random.seed(0)
+        engine = SnekEngine(width=12, height=12, max_food=10, game_tick=0.1)
+        for _ in range(6):
+            engine.create_snek()
+        for _ in range(100):
+            for snek in engine.sneks:
+                snek.queue_input(random.choice('uldr'))
+            engine.tick()
+            sneks, other_sneks = engine.all_objects
+            objects = list(sneks) + [element for elements in other_sneks.values() for element in elements]
+            self.assertEqual(set(engine.occupancy.cells), {block for obj in objects for block in obj.whole})
+            for obj in objects:
+                for block in obj.whole:
+                    self.assertIn(obj, engine.occupancy.owners(block))
+
+
+class TestFreeCells(unittest.TestCase):
+
+    def test_initial_range(self):
+        cells = FreeCells(10, 3, 7)
+        self.assertEqual(sorted(cells.cells), [3, 4, 5, 6])
+        self.assertEqual([cell in cells for cell in range(10)], [False] * 3 + [True] * 4 + [False] * 3)
+        self.assertEqual(len(FreeCells(10, 7, 3)), 0)
+
+    def test_matches_a_set(self):
+        random.seed(0)
+        cells, expected = FreeCells(50), set(range(50))
+        for _ in range(2000):
+            cell = random.randrange(50)
+            if random.random() < 0.5:
+                cells.add(cell)
+                expected.add(cell)
+            else:
+                cells.discard(cell)
+                expected.discard(cell)
+            self.assertEqual(len(cells), len(expected))
+            self.assertEqual(set(cells.cells), expected)
+            for position, cell in enumerate(cells.cells):
+                self.assertEqual(cells.positions[cell], position)
+            if expected:
+                self.assertIn(cells.choice(), expected)
+
+    def test_choice_of_an_empty_set(self):
+        cells = FreeCells(3)
+        for cell in range(3):
+            cells.discard(cell)
+        self.assertFalse(cells)
+        with self.assertRaises(IndexError):
+            cells.choice()
+
+
+if __name__ == '__main__':
+    unittest.main()
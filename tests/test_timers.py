@@ -0,0 +1,75 @@
+import random
+import unittest
+from unittest import mock
+
+from server import SnekEngine
+from sneklib.basetypes import Server
+from sneklib.timers import TimerWheel
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def test_items_are_due_with_their_slot(self):
+        wheel = TimerWheel(0.5)
+        wheel.schedule('a', 10.2)
+        wheel.schedule('b', 10.7)
+        wheel.schedule('c', 10.4)
+        self.assertEqual(len(wheel), 3)
+        self.assertEqual(wheel.pop_due(9.9), [])
+        self.assertEqual(wheel.pop_due(10), ['a', 'c'])  # up to resolution seconds early
+        self.assertEqual(wheel.pop_due(10.4), [])
+        self.assertEqual(wheel.pop_due(12), ['b'])
+        self.assertEqual(len(wheel), 0)
+
+    def test_late_items_come_with_the_next_slot(self):
+        wheel = TimerWheel(1)
+        wheel.pop_due(5)
+        wheel.schedule('late', 3)
+        self.assertEqual(wheel.pop_due(5.5), [])
+        self.assertEqual(wheel.pop_due(6), ['late'])
+
+    def test_due_items(self):
+        """whether pop_due walks the slots or sorts them, it returns exactly the items of the slots started by now"""
+        random.seed(0)
+        wheel = TimerWheel(1)
+        items = []
+        now = 0
+        for _ in range(200):
+            when = now + random.choice((random.random() * 3, random.random() * 1000))
+            wheel.schedule(when, when)
+            items.append(when)
+            if random.random() < 0.3:
+                now += random.random() * 100
+                due = wheel.pop_due(now)
+                self.assertEqual(sorted(due), sorted(when for when in items if when < int(now) + 1))
+                items = [when for when in items if when >= int(now) + 1]
+                self.assertEqual(len(wheel), len(items))
+
+
+class TestPlayerExpiry(unittest.TestCase):
+
+    def test_inactive_players_are_killed_then_kicked(self):
+        engine = SnekEngine(width=21, height=21, max_food=0, game_tick=0.1)
+        server = Server(None, engine)
+        server.player_removed = removed = mock.Mock()
+        with mock.patch('time.time', return_value=1000):
+            idle = server.deal_with_request(0, b'idle')
+            active = server.deal_with_request(0, b'active')
+        idle_snek = server.players[idle].snek
+        still = {}, {}, {kind: {} for kind in engine.other_sneks}, {kind: {} for kind in engine.other_sneks}
+
+        for now in range(1000, 1000 + int(server.KICK_TIME) + 2):
+            with mock.patch('time.time', return_value=now):
+                server.deal_with_request(4, active)
+                server.update(*still)  # nothing moves, so only inactivity kills sneks
+            if now - 1000 <= server.KILL_TIME:
+                self.assertTrue(idle_snek.alive)
+            elif now - 1000 > server.KILL_TIME + server.EXPIRY_RESOLUTION:
+                self.assertFalse(idle_snek.alive)
+        self.assertNotIn(idle, server.players)
+        self.assertIn(active, server.players)
+        removed.assert_called_once_with(idle)
+
+
+if __name__ == '__main__':
+    unittest.main()